@@ -0,0 +1,131 @@
+##\package capture
+# \brief Compact binary capture of MODBUS traffic
+#
+# Vegard Fiksdal (C) 2024
+#
+# A trace file starts with a header followed by one record per request or response:
+#
+#   Header: magic 'MBTT' (4 bytes), version (uint8)
+#   Record: timestamp  float64  Seconds since capture started (Monotonic clock)
+#           tid        uint16   Transaction id (0 for serial framers)
+#           direction  uint8    0 for requests, 1 for responses
+#           unit       uint8    Unit id (Slave id)
+#           function   uint8    Function code (With exception bit set on errors)
+#           length     uint16   Length of the PDU
+#           pdu        bytes    Raw PDU, including the function code
+#
+# All values are little endian.
+#
+import struct,threading,time
+
+##\class Trace
+# \brief Trace file constants
+class Trace():
+    ## File magic
+    magic=b'MBTT'
+
+    ## File format version
+    version=1
+
+    ## Record header layout
+    record=struct.Struct('<dHBBBH')
+
+    ## Direction of requests
+    request=0
+
+    ## Direction of responses
+    response=1
+
+##\class TraceWriter
+# \brief Writes MODBUS requests and responses to a trace file
+#
+# The write methods are safe to call from any thread, and are shaped to be
+# passed directly as pymodbus request_tracer and response_manipulator hooks.
+# Records are buffered and flushed to disk at most once per second.
+class TraceWriter():
+    ##\brief Opens trace file for writing
+    # \param filename Path to trace file
+    def __init__(self,filename):
+        self.fd=open(filename,'wb')
+        self.fd.write(Trace.magic+bytes([Trace.version]))
+        self.lock=threading.Lock()
+        self.started=time.monotonic()
+        self.flushed=self.started
+        self.count=0
+
+    ##\brief Write a record
+    # \param direction Trace.request or Trace.response
+    # \param message Decoded pymodbus request or response
+    def write(self,direction,message):
+        now=time.monotonic()
+        pdu=bytes([message.function_code])+message.encode()
+        header=Trace.record.pack(now-self.started,message.transaction_id&0xFFFF,direction,message.slave_id&0xFF,message.function_code&0xFF,len(pdu))
+        with self.lock:
+            if self.fd:
+                self.fd.write(header+pdu)
+                self.count+=1
+                if now-self.flushed>1:
+                    self.fd.flush()
+                    self.flushed=now
+
+    ##\brief Request tracer hook
+    # \param request Decoded request
+    # \param addr Client address (Not used)
+    def traceRequest(self,request,*addr):
+        self.write(Trace.request,request)
+
+    ##\brief Response manipulator hook
+    # \param response Response to be sent
+    # \return Unchanged response, False to let pymodbus encode it
+    def traceResponse(self,response):
+        self.write(Trace.response,response)
+        return response,False
+
+    ##\brief Flush and close trace file
+    def close(self):
+        with self.lock:
+            if self.fd:
+                self.fd.close()
+                self.fd=None
+
+##\class TraceReader
+# \brief Reads records from a trace file
+class TraceReader():
+    ##\brief Opens trace file and checks header
+    # \param filename Path to trace file
+    def __init__(self,filename):
+        self.filename=filename
+        with open(filename,'rb') as fd:
+            header=fd.read(len(Trace.magic)+1)
+        if header[:len(Trace.magic)]!=Trace.magic:
+            raise Exception('Not a trace file: '+filename)
+        if header[-1]!=Trace.version:
+            raise Exception('Unsupported trace version: '+str(header[-1]))
+
+    ##\brief Iterate records
+    # \return Generator of tuples (timestamp,tid,direction,unit,function,pdu)
+    def records(self):
+        with open(self.filename,'rb') as fd:
+            fd.seek(len(Trace.magic)+1)
+            while True:
+                header=fd.read(Trace.record.size)
+                if len(header)<Trace.record.size: break
+                timestamp,tid,direction,unit,function,length=Trace.record.unpack(header)
+                pdu=fd.read(length)
+                if len(pdu)<length: break
+                yield timestamp,tid,direction,unit,function,pdu
+
+    ##\brief Pair requests with their responses
+    # \return List of [request record, response record or None]
+    def transactions(self):
+        pairs=[]
+        pending={}
+        for record in self.records():
+            key=(record[1],record[3])
+            if record[2]==Trace.request:
+                pair=[record,None]
+                pairs.append(pair)
+                pending[key]=pair
+            elif key in pending:
+                pending.pop(key)[1]=record
+        return pairs
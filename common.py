@@ -3,11 +3,11 @@
 #
 # Vegard Fiksdal (C) 2024
 #
-from pymodbus.payload import BinaryPayloadBuilder
-from pymodbus.payload import BinaryPayloadDecoder
-from pymodbus.datastore import ModbusSparseDataBlock
-import json,logging,sys,os,argparse,struct,socket,datetime
-import serial.tools.list_ports
+# Heavy modules (pymodbus, pyserial) are imported where they are first used, so
+# tools only pay for what they use. Datablocks live in datastore.py for the same
+# reason.
+#
+import json,logging,sys,os,argparse,struct,socket,datetime,collections,array,mmap,threading,time,contextlib,bisect
 
 ##\class App
 # \brief Argument parsing and version handling
@@ -52,24 +52,47 @@ class App():
             s+='%-*s: %s\n' % (30,'Network port',args.port)
         return s
 
+    ##\brief Reports time spent importing modules
+    # \param argv Commandline of the tool to report on
+    # \param count Number of modules to list
+    # \return Import report as a string
+    #
+    # The tool is run again under python -X importtime with --version, so it exits
+    # right after importing its modules and parsing its arguments.
+    def reportImports(argv,count=10):
+        import subprocess
+        result=subprocess.run([sys.executable,'-X','importtime']+argv+['--version'],stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,text=True)
+        modules=[]
+        for line in result.stderr.splitlines():
+            fields=line.split('|')
+            if len(fields)!=3 or not fields[1].strip().isdigit(): continue
+            # Only count modules imported at top level, nested ones are included in their cumulative time
+            if fields[2].startswith('  '): continue
+            modules.append((int(fields[1]),fields[2].strip()))
+        modules.sort(reverse=True)
+        s='%-*s: %.1fms\n' % (30,'Total import time',sum(module[0] for module in modules)/1000)
+        for cumulative,name in modules[:count]:
+            s+='%-*s: %.1fms\n' % (30,name,cumulative/1000)
+        return s
+
 ##\class Profiles
 # \brief Utilities for loading profiles
 class Profiles():
+    ## Directories in PATH holding MBTester, searched on first use
+    execpaths=None
+
     ##\brief Get search paths for profiles
     # \param args Argument list to get user specified paths
     # \return List of paths eligable to hold profiles
     def getProfilePaths(args):
         # Add path
-        path=[]
-        for dir in os.get_exec_path():
-            try:
-                for file in os.listdir(dir):
-                    if file.upper()=='MBTSERVER.PY' or file.upper()=='QMBTSERVER.PY':
-                        if not dir in path: path.append(dir)
-                    if file.upper()=='MBTSERVER.EXE' or file.upper()=='QMBTSERVER.EXE':
-                        if not dir in path: path.append(dir)
-            except:
-                pass
+        if Profiles.execpaths==None:
+            Profiles.execpaths=[]
+            for dir in os.get_exec_path():
+                for file in ['mbtserver.py','qmbtserver.py','mbtserver.exe','qmbtserver.exe']:
+                    if os.path.isfile(os.path.join(dir,file)) and not dir in Profiles.execpaths:
+                        Profiles.execpaths.append(dir)
+        path=list(Profiles.execpaths)
 
         # Add user specified and cwd paths
         if os.path.dirname(args.profile):
@@ -109,6 +132,8 @@ class Profiles():
     # \param args Argument list to get user specified paths
     # \return Path to profile or None on failure
     def getProfile(args,profile):
+        if len(profile)==0:
+            return None
         if os.path.exists(profile):
             return profile
         files=Profiles.listProfiles(args)
@@ -242,6 +267,7 @@ class Registers():
     # \param value Decoded value
     # \return List of register values
     def encodeRegister(register,value):
+        from pymodbus.payload import BinaryPayloadBuilder
         builder = BinaryPayloadBuilder(byteorder=register['bo'], wordorder=register['wo'])
         if register['dtype']=='float16':     builder.add_16bit_float(value)
         elif register['dtype']=='float32':   builder.add_32bit_float(value)
@@ -266,6 +292,7 @@ class Registers():
     # \param values List of register values
     # \return Decoded value
     def decodeRegister(register,values):
+        from pymodbus.payload import BinaryPayloadDecoder
         decoder = BinaryPayloadDecoder.fromRegisters(values, byteorder=register['bo'], wordorder=register['wo'])
         value = None
         if register['dtype']=='float16':     value = decoder.decode_16bit_float()
@@ -322,72 +349,228 @@ class Registers():
             while len(value)<length: value+=' '
         return value
 
-##\class DataBlock
-# \brief Retains modbus registers in memory
-class DataBlock(ModbusSparseDataBlock):
-    ##\brief Initiates data storage and loads profile
-    # \param profile Modbus registers to load
-    # \param datablock Modbus datablock to load
-    # \param string Set to true to only respond to defined address (Enable IllegalAddress exceptions)
-    def __init__(self, profile, datablock, strict=False):
-        self.rcallbacks=[]
-        self.wcallbacks=[]
-        self.profile=profile
-        self.datablock=datablock
-        registers={}
-        prev=0
-        keys=list(profile['datablocks'][datablock].keys())
-        for i in range(len(keys)): keys[i]=int(keys[i])
-        keys.sort()
-        for key in keys:
-            register=profile['datablocks'][datablock][str(key)]
-            logging.debug('Setting register['+str(key)+']='+str(register['value']))
-            if not strict:
-                for i in range(prev+1,key):
-                    prev+=1
-                    if datablock=='di' or datablock=='co':
-                        registers[prev]=Registers.encodeRegister({'dtype':'bit','bo':'<','wo':'<'},0)
-                    if datablock=='hr' or datablock=='ir':
-                        registers[prev]=Registers.encodeRegister({'dtype':'uint16','bo':'<','wo':'<'},0)
-            registers[key]=Registers.encodeRegister(register,register['value'])
-            prev+=len(registers[key])
-        super().__init__(registers)
-
-    ##\brief Add callback for register write
-    # \param callback Callback function(datablock,register,value)
-    def addWriteCallback(self,callback):
-        self.wcallbacks.append(callback)
-
-    ##\brief Add callback for register write
-    # \param callback Callback function(datablock,register,value)
-    def addReadCallback(self,callback):
-        self.rcallbacks.append(callback)
-
-    ##\brief Overwrites modbus registers and calls optional callback
-    # \param address Register address to write to
-    # \param value Values to write
-    def setValues(self, address, value):
-        for callback in self.wcallbacks:
-            value=callback(self.datablock,address,value)
-        super().setValues(address,value)
-        #self.profile['datablocks'][self.datablock][str(address)]['value']=value
-
-    ##\brief Get modbus register contents
-    # \param address Register address to read from
-    # \param count Number of 16-bit registers to read
-    # \return Values
-    def getValues(self, address, count=1):
-        values = super().getValues(address,count)
-        for callback in self.rcallbacks:
-            values=callback(self.datablock,address,values)
-        #self.profile['datablocks'][self.datablock][str(address)]['value']=values
+##\class RegisterIndex
+# \brief Sorted index of register address ranges
+#
+# Registers are kept as sorted (address,count) ranges, and contiguous ranges are
+# merged into runs. This answers whether a block of words is fully defined, and
+# which registers a block overlaps, with binary searches instead of per word lookups.
+class RegisterIndex():
+    ##\brief Builds index from register ranges
+    # \param ranges List of (address,count) tuples
+    def __init__(self,ranges=[]):
+        ranges=sorted((int(address),int(count)) for address,count in ranges)
+        self.starts=[address for address,count in ranges]
+        self.counts=[count for address,count in ranges]
+        self.runstarts=[]
+        self.runends=[]
+        for address,count in ranges:
+            if len(self.runends) and self.runends[-1]>=address:
+                self.runends[-1]=max(self.runends[-1],address+count)
+            else:
+                self.runstarts.append(address)
+                self.runends.append(address+count)
+
+    ##\brief Builds index of the registers defined in a profile datablock
+    # \param registers Dictionary of registers from the profile
+    # \return RegisterIndex
+    def fromProfile(registers):
+        return RegisterIndex([(address,Registers.registersPerValue(registers[address])) for address in registers])
+
+    ##\brief Check if a block of words is fully defined
+    # \param address First address of block
+    # \param count Number of words in block
+    # \return True if all words in [address,address+count) are defined
+    def contains(self,address,count=1):
+        i=bisect.bisect_right(self.runstarts,address)-1
+        return i>=0 and self.runends[i]>=address+count
+
+    ##\brief Find registers overlapping a block of words
+    # \param address First address of block
+    # \param count Number of words in block
+    # \return List of (address,count) tuples for the registers overlapping the block
+    def overlapping(self,address,count=1):
+        i=bisect.bisect_right(self.starts,address)-1
+        if i<0 or self.starts[i]+self.counts[i]<=address: i+=1
+        j=bisect.bisect_left(self.starts,address+count)
+        return [(self.starts[k],self.counts[k]) for k in range(max(i,0),j)]
+
+    ##\brief Get contiguous runs of defined words
+    # \return List of (address,count) tuples
+    def runs(self):
+        return [(self.runstarts[i],self.runends[i]-self.runstarts[i]) for i in range(len(self.runstarts))]
+
+##\class ReadPlanner
+# \brief Coalesces the registers of a profile into block reads
+#
+# Registers are sorted by address and merged into blocks as long as the gap
+# between them is no more than maxgap words, and the block stays within the
+# protocol limit of 125 registers or 2000 bits per request. Gaps are read but
+# discarded, so only allow them for devices that do not reject undefined addresses.
+class ReadPlanner():
+    ## Maximum number of registers per read request
+    maxregisters=125
+
+    ## Maximum number of bits per read request
+    maxbits=2000
+
+    ##\brief Plan block reads for a datablock
+    # \param registers Dictionary of registers from the profile
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param maxgap Maximum number of undefined words to read across
+    # \return List of (address,count,addresses) tuples, where addresses are the profile keys read by the block
+    def plan(registers,datablock,maxgap=0):
+        limit=ReadPlanner.maxbits if datablock=='di' or datablock=='co' else ReadPlanner.maxregisters
+        blocks=[]
+        for address in sorted(registers,key=int):
+            start=int(address)
+            count=Registers.registersPerValue(registers[address])
+            if len(blocks):
+                first,length,keys=blocks[-1]
+                end=first+length
+                if start-end<=maxgap and max(end,start+count)-first<=limit:
+                    blocks[-1]=(first,max(end,start+count)-first,keys+[address])
+                    continue
+            blocks.append((start,count,[address]))
+        return blocks
+
+    ##\brief Decode the registers of a block read
+    # \param registers Dictionary of registers from the profile
+    # \param block Block as returned by plan()
+    # \param values Register words or bits read for the block
+    # \return Dictionary of profile key to decoded value
+    def decode(registers,block,values):
+        output={}
+        first,length,keys=block
+        for address in keys:
+            register=registers[address]
+            offset=int(address)-first
+            output[address]=Registers.decodeRegister(register,values[offset:offset+Registers.registersPerValue(register)])
+        return output
+
+##\class RegionSearch
+# \brief Finds the valid regions of an address range with block reads
+#
+# The range is read in the largest blocks a request allows. A rejected block is
+# split in halves, which are read in turn, so valid regions cost a few requests
+# regardless of their length. Only rejected blocks of a few addresses are probed
+# address by address, to find the exact edges of the valid regions.
+class RegionSearch():
+    ## Rejected blocks of at most this many addresses are probed address by address
+    leaf=8
+
+    ##\brief Read all valid addresses of a range
+    # \param fetch Function(address,count) returning a list of values, None if rejected, or False if the datablock is not supported
+    # \param first First address
+    # \param last Last address
+    # \param limit Maximum number of addresses per read
+    # \return Dictionary of address to value, or None if the datablock is not supported
+    def search(fetch,first,last,limit):
+        values={}
+        pending=[(start,min(limit,last+1-start)) for start in range(first,last+1,limit)]
+        pending.reverse()
+        while len(pending):
+            address,count=pending.pop()
+            data=fetch(address,count)
+            if data is False: return None
+            if data!=None:
+                values.update(zip(range(address,address+count),data))
+            elif count>RegionSearch.leaf:
+                half=count//2
+                pending.append((address+half,count-half))
+                pending.append((address,half))
+            elif count>1:
+                pending.extend((start,1) for start in range(address+count-1,address-1,-1))
         return values
 
-    ##\brief Validate modbus register contents
-    # \param address Register address to validate
-    # \param count Number of 16-bit registers to validate
-    def validate(self, address, count=1):
-        return super().validate(address,count)
+##\class ProfileWatcher
+# \brief Polls a profile file and reports when it has changed
+#
+# Modification time and size are polled rather than relying on platform specific
+# notifications. A change is only reported once the file has been stable for one
+# polling interval, so editors writing the file in several steps are not caught
+# halfway.
+class ProfileWatcher():
+    ##\brief Initializes watcher
+    # \param filename File to watch
+    # \param callback Function called with the filename when it has changed
+    # \param interval Polling interval in seconds
+    def __init__(self,filename,callback,interval=1.0):
+        self.filename=filename
+        self.callback=callback
+        self.interval=interval
+        self.running=False
+        self.thread=None
+        self.stamp=self.getStamp()
+
+    ##\brief Get modification time and size of the file
+    # \return Tuple of modification time and size, or None if the file is missing
+    def getStamp(self):
+        try:
+            stat=os.stat(self.filename)
+            return (stat.st_mtime_ns,stat.st_size)
+        except OSError:
+            return None
+
+    ##\brief Thread method polling the file
+    def run(self):
+        pending=None
+        while self.running:
+            time.sleep(self.interval)
+            stamp=self.getStamp()
+            if stamp==None or stamp==self.stamp:
+                pending=None
+            elif stamp!=pending:
+                pending=stamp
+            else:
+                self.stamp=stamp
+                pending=None
+                try:
+                    self.callback(self.filename)
+                except Exception as error:
+                    logging.error('Failed to reload '+self.filename+': '+str(error))
+
+    ##\brief Starts watching in a background thread
+    def start(self):
+        self.running=True
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    ##\brief Stops watching
+    def stop(self):
+        self.running=False
+        self.thread=None
+
+##\class UpdateBus
+# \brief Hands register updates from background threads over to the UI thread
+#
+# Producers (Modbus server threads, client workers) only append to a bounded
+# deque, which is thread safe without taking any locks. The UI thread drains it
+# once per timer tick and only keeps the latest value for each register. If the
+# UI falls behind, the oldest updates are dropped rather than blocking producers.
+class UpdateBus():
+    ##\brief Initializes an empty bus
+    # \param capacity Maximum number of pending updates before dropping old ones
+    def __init__(self,capacity=100000):
+        self.queue=collections.deque(maxlen=capacity)
+        self.dropped=0
+
+    ##\brief Post a register update (Any thread)
+    # \param datablock Datablock containing register
+    # \param address Register address that has changed
+    # \param value New register value
+    def put(self,datablock,address,value):
+        if len(self.queue)==self.queue.maxlen: self.dropped+=1
+        self.queue.append((datablock,address,value))
+
+    ##\brief Collect pending updates (Consumer thread)
+    # \return Dictionary of (datablock,address) -> latest value
+    def take(self):
+        updates={}
+        for i in range(len(self.queue)):
+            datablock,address,value=self.queue.popleft()
+            updates[(datablock,address)]=value
+        return updates
 
 ##\class LogHandler
 # \brief Custom logging handler for dynamic output handling
@@ -398,9 +581,12 @@ class LogHandler(logging.Handler):
     ## Reference to the output object (Falls back to print())
     output=None
 
-    ## Effective log level to display
+    ## Effective log level to print when there is no output object
     level=logging.INFO
 
+    ## File to print to when there is no output object, None for stdout
+    fd=None
+
     ##\brief Initializes handler
     def __init__(self):
         super().__init__()
@@ -408,14 +594,17 @@ class LogHandler(logging.Handler):
 
     ##\brief Handle output
     # \param record Log record to handle
+    #
+    # The output object gets records down to the lowest level it offers and
+    # filters them itself, so lowering its level shows the records logged before
+    # the change.
     def emit(self, record):
-        if record.levelno>=LogHandler.level:
-            if LogHandler.output:
-                LogHandler.output.processLog(record)
-            else:
-                t=datetime.datetime.now().strftime('%c')
-                msg='%s  %-*s %s' % (t,8,record.levelname,record.msg)
-                print(msg)
+        if LogHandler.output:
+            if record.levelno>=logging.DEBUG: LogHandler.output.processLog(record)
+        elif record.levelno>=LogHandler.level:
+            t=datetime.datetime.now().strftime('%c')
+            msg='%s  %-*s %s' % (t,8,record.levelname,record.msg)
+            print(msg,file=LogHandler.fd)
 
 ##\class Loader
 # \brief Class to handle command line arguments for all targets
@@ -429,7 +618,9 @@ class Loader():
     ##\brief Parses command line parameters and splits them into server- and client arguments
     # \param usage Usage description for argparse
     # \param gui Set to true to relax input requirements (User can set them in GUI)
-    def __init__(self,usage='%(prog)s --server [options] | --client [options]',gui=False):
+    # \param parents Additional argparse parents for tool specific options
+    # \param required Set to false if the tool does not require a profile
+    def __init__(self,usage='%(prog)s --server [options] | --client [options]',gui=False,parents=[],required=True):
         # Split arguments in client- and server arguments
         clientargs=[]
         serverargs=[]
@@ -449,8 +640,8 @@ class Loader():
         parser=argparse.ArgumentParser(add_help=False)
         parser.add_argument('-C','--client',help='Run as MODBUS client',dest='client',action='store_true')
         parser.add_argument('-S','--server',help='Run as MODBUS server',dest='server',action='store_true')
-        serverargs=self.parseArguments(args=serverargs,parents=[parser],usage=usage,offset=0)
-        clientargs=self.parseArguments(args=clientargs,parents=[parser],usage=usage,offset=-1)
+        serverargs=self.parseArguments(args=serverargs,parents=[parser]+parents,usage=usage,offset=0)
+        clientargs=self.parseArguments(args=clientargs,parents=[parser]+parents,usage=usage,offset=-1)
 
         # Check for common profile
         profile=''
@@ -458,7 +649,7 @@ class Loader():
         if len(serverargs.profile): profile=serverargs.profile
         serverargs.profile=profile
         clientargs.profile=profile
-        if not gui:
+        if not gui and (required or len(profile)):
             if len(profile)==0:
                 print('Please set a profile to use (See -p or --profile parameter)')
                 sys.exit()
@@ -503,21 +694,37 @@ class Loader():
         parser.add_argument('-b','--baudrate',help='Serial device baud rate',dest='baudrate',default=9600,type=int)
         parser.add_argument('-x','--parity',choices=['O', 'E', 'N'],help='Serial device parity',dest='parity',default='N',type=str)
         parser.add_argument('-B','--bytesize',choices=[7,8],help='Serial bits per byte',dest='bytesize',default=8,type=int)
-        parser.add_argument('-t','--timeout',help='Request timeout',dest='timeout',default=1,type=int)
+        parser.add_argument('-t','--timeout',help='Request timeout in seconds',dest='timeout',default=1,type=float)
+        parser.add_argument('-A','--adaptive',help='Adapt timeouts to measured response times and back off from unresponsive devices (client only)',action='store_true')
         parser.add_argument('-p','--profile',help='MODBUS register profile to serve',dest='profile',default='',type=str)
         parser.add_argument('-a','--strict',help='Only respond to defined registers',action='store_true')
+        parser.add_argument('-k','--capture',help='Capture traffic to a trace file (server only)',dest='capture',default='',type=str)
+        parser.add_argument('-i','--image',help='Keep register values in a memory mapped file other processes can attach to (server only)',dest='image',default='',type=str)
+        parser.add_argument('-w','--workers',help='Number of server processes sharing one TCP port (server only)',dest='workers',default=1,type=int)
+        parser.add_argument('-W','--watch',help='Reload the profile when it changes on disk (server only)',action='store_true')
+        parser.add_argument('-e','--cache',help='Cache encoded read responses of up to this many address ranges per datablock (server only), default is 0 (disabled)',dest='cache',default=0,type=int)
+        parser.add_argument('-j','--persist',help='Persist register values in PATH.snap and PATH.wal, and restore them at startup (server only)',dest='persist',default='',type=str)
+        parser.add_argument('--fsync',help='Sync persisted register writes to disk after every commit (server only)',action='store_true')
+        parser.add_argument('--checkpoint',help='Seconds between snapshots of persisted register values (server only), default is 300',dest='checkpoint',default=300,type=float)
+        parser.add_argument('-r','--rate',help='Scenario update rate in Hz (server only), 0 disables scenarios, default is 10',dest='rate',default=10,type=float)
         parser.add_argument('-L','--list',choices=['profiles', 'serial'],help='List available resources',dest='list',default=None,type=str)
         parser.add_argument('-v','--version',help='Print version information',action='store_true')
+        parser.add_argument('--imports',help='Report time spent importing modules and exit',action='store_true')
         parser.add_argument('-l','--log',choices=['critical', 'error', 'warning', 'info', 'debug'],help='Log level, default is info',dest='log',default='info',type=str)
         args=parser.parse_args(args)
+        if args.rate<0: parser.error('argument -r/--rate: must not be negative')
         if args.list=='profiles':
             profiles=Profiles.listProfiles(args)
             for profile in profiles: print(profile[0]+profile[1])
             sys.exit()
         if args.list=='serial':
+            import serial.tools.list_ports
             ports=serial.tools.list_ports.comports()
             for port, desc, hwid in sorted(ports): print(port+'\t'+desc)
             sys.exit()
+        if args.imports:
+            print(App.reportImports([arg for arg in sys.argv if arg!='--imports']))
+            sys.exit()
         if args.version:
             print(App.getAbout())
             sys.exit()
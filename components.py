@@ -5,12 +5,12 @@
 #
 
 # Import QT framework
-from PyQt5.QtWidgets import QDialog, QDialogButtonBox, QComboBox, QLabel, QLineEdit, QListWidget, QPushButton, QVBoxLayout, QHBoxLayout, QMessageBox, QFrame, QFileDialog, QTableWidget, QTableWidgetItem
+from PyQt5.QtWidgets import QDialog, QDialogButtonBox, QComboBox, QLabel, QLineEdit, QListWidget, QListView, QTableView, QPushButton, QVBoxLayout, QHBoxLayout, QMessageBox, QFrame, QFileDialog, QTableWidget, QTableWidgetItem
 from PyQt5.Qt import QStandardItem, QHeaderView, QAbstractItemView
 from PyQt5.QtGui import QFont, QColor
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import Qt, QTimer, QAbstractListModel, QAbstractTableModel, QModelIndex
 from pymodbus import pymodbus_apply_logging_config
-import datetime,threading
+import datetime,threading,collections,heapq
 import serial.tools.list_ports
 from common import *
 
@@ -49,21 +49,236 @@ class BrowseBox(QFrame):
     def getValue(self):
         return self.edit.text()
 
+##\class LogModel
+# \brief Bounded ring buffers of log lines exposed as a virtual list model
+#
+# Records are retained in fixed size buffers, oldest records are dropped when
+# they are full. Debug records have a buffer of their own, so a flood of them
+# (Like the frame dumps of pymodbus) never evicts records of higher levels. The
+# view only sees the records at or above the current level, so changing the
+# level filters the buffers without losing anything. Records are formatted when
+# the view asks for them, so records never displayed are never formatted.
+class LogModel(QAbstractListModel):
+    ##\brief Initializes empty buffers
+    # \param capacity Maximum number of records to retain per buffer
+    def __init__(self,capacity):
+        super().__init__()
+        self.capacity=capacity
+        self.level=logging.INFO
+        self.count=0
+        self.records=collections.deque(maxlen=capacity)
+        self.debug=collections.deque(maxlen=capacity)
+        self.rows=collections.deque(maxlen=capacity)
+
+    ##\brief Check if a record passes the current level filter
+    # \param record Tuple of (level,item,sequence). Level None is always shown.
+    # \return True if record is to be displayed
+    def accept(self,record):
+        return record[0]==None or record[0]>=self.level
+
+    ##\brief Get the text of a record
+    # \param record Tuple of (level,item,sequence), where item is a text string or a LogRecord
+    # \return Text of the record
+    def format(record):
+        item=record[1]
+        if isinstance(item,str): return item
+        t=datetime.datetime.fromtimestamp(item.created).strftime('%c')
+        return '%s  %-*s %s' % (t,8,item.levelname,item.msg)
+
+    ##\brief Number of displayed rows
+    # \param parent Parent index (Not used, this is a flat list)
+    # \return Number of rows
+    def rowCount(self,parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(self.rows)
+
+    ##\brief Get text of a displayed row
+    # \param index Model index of row
+    # \param role Item data role
+    # \return Text of the row, or None
+    def data(self,index,role=Qt.DisplayRole):
+        if role==Qt.DisplayRole and index.isValid():
+            return LogModel.format(self.rows[index.row()])
+        return None
+
+    ##\brief Append records to the buffers
+    # \param records List of (level,item) tuples, where item is a text string or a LogRecord
+    def append(self,records):
+        records=[(record[0],record[1],self.count+i) for i,record in enumerate(records)]
+        self.count+=len(records)
+        for record in records:
+            if record[0]!=None and record[0]<logging.INFO: self.debug.append(record)
+            else: self.records.append(record)
+        rows=[record for record in records if self.accept(record)]
+        if len(rows)==0: return
+        rows=rows[-self.capacity:]
+
+        # Drop oldest rows to make room
+        overflow=min(len(self.rows)+len(rows)-self.capacity,len(self.rows))
+        if overflow>0:
+            self.beginRemoveRows(QModelIndex(),0,overflow-1)
+            for i in range(overflow): self.rows.popleft()
+            self.endRemoveRows()
+
+        # Insert new rows
+        first=len(self.rows)
+        self.beginInsertRows(QModelIndex(),first,first+len(rows)-1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    ##\brief Change level filter and rebuild displayed rows from the buffers
+    # \param level New loglevel
+    def setLevel(self,level):
+        self.beginResetModel()
+        self.level=level
+        records=heapq.merge(self.records,self.debug,key=lambda record: record[2]) if level<logging.INFO else self.records
+        self.rows=collections.deque([record for record in records if self.accept(record)],maxlen=self.capacity)
+        self.endResetModel()
+
+    ##\brief Drop all records
+    def clear(self):
+        self.beginResetModel()
+        self.records.clear()
+        self.debug.clear()
+        self.rows.clear()
+        self.endResetModel()
+
+    ##\brief Write displayed rows to a file, line by line
+    # \param fd File object to write to
+    def write(self,fd):
+        for record in self.rows:
+            fd.write(LogModel.format(record)+'\n')
+
+##\class RegisterTableModel
+# \brief Table model holding one row per register with constant time address lookup
+#
+# Values are changed with setValue() from anywhere in the UI thread, but the views
+# are only notified when flush() is called. This coalesces any number of changes
+# into a single dataChanged signal per timer tick.
+class RegisterTableModel(QAbstractTableModel):
+    ##\brief Initializes model
+    # \param headers List of column titles
+    # \param rows List of rows, each a list of column values
+    # \param keycolumn Column holding the register address
+    # \param valuecolumn Column holding the register value
+    def __init__(self,headers,rows,keycolumn,valuecolumn):
+        super().__init__()
+        self.headers=headers
+        self.rows=rows
+        self.keycolumn=keycolumn
+        self.valuecolumn=valuecolumn
+        self.lookup={}
+        for i in range(len(rows)):
+            self.lookup[str(rows[i][keycolumn])]=i
+        self.first=None
+        self.last=None
+
+    ##\brief Number of rows
+    # \param parent Parent index (Not used, this is a flat table)
+    # \return Number of rows
+    def rowCount(self,parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(self.rows)
+
+    ##\brief Number of columns
+    # \param parent Parent index (Not used, this is a flat table)
+    # \return Number of columns
+    def columnCount(self,parent=QModelIndex()):
+        if parent.isValid(): return 0
+        return len(self.headers)
+
+    ##\brief Get cell contents
+    # \param index Model index of cell
+    # \param role Item data role
+    # \return Text of the cell, or None
+    def data(self,index,role=Qt.DisplayRole):
+        if role==Qt.DisplayRole and index.isValid():
+            return str(self.rows[index.row()][index.column()])
+        return None
+
+    ##\brief Get column titles
+    # \param section Column or row number
+    # \param orientation Horizontal or vertical header
+    # \param role Item data role
+    # \return Column title, or None
+    def headerData(self,section,orientation,role=Qt.DisplayRole):
+        if role==Qt.DisplayRole and orientation==Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    ##\brief Get row number of a register
+    # \param address Register address
+    # \return Row number or None if address is not in the table
+    def getRow(self,address):
+        return self.lookup.get(str(address))
+
+    ##\brief Get address of a row
+    # \param row Row number
+    # \return Register address as a string
+    def getAddress(self,row):
+        return str(self.rows[row][self.keycolumn])
+
+    ##\brief Change the value of a register
+    # \param address Register address
+    # \param value New value
+    # \return True if the address is in the table
+    #
+    # Views are not notified before flush() is called
+    def setValue(self,address,value):
+        row=self.lookup.get(str(address))
+        if row==None: return False
+        self.rows[row][self.valuecolumn]=value
+        if self.first==None or row<self.first: self.first=row
+        if self.last==None or row>self.last: self.last=row
+        return True
+
+    ##\brief Notify views of all changes since last flush
+    def flush(self):
+        if self.first!=None:
+            first=self.index(self.first,self.valuecolumn)
+            last=self.index(self.last,self.valuecolumn)
+            self.first=None
+            self.last=None
+            self.dataChanged.emit(first,last,[Qt.DisplayRole])
+
+##\class RegisterTableView
+# \brief Read-only table view with the look shared by all register tables
+class RegisterTableView(QTableView):
+    ##\brief Configures view
+    # \param model RegisterTableModel to display
+    def __init__(self,model):
+        super().__init__()
+        self.setModel(model)
+        self.verticalHeader().setVisible(False)
+        self.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
 ##\class ConFrame
 # \brief Frame to display realtime log output
 class ConFrame(QFrame):
+    ## Default number of log records to retain
+    capacity=10000
+
     ##\brief Constructor sets up frame layout
     # \param args Parsed commandline arguments
-    def __init__(self,args):
+    # \param capacity Maximum number of log records to retain
+    def __init__(self,args,capacity=None):
         super().__init__()
-        self.listbox=QListWidget()
+        if capacity==None: capacity=ConFrame.capacity
+        self.model=LogModel(capacity)
+        self.listbox=QListView()
         self.listbox.setFont(QFont('cascadia mono'))
+        self.listbox.setUniformItemSizes(True)
+        self.listbox.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.listbox.setModel(self.model)
         self.dropdown=QComboBox()
         self.clearbutton=QPushButton('Clear logs')
         self.clearbutton.clicked.connect(self.clear)
         self.savebutton=QPushButton('Save log to file')
         self.savebutton.clicked.connect(self.savelog)
-        self.messages=[]
+        self.messages=collections.deque(maxlen=capacity)
+        self.debug=collections.deque(maxlen=capacity)
         self.msgbox=False
 
         # Manage loglevels
@@ -74,6 +289,7 @@ class ConFrame(QFrame):
             if args.log.upper()==levels[i]: level=i
         self.dropdown.currentIndexChanged.connect(self.currentIndexChanged)
         self.dropdown.setCurrentIndex(level)
+        self.model.setLevel(logging._nameToLevel[levels[level]])
 
         # Add any controls to the layout
         layout=QVBoxLayout()
@@ -99,31 +315,34 @@ class ConFrame(QFrame):
         levelname=self.dropdown.itemText(index)
         level=logging._nameToLevel[levelname]
         LogHandler.level=level
+        self.model.setLevel(level)
 
     ##\brief Clear existing log
     def clear(self):
-        self.messages=[]
-        self.listbox.clear()
+        self.messages.clear()
+        self.debug.clear()
+        self.model.clear()
 
     ##\brief Process messages from logger
+    # \param message Log record to process
+    #
+    # This may be called from any thread, the record is only queued here. Debug
+    # records are queued separately, so they never evict records of higher levels.
     def processLog(self,message):
-        self.messages.append(message)
+        if message.levelno<logging.INFO: self.debug.append(message)
+        else: self.messages.append(message)
 
     ##\brief Manually adds a text string
     # \param text Text string to add
     def addText(self,text):
-        self.listbox.addItem(text)
+        self.model.append([(None,text)])
 
     ##\brief Saves log output to file
     def savelog(self):
-        text=''
-        for message in self.messages:
-            text+=message+'\n'
         filename, _ = QFileDialog.getSaveFileName(self,'Save process log','mbserver.log','Log files(*.log);;All Files(*.*)',options=QFileDialog.Options())
         if filename:
             with open(filename, 'w') as f:
-                f.write(text)
-                f.close()
+                self.model.write(f)
 
     ##\brief Show errors in a messagebox
     # \param show True to display messagebox for error messages
@@ -134,14 +353,17 @@ class ConFrame(QFrame):
 
     ##\brief Updates GUI with added messages
     def update(self):
-        messages=self.messages
-        self.messages=[]
-        for message in messages:
+        messages=[]
+        while len(self.messages):
+            message=self.messages.popleft()
             if self.msgbox and (message.levelno==logging.ERROR or message.levelno==logging.CRITICAL):
                 QMessageBox.critical(self,message.module,str(message.msg))
-            s='%s  %-*s %s' % (datetime.datetime.now().strftime('%c'),8,message.levelname,message.msg)
-            self.listbox.addItem(s)
+            messages.append(message)
+        debug=[]
+        while len(self.debug): debug.append(self.debug.popleft())
+        if len(debug): messages=list(heapq.merge(messages,debug,key=lambda message: message.created))
         if len(messages):
+            self.model.append([(message.levelno,message) for message in messages])
             self.listbox.scrollToBottom()
 
 ##\class StandardItem
@@ -403,6 +625,7 @@ class CSVLogger(QFrame):
         # Populate table
         self.profile=profile
         self.table=[]
+        self.lookup={}
         for datablock in profile['datablocks']:
             datatype=Utilities.getDatablockName(datablock)
             for register in profile['datablocks'][datablock]:
@@ -412,6 +635,7 @@ class CSVLogger(QFrame):
                 column.append(registers[register]['dsc'])
                 column.append(register)
                 column.append(registers[register]['value'])
+                self.lookup[(datablock,register)]=len(self.table)
                 self.table.append(column)
         self.tablewidget.setColumnCount(4)
         self.tablewidget.setRowCount(len(self.table))
@@ -477,8 +701,6 @@ class CSVLogger(QFrame):
     # \param address Register address that has changed
     # \param value New register value
     def update(self,datablock,address,value):
-        datatype=Utilities.getDatablockName(datablock)
-        for j in range(len(self.table)):
-            if self.table[j][0]==datatype and self.table[j][2]==str(address):
-                self.tablewidget.setItem(j,3,QTableWidgetItem(str(value)))
-                break
+        row=self.lookup.get((datablock,str(address)))
+        if row!=None:
+            self.tablewidget.item(row,3).setText(str(value))
@@ -0,0 +1,719 @@
+##\package datastore
+# \brief Register storage of MODBUS servers
+#
+# Vegard Fiksdal (C) 2024
+#
+# Kept apart from common.py, as the datablocks derive from pymodbus classes and
+# importing pymodbus dominates the startup time of the tools not serving registers.
+#
+from pymodbus.datastore import ModbusSparseDataBlock
+from multiprocessing import shared_memory
+try:
+    import fcntl
+except ImportError:
+    fcntl=None
+from common import *
+
+##\class ResponseCache
+# \brief Encoded read responses of a datablock, by address range
+#
+# Entries are indexed by the pages of addresses they cover, so a write only
+# drops the entries overlapping the written addresses. Each entry carries the
+# stamp of the datablock it was read at, and is only valid while the stamp is
+# unchanged (See DataBlock.getStamp()). Lookups take no lock, while entries
+# are added and dropped under the lock of the datablock.
+class ResponseCache():
+    ## Number of address bits per page
+    pageshift=6
+
+    ##\brief Initializes an empty cache
+    # \param limit Maximum number of entries, the cache is emptied when full
+    def __init__(self,limit=1024):
+        self.limit=limit
+        self.entries={}
+        self.pages={}
+        self.hits=0
+        self.misses=0
+
+    ##\brief Look up an encoded response
+    # \param address First address of range
+    # \param count Number of addresses in range
+    # \param stamp Current stamp of the datablock
+    # \return Encoded response, or None if not cached
+    def get(self,address,count,stamp):
+        entry=self.entries.get((address,count))
+        if entry and entry[1]==stamp:
+            self.hits+=1
+            return entry[0]
+        self.misses+=1
+        return None
+
+    ##\brief Add an encoded response
+    # \param address First address of range
+    # \param count Number of addresses in range
+    # \param data Encoded response
+    # \param stamp Stamp of the datablock when the values were read
+    def put(self,address,count,data,stamp):
+        if len(self.entries)>=self.limit: self.clear()
+        key=(address,count)
+        self.entries[key]=(data,stamp)
+        for page in ResponseCache.getPages(address,count):
+            self.pages.setdefault(page,set()).add(key)
+
+    ##\brief Drop all entries overlapping a range
+    # \param address First address of range
+    # \param count Number of addresses in range
+    def invalidate(self,address,count):
+        for page in ResponseCache.getPages(address,count):
+            keys=self.pages.get(page)
+            if not keys: continue
+            for key in [key for key in keys if key[0]<address+count and address<key[0]+key[1]]:
+                self.entries.pop(key,None)
+                for other in ResponseCache.getPages(*key):
+                    self.pages[other].discard(key)
+
+    ##\brief Get the pages covered by a range
+    # \param address First address of range
+    # \param count Number of addresses in range
+    # \return Range of page numbers
+    def getPages(address,count):
+        return range(address>>ResponseCache.pageshift,((address+count-1)>>ResponseCache.pageshift)+1)
+
+    ##\brief Drop all entries
+    def clear(self):
+        self.entries={}
+        self.pages={}
+
+##\class Subscription
+# \brief Observer of the reads or writes of a range of addresses in a DataBlock
+class Subscription():
+    ##\brief Initializes subscription
+    # \param callback Callback function, see DataBlock.subscribeReads() and DataBlock.subscribeWrites()
+    # \param first First address to observe
+    # \param last Last address to observe
+    def __init__(self,callback,first=0,last=65535):
+        self.callback=callback
+        self.first=first
+        self.last=last
+
+    ##\brief Check if a range overlaps the observed addresses
+    # \param address First address of range
+    # \param count Number of addresses in range
+    # \return True if overlapping
+    def overlaps(self,address,count):
+        return address<=self.last and address+count>self.first
+
+##\class DataBlock
+# \brief Retains modbus registers in memory
+#
+# Writers are serialized by a lock, while readers never take it. Instead every
+# write bumps a sequence counter before and after changing the values, so the
+# counter is odd while a write is in progress. Readers copy the values and retry
+# if the counter was odd or changed meanwhile, which gives consistent snapshots
+# of values spanning several registers (Eg. float64) without slowing down reads.
+#
+# Reads and writes may be observed with subscriptions limited to a range of
+# addresses, or just counted. When nothing observes the reads, getValues() is
+# a plain snapshot of the values.
+class DataBlock(ModbusSparseDataBlock):
+    ##\brief Initiates data storage and loads profile
+    # \param profile Modbus registers to load
+    # \param datablock Modbus datablock to load
+    # \param string Set to true to only respond to defined address (Enable IllegalAddress exceptions)
+    def __init__(self, profile, datablock, strict=False):
+        self.rcallbacks=[]
+        self.wcallbacks=[]
+        self.readers=[]
+        self.writers=[]
+        self.observed=False
+        self.counting=False
+        self.reads=0
+        self.writes=0
+        self.lock=threading.RLock()
+        self.depth=0
+        self.sequence=0
+        self.writer=None
+        self.cache=None
+        self.profile=profile
+        self.datablock=datablock
+        self.strict=strict
+        registers,keys=DataBlock.encodeProfile(profile,datablock,strict)
+        super().__init__(registers)
+
+        # Index defined registers, and all words we respond to
+        self.registers=RegisterIndex([(key,len(registers[key])) for key in keys])
+        self.index=RegisterIndex([(key,1) for key in self.values])
+
+    ##\brief Encode the registers of a profile datablock
+    # \param profile Modbus registers to load
+    # \param datablock Modbus datablock to load
+    # \param strict Set to true to only include defined addresses, otherwise gaps are filled with zeros
+    # \return Dictionary of address to list of words, and sorted list of defined addresses
+    def encodeProfile(profile,datablock,strict=False):
+        registers={}
+        prev=0
+        keys=list(profile['datablocks'][datablock].keys())
+        for i in range(len(keys)): keys[i]=int(keys[i])
+        keys.sort()
+        for key in keys:
+            register=profile['datablocks'][datablock][str(key)]
+            logging.debug('Setting register['+str(key)+']='+str(register['value']))
+            if not strict:
+                for i in range(prev+1,key):
+                    prev+=1
+                    if datablock=='di' or datablock=='co':
+                        registers[prev]=Registers.encodeRegister({'dtype':'bit','bo':'<','wo':'<'},0)
+                    if datablock=='hr' or datablock=='ir':
+                        registers[prev]=Registers.encodeRegister({'dtype':'uint16','bo':'<','wo':'<'},0)
+            registers[key]=Registers.encodeRegister(register,register['value'])
+            prev+=len(registers[key])
+        return registers,keys
+
+    ##\brief Encode and validate the register layout of a new profile
+    # \param profile New profile
+    # \return Layout to pass to commit()
+    #
+    # Nothing is changed here, so a profile that fails to encode leaves the
+    # datablock as it was.
+    def prepare(self,profile):
+        old=self.profile['datablocks'][self.datablock]
+        new=profile['datablocks'][self.datablock]
+        registers,keys=DataBlock.encodeProfile(profile,self.datablock,self.strict)
+        added,removed,changed,kept=0,0,0,[]
+        for address in old:
+            if not address in new: removed+=1
+        for address in new:
+            register=new[address]
+            if not address in old:
+                added+=1
+                continue
+            previous=old[address]
+            if register['dtype']!=previous['dtype'] or Registers.registersPerValue(register)!=Registers.registersPerValue(previous):
+                changed+=1
+                continue
+            kept.append(address)
+        return profile,registers,keys,kept,(added,removed,changed)
+
+    ##\brief Replace the register layout with one prepared by prepare()
+    # \param layout Layout returned by prepare()
+    # \return Number of added, removed and changed registers
+    #
+    # Registers whose datatype and size are unchanged keep their current value, and
+    # the value of the new profile is updated to match. The change is applied in a
+    # single atomic section, so readers see either the old or the new layout.
+    def commit(self,layout):
+        profile,registers,keys,kept,counts=layout
+        new=profile['datablocks'][self.datablock]
+        with self.atomic():
+            for address in kept:
+                register=new[address]
+                words=self.load(int(address),Registers.registersPerValue(register))
+                registers[int(address)]=words
+                register['value']=Registers.decodeRegister(register,words)
+            self.replace(ModbusSparseDataBlock(registers).values)
+            self.registers=RegisterIndex([(key,len(registers[key])) for key in keys])
+            self.index=RegisterIndex([(key,1) for key in self.values])
+            self.profile=profile
+        return counts
+
+    ##\brief Replace the register layout with the one of a new profile
+    # \param profile New profile
+    # \return Number of added, removed and changed registers
+    def reload(self,profile):
+        return self.commit(self.prepare(profile))
+
+    ##\brief Replace all stored words, only valid inside an atomic context
+    # \param values Dictionary of address to word
+    def replace(self,values):
+        self.values=values
+        self.default_value=values.copy()
+        if self.cache: self.cache.clear()
+
+    ##\brief Add callback for register write
+    # \param callback Callback function(datablock,register,value)
+    def addWriteCallback(self,callback):
+        self.wcallbacks=self.wcallbacks+[callback]
+
+    ##\brief Add callback for register read
+    # \param callback Callback function(datablock,register,value)
+    #
+    # The callback may change the values read, and is called for every read. Use
+    # subscribeReads() to only observe reads.
+    def addReadCallback(self,callback):
+        self.rcallbacks=self.rcallbacks+[callback]
+        self.update()
+
+    ##\brief Add callback for batched register writes
+    # \param callback Callback function(datablock,changes)
+    # \return Subscription
+    def addBatchCallback(self,callback):
+        return self.subscribeWrites(callback)
+
+    ##\brief Observe reads of a range of addresses
+    # \param callback Callback function(datablock,address,values), called after reads overlapping the range
+    # \param first First address to observe
+    # \param last Last address to observe
+    # \return Subscription to pass to unsubscribe()
+    def subscribeReads(self,callback,first=0,last=65535):
+        subscription=Subscription(callback,first,last)
+        self.readers=self.readers+[subscription]
+        self.update()
+        return subscription
+
+    ##\brief Observe writes to a range of addresses
+    # \param callback Callback function(datablock,changes)
+    # \param first First address to observe
+    # \param last Last address to observe
+    # \return Subscription to pass to unsubscribe()
+    #
+    # The callback is called once per write operation overlapping the range, after
+    # the values are stored, with a list of (address,values) tuples for each of the
+    # contiguous ranges changed that overlap the observed range.
+    def subscribeWrites(self,callback,first=0,last=65535):
+        subscription=Subscription(callback,first,last)
+        self.writers=self.writers+[subscription]
+        return subscription
+
+    ##\brief Remove a subscription
+    # \param subscription Subscription returned by subscribeReads() or subscribeWrites()
+    def unsubscribe(self,subscription):
+        self.readers=[reader for reader in self.readers if reader!=subscription]
+        self.writers=[writer for writer in self.writers if writer!=subscription]
+        self.update()
+
+    ##\brief Count reads and writes in the reads and writes members
+    # \param enable Set to false to stop counting
+    #
+    # Counting needs no callbacks, and reads answered from the response cache
+    # are counted as well.
+    def enableCounters(self,enable=True):
+        self.counting=enable
+        self.update()
+
+    ##\brief Choose between the plain and the observed read path
+    def update(self):
+        self.observed=self.counting or len(self.rcallbacks)>0 or len(self.readers)>0
+
+    ##\brief Notify write subscribers
+    # \param changes List of (address,values) tuples of the ranges written
+    def notifyWrites(self,changes):
+        if self.counting: self.writes+=1
+        for subscription in self.writers:
+            overlapping=[change for change in changes if subscription.overlaps(change[0],len(change[1]) if isinstance(change[1],list) else 1)]
+            if len(overlapping): subscription.callback(self.datablock,overlapping)
+
+    ##\brief Context manager to apply several writes atomically
+    #
+    # Readers never observe a state where only some of the writes made inside
+    # the context are applied. Contexts may be nested.
+    @contextlib.contextmanager
+    def atomic(self):
+        with self.lock:
+            self.depth+=1
+            if self.depth==1:
+                self.writer=threading.get_ident()
+                self.begin()
+            try:
+                yield self
+            finally:
+                if self.depth==1:
+                    self.end()
+                    self.writer=None
+                self.depth-=1
+
+    ##\brief Called when the outermost atomic context is entered, marks the values as being written to
+    def begin(self):
+        self.sequence+=1
+
+    ##\brief Called when the outermost atomic context is left, publishes the changes
+    def end(self):
+        self.sequence+=1
+
+    ##\brief Read a consistent snapshot of raw register values, bypassing callbacks
+    # \param address Register address to read from
+    # \param count Number of 16-bit registers to read
+    # \return Values
+    def snapshot(self, address, count=1):
+        # Writers may read their own changes while inside an atomic context
+        if self.writer==threading.get_ident():
+            return self.load(address,count)
+        while True:
+            before=self.sequence
+            if before&1==0:
+                values=self.load(address,count)
+                if self.sequence==before: return values
+            time.sleep(0)
+
+    ##\brief Overwrites modbus registers and calls optional callback
+    # \param address Register address to write to
+    # \param value Values to write
+    def setValues(self, address, value):
+        for callback in self.wcallbacks:
+            value=callback(self.datablock,address,value)
+        with self.atomic():
+            self.store(address,value)
+            if self.cache: self.cache.invalidate(address,len(value) if isinstance(value,list) else 1)
+        if self.counting or len(self.writers): self.notifyWrites([(address,value)])
+        #self.profile['datablocks'][self.datablock][str(address)]['value']=value
+
+    ##\brief Overwrites a contiguous range of registers in one operation
+    # \param address First register address to write to
+    # \param values Values to write
+    def setRange(self, address, values):
+        self.setMany([(address,values)])
+
+    ##\brief Overwrites many registers in one atomic operation
+    # \param changes List of (address,values) tuples, or dictionary of address -> values
+    #
+    # Adjacent changes are merged into contiguous ranges. Write callbacks are called
+    # once per range, while batch callbacks are called once with all ranges.
+    def setMany(self, changes):
+        if isinstance(changes,dict): changes=changes.items()
+        ranges=[]
+        for address,values in sorted(changes,key=lambda change: change[0]):
+            if not isinstance(values,list): values=[values]
+            if len(ranges) and ranges[-1][0]+len(ranges[-1][1])==address:
+                ranges[-1][1].extend(values)
+            else:
+                ranges.append((address,list(values)))
+        if len(ranges)==0: return
+        for i in range(len(ranges)):
+            address,values=ranges[i]
+            for callback in self.wcallbacks:
+                values=callback(self.datablock,address,values)
+            ranges[i]=(address,values)
+        with self.atomic():
+            for address,values in ranges:
+                self.store(address,values)
+                if self.cache: self.cache.invalidate(address,len(values))
+        if self.counting or len(self.writers): self.notifyWrites(ranges)
+
+    ##\brief Get modbus register contents
+    # \param address Register address to read from
+    # \param count Number of 16-bit registers to read
+    # \return Values
+    def getValues(self, address, count=1):
+        if not self.observed: return self.snapshot(address,count)
+        if self.counting: self.reads+=1
+        values = self.snapshot(address,count)
+        for callback in self.rcallbacks:
+            values=callback(self.datablock,address,values)
+        for subscription in self.readers:
+            if subscription.overlaps(address,count): subscription.callback(self.datablock,address,values)
+        #self.profile['datablocks'][self.datablock][str(address)]['value']=values
+        return values
+
+    ##\brief Cache encoded read responses of this datablock
+    # \param limit Maximum number of cached address ranges
+    def enableCache(self,limit=1024):
+        self.cache=ResponseCache(limit)
+
+    ##\brief Get a cached encoded read response
+    # \param address First register address of range
+    # \param count Number of registers in range
+    # \return Encoded response, or None if not cached
+    #
+    # Read callbacks may change the values, and read subscribers need them, so
+    # nothing is cached for datablocks having any. Hits are counted as reads.
+    def getEncoded(self, address, count):
+        if not self.cache or len(self.rcallbacks) or len(self.readers): return None
+        data=self.cache.get(address,count,self.getStamp())
+        if data and self.counting: self.reads+=1
+        return data
+
+    ##\brief Get the state to pass to putEncoded(), taken before reading the values to encode
+    # \return Opaque token
+    def getToken(self):
+        return (self.sequence,self.getStamp())
+
+    ##\brief Cache an encoded read response
+    # \param address First register address of range
+    # \param count Number of registers in range
+    # \param data Encoded response
+    # \param token Token from getToken(), taken before the values were read
+    #
+    # The response is dropped if any write started since the token was taken, as
+    # its values may then already be outdated.
+    def putEncoded(self, address, count, data, token):
+        if not self.cache or len(self.rcallbacks) or len(self.readers): return
+        with self.lock:
+            if token[0]&1==0 and token[1]&1==0 and token==self.getToken():
+                self.cache.put(address,count,data,token[1])
+
+    ##\brief Get the stamp cached responses are valid for
+    # \return Stamp, which is constant as writes invalidate the ranges they cover
+    def getStamp(self):
+        return 0
+
+    ##\brief Validate modbus register contents
+    # \param address Register address to validate
+    # \param count Number of 16-bit registers to validate
+    def validate(self, address, count=1):
+        return self.index.contains(address,count)
+
+    ##\brief Read raw register values from storage, bypassing callbacks
+    # \param address Register address to read from
+    # \param count Number of 16-bit registers to read
+    # \return Values
+    def load(self, address, count=1):
+        return ModbusSparseDataBlock.getValues(self,address,count)
+
+    ##\brief Write raw register values to storage, bypassing callbacks
+    # \param address Register address to write to
+    # \param value Values to write
+    def store(self, address, value):
+        ModbusSparseDataBlock.setValues(self,address,value)
+
+##\class ImageLock
+# \brief Serializes writers of a SharedImage
+#
+# Writers in the same process are serialized with the given lock. For memory
+# mapped files, writers in other processes are also excluded with an advisory
+# lock on the file where the platform supports it.
+class ImageLock():
+    ##\brief Initializes lock
+    # \param lock Lock shared by all local writers (Eg. a multiprocessing.Lock)
+    # \param fd Optional file descriptor to lock across processes
+    def __init__(self,lock=None,fd=None):
+        self.lock=lock if lock else threading.Lock()
+        self.fd=fd if fcntl else None
+
+    ##\brief Acquire lock
+    def __enter__(self):
+        self.lock.acquire()
+        if self.fd!=None: fcntl.flock(self.fd,fcntl.LOCK_EX)
+
+    ##\brief Release lock
+    def __exit__(self,*args):
+        if self.fd!=None: fcntl.flock(self.fd,fcntl.LOCK_UN)
+        self.lock.release()
+
+##\class SharedImage
+# \brief Register image in shared memory, accessible from several processes
+#
+# The image lives either in a named shared memory segment or in a memory mapped
+# file, so simulators and test harnesses on the same host can read and change
+# the registers of a running server without going through MODBUS. The layout is:
+#
+#   Offset  Size      Field
+#   0       4         Magic 'MBTI'
+#   4       2         Layout version (1)
+#   6       2         Number of datablocks (4)
+#   8       4         Words per datablock (65536)
+#   12      4         Header size in bytes (64)
+#   16      4x8       Sequence counter per datablock, unsigned 64-bit
+#   48      16        Reserved
+#   64      4x131072  Register words per datablock, unsigned 16-bit indexed by address
+#
+# Datablocks are laid out in the order di, co, hr, ir. All fields are in native
+# byte order. Register addresses are the server side addresses, ie. the ones
+# used as keys in the profile.
+#
+# The sequence counter of a datablock is odd while a write is in progress. To
+# read a consistent set of words, read the counter, read the words, and read the
+# counter again. If it is odd or has changed, retry. Writers increment the counter
+# before and after changing the words, and must hold the image lock while doing so.
+class SharedImage():
+    ## Datablocks in the order they are laid out
+    datablocks=['di','co','hr','ir']
+
+    ## Number of words per datablock
+    words=65536
+
+    ## Size of header in bytes
+    headersize=64
+
+    ## Header layout up to the sequence counters
+    header=struct.Struct('=4sHHII')
+
+    ##\brief Creates or attaches to a shared image
+    # \param name Name of shared memory segment to attach to, or None to create one
+    # \param filename Memory mapped file to use instead of a shared memory segment
+    # \param create Set to true to create the image and load initial values into it
+    # \param lock Lock shared by all writers in this process tree
+    def __init__(self,name=None,filename=None,create=False,lock=None):
+        size=SharedImage.headersize+len(SharedImage.datablocks)*SharedImage.words*2
+        self.owner=create
+        self.filename=filename
+        self.shm=None
+        self.fd=None
+        self.mmap=None
+        if filename:
+            self.fd=open(filename,'w+b' if create else 'r+b')
+            if create: self.fd.truncate(size)
+            self.mmap=mmap.mmap(self.fd.fileno(),size)
+            buffer=memoryview(self.mmap)
+            self.name=filename
+            self.lock=ImageLock(lock,self.fd.fileno())
+        else:
+            self.shm=shared_memory.SharedMemory(name=name,create=create,size=size)
+            buffer=self.shm.buf
+            self.name=self.shm.name
+            self.lock=ImageLock(lock)
+
+        # Check or write header
+        if create:
+            buffer[:SharedImage.header.size]=SharedImage.header.pack(b'MBTI',1,len(SharedImage.datablocks),SharedImage.words,SharedImage.headersize)
+        else:
+            magic,version,count,words,headersize=SharedImage.header.unpack(bytes(buffer[:SharedImage.header.size]))
+            if magic!=b'MBTI' or version!=1 or words!=SharedImage.words or headersize!=SharedImage.headersize:
+                buffer.release()
+                self.close()
+                raise Exception('Incompatible register image: '+str(self.name))
+
+        # Map counters and words
+        self.buffer=buffer
+        self.sequence=buffer[16:16+8*len(SharedImage.datablocks)].cast('Q')
+        self.words=buffer[SharedImage.headersize:].cast('H')
+        self.views=[self.sequence,self.words]
+        self.blocks={}
+        for i in range(len(SharedImage.datablocks)):
+            view=self.words[i*SharedImage.words:(i+1)*SharedImage.words]
+            self.blocks[SharedImage.datablocks[i]]=(i,view)
+            self.views.append(view)
+
+    ##\brief Get the words of a datablock
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \return Memoryview of unsigned 16-bit words indexed by address
+    #
+    # Writing directly to the view bypasses the sequence counter. The view is
+    # invalidated when the image is closed.
+    def getBlock(self,datablock):
+        return self.blocks[datablock][1]
+
+    ##\brief Read a consistent set of words
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First address to read
+    # \param count Number of words to read
+    # \return List of words
+    def read(self,datablock,address,count=1):
+        index,words=self.blocks[datablock]
+        sequence=self.sequence
+        while True:
+            before=sequence[index]
+            if before&1==0:
+                values=words[address:address+count].tolist()
+                if sequence[index]==before: return values
+            time.sleep(0)
+
+    ##\brief Write a set of words
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First address to write
+    # \param values List of words to write
+    def write(self,datablock,address,values):
+        self.begin(datablock)
+        try:
+            self.assign(datablock,address,values)
+        finally:
+            self.end(datablock)
+
+    ##\brief Start writing to a datablock, taking the lock and marking it as in progress
+    # \param datablock Name of datablock (di, co, hr or ir)
+    def begin(self,datablock):
+        self.lock.__enter__()
+        self.sequence[self.blocks[datablock][0]]+=1
+
+    ##\brief Finish writing to a datablock, publishing the changes and releasing the lock
+    # \param datablock Name of datablock (di, co, hr or ir)
+    def end(self,datablock):
+        self.sequence[self.blocks[datablock][0]]+=1
+        self.lock.__exit__()
+
+    ##\brief Read words without checking the sequence counter, only valid between begin() and end()
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First address to read
+    # \param count Number of words to read
+    # \return List of words
+    def fetch(self,datablock,address,count=1):
+        words=self.blocks[datablock][1]
+        return words[address:address+count].tolist()
+
+    ##\brief Change words without locking, only valid between begin() and end()
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First address to write
+    # \param values List of words to write
+    def assign(self,datablock,address,values):
+        words=self.blocks[datablock][1]
+        words[address:address+len(values)]=array.array('H',values)
+
+    ##\brief Detach from image, and remove shared memory segments we created
+    def close(self):
+        for view in getattr(self,'views',[]): view.release()
+        self.views=[]
+        if hasattr(self,'buffer'): self.buffer.release()
+        if self.shm:
+            if self.owner: self.shm.unlink()
+            self.shm.close()
+        if self.mmap: self.mmap.close()
+        if self.fd: self.fd.close()
+
+##\class SharedDataBlock
+# \brief DataBlock storing its values in a SharedImage
+#
+# Register layout and validation is loaded from the profile in every process,
+# while the values themselves live in shared memory so writes are visible to
+# all processes attached to the image.
+class SharedDataBlock(DataBlock):
+    ##\brief Initiates data storage and loads profile
+    # \param profile Modbus registers to load
+    # \param datablock Modbus datablock to load
+    # \param strict Set to true to only respond to defined address (Enable IllegalAddress exceptions)
+    # \param image SharedImage to store values in. The owner loads initial values from the profile.
+    def __init__(self, profile, datablock, strict, image):
+        super().__init__(profile,datablock,strict)
+        self.image=image
+        if image.owner:
+            for address in self.values:
+                image.write(datablock,address,[int(self.values[address])])
+
+    ##\brief Read raw register values from shared memory
+    # \param address Register address to read from
+    # \param count Number of 16-bit registers to read
+    # \return Values
+    def load(self, address, count=1):
+        if self.depth and self.writer==threading.get_ident():
+            return self.image.fetch(self.datablock,address,count)
+        return self.image.read(self.datablock,address,count)
+
+    ##\brief Write raw register values to shared memory
+    # \param address Register address to write to
+    # \param value Values to write
+    def store(self, address, value):
+        if not isinstance(value,list): value=[value]
+        if self.depth:
+            self.image.assign(self.datablock,address,value)
+        else:
+            self.image.write(self.datablock,address,value)
+
+    ##\brief Replace all stored words, only valid inside an atomic context
+    # \param values Dictionary of address to word
+    def replace(self,values):
+        removed=[address for address in self.values if not address in values]
+        super().replace(values)
+        for address in removed:
+            self.image.assign(self.datablock,address,[0])
+        for address in values:
+            self.image.assign(self.datablock,address,[int(values[address])])
+
+    ##\brief Get the stamp cached responses are valid for
+    # \return Sequence counter of the datablock in the image
+    #
+    # Other processes write to the image without invalidating our cache, so any
+    # write to the datablock invalidates all cached responses.
+    def getStamp(self):
+        return self.image.sequence[self.image.blocks[self.datablock][0]]
+
+    ##\brief Read raw register values, relying on the sequence counter of the image
+    # \param address Register address to read from
+    # \param count Number of 16-bit registers to read
+    # \return Values
+    def snapshot(self, address, count=1):
+        return self.load(address,count)
+
+    ##\brief Lock the image and mark the datablock as being written to
+    def begin(self):
+        self.image.begin(self.datablock)
+
+    ##\brief Publish changes and unlock the image
+    def end(self):
+        self.image.end(self.datablock)
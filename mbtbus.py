@@ -0,0 +1,217 @@
+##\package mbtbus
+# \brief CLI bus master polling several devices on one serial line
+#
+# Vegard Fiksdal (C) 2024
+#
+# A single client owns the serial port and polls a list of devices, each with
+# its own unit id and profile. The registers of each profile are coalesced into
+# block reads, and requests are spaced by the silent interval of 3.5 characters
+# required between RTU frames (See LinkModel in timing.py). Devices are either
+# served in turn, one block at a time (roundrobin), or in order of descending
+# priority (priority).
+#
+from mbtclient import *
+
+##\class BusDevice
+# \brief A device on the bus with its profile and read plan
+class BusDevice():
+    ##\brief Loads profile and plans block reads
+    # \param args Parsed commandline arguments
+    # \param deviceid Unit id of device
+    # \param profile Filename of profile
+    # \param priority Priority of device, higher is served first
+    # \param maxgap Maximum number of undefined words to read across
+    def __init__(self,args,deviceid,profile,priority=1,maxgap=0):
+        self.deviceid=deviceid
+        self.priority=priority
+        self.profile=Profiles.loadProfile(args,profile)
+        self.elapsed=0
+        self.wiretime=0
+        self.requests=0
+        self.plan=[]
+        for datablock in self.profile['datablocks']:
+            for block in ReadPlanner.plan(self.profile['datablocks'][datablock],datablock,maxgap):
+                self.plan.append((datablock,block))
+
+    ##\brief Get the poll plan of the device for the link model
+    # \return List of (datablock,count,write) tuples
+    def getPollPlan(self):
+        return [(datablock,block[1],False) for datablock,block in self.plan]
+
+    ##\brief Get measured turnaround of the device, ie. response time not spent on the wire
+    # \return Average turnaround in seconds per request, and resets the measurements
+    def getTurnaround(self):
+        turnaround=(self.elapsed-self.wiretime)/self.requests if self.requests else 0
+        self.elapsed,self.wiretime,self.requests=0,0,0
+        return turnaround
+
+    ##\brief Parse a device specification from the commandline
+    # \param args Parsed commandline arguments
+    # \param spec Device specification as UNIT:PROFILE[:PRIORITY]
+    # \param maxgap Maximum number of undefined words to read across
+    # \return BusDevice
+    #
+    # The profile may contain colons (Eg. Windows drive letters), a trailing
+    # number after the last colon is taken as the priority.
+    def parse(args,spec,maxgap=0):
+        fields=spec.split(':',1)
+        if len(fields)<2 or not fields[0].strip().isdigit() or not len(fields[1]): raise Exception('Invalid device specification: '+spec)
+        profile,priority=fields[1],1
+        tail=profile.rsplit(':',1)
+        if len(tail)==2 and tail[1].strip().isdigit(): profile,priority=tail[0],int(tail[1])
+        return BusDevice(args,int(fields[0]),profile,priority,maxgap)
+
+##\class BusMaster
+# \brief Polls all devices on a bus through one client
+class BusMaster():
+    ##\brief Initializes bus master
+    # \param args Parsed commandline arguments
+    # \param devices List of BusDevice objects
+    # \param schedule Scheduling policy, roundrobin or priority
+    def __init__(self,args,devices,schedule='roundrobin'):
+        self.args=args
+        self.devices=devices
+        self.schedule=schedule
+        self.offset=args.offset
+        self.client=ClientObject.createClient(args)
+        self.link=LinkModel(args)
+        self.timing=AdaptiveTimeout(args) if args.adaptive else None
+        self.requests=0
+        self.errors=0
+        self.last=0
+
+    ##\brief Connect to the bus
+    # \return True if succsessfully connected
+    def connect(self):
+        if self.client:
+            self.client.connect()
+            if not self.client.connected: self.client=None
+        return (self.client!=None)
+
+    ##\brief Order the block reads of one cycle according to the scheduling policy
+    # \return List of (device,datablock,block) tuples
+    def getRequests(self):
+        requests=[]
+        if self.schedule=='priority':
+            for device in sorted(self.devices,key=lambda device: -device.priority):
+                for datablock,block in device.plan:
+                    requests.append((device,datablock,block))
+        else:
+            for i in range(max([len(device.plan) for device in self.devices]+[0])):
+                for device in self.devices:
+                    if i<len(device.plan):
+                        requests.append((device,)+device.plan[i])
+        return requests
+
+    ##\brief Read a block from a device, respecting the silent interval
+    # \param device BusDevice to read from
+    # \param datablock Datablock to read from (di,co,hr or ir)
+    # \param block Block as returned by ReadPlanner.plan()
+    # \return List of register words or bits
+    def read(self,device,datablock,block):
+        if self.timing and self.timing.isSuspect(device.deviceid):
+            raise SuspectDeviceException('Skipping request to suspect device '+str(device.deviceid))
+        address,count=block[0]+self.offset,block[1]
+        if datablock=='di': request=lambda: self.client.read_discrete_inputs(address,count,device.deviceid)
+        if datablock=='co': request=lambda: self.client.read_coils(address,count,device.deviceid)
+        if datablock=='hr': request=lambda: self.client.read_holding_registers(address,count,device.deviceid)
+        if datablock=='ir': request=lambda: self.client.read_input_registers(address,count,device.deviceid)
+        wiretime=self.link.getTransactionTime(datablock,count)
+        delay=self.last+self.link.gap-time.monotonic()
+        if delay>0: time.sleep(delay)
+        started=time.monotonic()
+        try:
+            if self.timing: response=self.timing.execute(self.client,device.deviceid,wiretime,request)
+            else: response=request()
+        finally:
+            self.last=time.monotonic()
+            device.elapsed+=self.last-started
+            device.wiretime+=wiretime
+            device.requests+=1
+        if response.isError() or isinstance(response, ExceptionResponse):
+            raise ModbusException(str(response))
+        if datablock=='di' or datablock=='co': return response.bits
+        return response.registers
+
+    ##\brief Predict the wire time of a polling cycle
+    # \return Time in seconds
+    def predictCycle(self):
+        return sum(self.link.predictCycle(device.getPollPlan()) for device in self.devices)
+
+    ##\brief Run one polling cycle over all devices
+    # \return Dictionary of unit id to datablocks and values
+    def poll(self):
+        output={}
+        skipped=set()
+        for device,datablock,block in self.getRequests():
+            if device.deviceid in skipped: continue
+            self.requests+=1
+            try:
+                values=self.read(device,datablock,block)
+            except SuspectDeviceException as exc:
+                logging.debug(str(exc))
+                skipped.add(device.deviceid)
+                continue
+            except ModbusException as exc:
+                logging.warning('Device '+str(device.deviceid)+': '+str(exc))
+                self.errors+=1
+                continue
+            registers=device.profile['datablocks'][datablock]
+            values=ReadPlanner.decode(registers,block,values)
+            if not device.deviceid in output: output[device.deviceid]={}
+            if not datablock in output[device.deviceid]: output[device.deviceid][datablock]={}
+            for address in values:
+                output[device.deviceid][datablock][address]={'name':registers[address]['dsc'],'value':values[address]}
+        return output
+
+    ##\brief Close connection to bus
+    def close(self):
+        if self.client: self.client.close()
+
+if __name__ == "__main__":
+    # Parse command line options
+    print(App.getAbout('bus','CLI bus master for MODBUS Testing')+'\n')
+    parser=argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-U','--unit',help='Device to poll as UNIT:PROFILE[:PRIORITY], may be repeated',dest='units',action='append',default=[])
+    parser.add_argument('-Y','--schedule',choices=['roundrobin','priority'],help='Scheduling policy, default is roundrobin',dest='schedule',default='roundrobin',type=str)
+    parser.add_argument('-G','--maxgap',help='Maximum number of undefined registers to read across, default is 0',dest='maxgap',default=0,type=int)
+    parser.add_argument('-N','--cycles',help='Number of polling cycles, 0 to poll until interrupted, default is 1',dest='cycles',default=1,type=int)
+    parser.add_argument('-I','--interval',help='Minimum time between polling cycles in seconds, default is 0',dest='interval',default=0,type=float)
+    args=Loader(parents=[parser],required=False).clientargs
+    print(App.reportConfig(args))
+
+    # Load devices
+    if len(args.units)==0:
+        if not len(args.profile):
+            print('No devices specified, use --unit UNIT:PROFILE[:PRIORITY] or --profile')
+            sys.exit(1)
+        args.units.append(str(args.deviceid)+':'+args.profile)
+    try:
+        devices=[BusDevice.parse(args,spec,args.maxgap) for spec in args.units]
+    except Exception as error:
+        print(str(error)+', use --unit UNIT:PROFILE[:PRIORITY] or --profile')
+        sys.exit(1)
+    bus=BusMaster(args,devices,args.schedule)
+    if bus.link.chartime:
+        requests=sum(len(device.plan) for device in devices)
+        print('Predicted cycle time of %d requests: %.3fms\n' % (requests,round(bus.predictCycle()*1000,3)))
+
+    # Run polling cycles
+    if bus.connect():
+        cycle=0
+        try:
+            while args.cycles==0 or cycle<args.cycles:
+                started=time.monotonic()
+                output=bus.poll()
+                duration=time.monotonic()-started
+                cycle+=1
+                print(json.dumps(output,indent=4))
+                logging.info('Cycle completed in %.3fms' % round(duration*1000,3))
+                for device in devices:
+                    if device.requests: logging.info('Device %d average turnaround %.3fms per request' % (device.deviceid,round(device.getTurnaround()*1000,3)))
+                if args.interval>duration and (args.cycles==0 or cycle<args.cycles):
+                    time.sleep(args.interval-duration)
+        except KeyboardInterrupt:
+            pass
+        logging.info('Sent '+str(bus.requests)+' requests with '+str(bus.errors)+' errors')
+        bus.close()
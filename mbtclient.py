@@ -8,8 +8,9 @@ from pymodbus import (
     ExceptionResponse,
     ModbusException,
 )
-import threading,time
+import threading,time,csv,signal
 from common import *
+from timing import *
 
 ##\class AsyncClientObject
 # \brief Asyncronous client object
@@ -126,10 +127,20 @@ class ClientObject():
 
         # Load client object
         self.args=args
-        self.client=None
-        if args.comm=='tcp':    self.client = ModbusClient.ModbusTcpClient(host=args.host,port=args.port,framer=args.framer,timeout=args.timeout,retries=3)
-        if args.comm=='udp':    self.client = ModbusClient.ModbusUdpClient(host=args.host,port=args.port,framer=args.framer,timeout=args.timeout,retries=3)
-        if args.comm=='serial': self.client = ModbusClient.ModbusSerialClient(port=args.serial,framer=args.framer,baudrate=args.baudrate,bytesize=args.bytesize,parity=args.parity,timeout=args.timeout,strict=True,stopbits=1,retries=3,handle_local_echo=False)
+        self.client=ClientObject.createClient(args)
+        self.link=LinkModel(args)
+        self.timing=AdaptiveTimeout(args) if args.adaptive else None
+
+    ##\brief Create a pymodbus client
+    # \param args Parsed commandline arguments
+    # \param retries Number of times a request is retried when the device does not respond
+    # \return Unconnected pymodbus client, or None for unknown interfaces
+    def createClient(args,retries=3):
+        client=None
+        if args.comm=='tcp':    client = ModbusClient.ModbusTcpClient(host=args.host,port=args.port,framer=args.framer,timeout=args.timeout,retries=retries)
+        if args.comm=='udp':    client = ModbusClient.ModbusUdpClient(host=args.host,port=args.port,framer=args.framer,timeout=args.timeout,retries=retries)
+        if args.comm=='serial': client = ModbusClient.ModbusSerialClient(port=args.serial,framer=args.framer,baudrate=args.baudrate,bytesize=args.bytesize,parity=args.parity,timeout=args.timeout,strict=True,stopbits=1,retries=retries,handle_local_echo=False)
+        return client
 
     ##\brief Connect to the server
     # \return True if succsessfully connected
@@ -139,6 +150,14 @@ class ClientObject():
             if not self.client.connected: self.client=None
         return (self.client!=None)
 
+    ##\brief Execute a request, with adaptive timeouts if enabled
+    # \param wiretime Time the request and response take on the wire, in seconds
+    # \param request Function executing the request and returning the response
+    # \return Response from the server
+    def execute(self,wiretime,request):
+        if self.timing: return self.timing.execute(self.client,self.deviceid,wiretime,request)
+        return request()
+
     ##\brief Read registers from the server
     # \param datablock Datablock to read from (di,co,hr or ir)
     # \param address Register address to read from
@@ -150,12 +169,16 @@ class ClientObject():
             registerdata=self.profile['datablocks'][datablock][str(address)]
             registeraddress=int(address)+self.offset
             count=Registers.registersPerValue(registerdata)
+            wiretime=self.link.getTransactionTime(datablock,count)
 
             # Execute request
-            if datablock=='di': response = self.client.read_discrete_inputs(registeraddress,count,self.deviceid)
-            if datablock=='co': response = self.client.read_coils(registeraddress,count,self.deviceid)
-            if datablock=='hr': response = self.client.read_holding_registers(registeraddress,count,self.deviceid)
-            if datablock=='ir': response = self.client.read_input_registers(registeraddress,count,self.deviceid)
+            if datablock=='di': response = self.execute(wiretime,lambda: self.client.read_discrete_inputs(registeraddress,count,self.deviceid))
+            if datablock=='co': response = self.execute(wiretime,lambda: self.client.read_coils(registeraddress,count,self.deviceid))
+            if datablock=='hr': response = self.execute(wiretime,lambda: self.client.read_holding_registers(registeraddress,count,self.deviceid))
+            if datablock=='ir': response = self.execute(wiretime,lambda: self.client.read_input_registers(registeraddress,count,self.deviceid))
+        except SuspectDeviceException as exc:
+            logging.debug(str(exc))
+            return None
         except ModbusException as exc:
             logging.error('ModbusException: '+str(exc))
             return None
@@ -166,6 +189,32 @@ class ClientObject():
         if datablock=='hr' or datablock=='ir': return Registers.decodeRegister(registerdata,response.registers)
         return None
 
+    ##\brief Read a block of raw registers or bits from the server
+    # \param datablock Datablock to read from (di,co,hr or ir)
+    # \param address First register address to read from
+    # \param count Number of registers or bits to read
+    # \return List of register words or bits, or None upon failure
+    def readBlock(self,datablock,address,count):
+        response=None
+        try:
+            registeraddress=int(address)+self.offset
+            wiretime=self.link.getTransactionTime(datablock,count)
+            if datablock=='di': response = self.execute(wiretime,lambda: self.client.read_discrete_inputs(registeraddress,count,self.deviceid))
+            if datablock=='co': response = self.execute(wiretime,lambda: self.client.read_coils(registeraddress,count,self.deviceid))
+            if datablock=='hr': response = self.execute(wiretime,lambda: self.client.read_holding_registers(registeraddress,count,self.deviceid))
+            if datablock=='ir': response = self.execute(wiretime,lambda: self.client.read_input_registers(registeraddress,count,self.deviceid))
+        except SuspectDeviceException as exc:
+            logging.debug(str(exc))
+            return None
+        except ModbusException as exc:
+            logging.error('ModbusException: '+str(exc))
+            return None
+        if response.isError() or isinstance(response, ExceptionResponse):
+            logging.warning(str(response))
+            return None
+        if datablock=='di' or datablock=='co': return response.bits[:count]
+        return response.registers
+
     ##\brief Write registers to the server
     # \param datablock Datablock to write to (di,co,hr or ir)
     # \param address Register address to write to
@@ -177,10 +226,14 @@ class ClientObject():
             registerdata=self.profile['datablocks'][datablock][str(address)]
             registeraddress=int(address)+self.offset
             value=Registers.encodeRegister(registerdata,value)
+            wiretime=self.link.getTransactionTime(datablock,len(value),True)
 
             # Execute request
-            if datablock=='co': response = self.client.write_coil(registeraddress,value,self.deviceid)
-            if datablock=='hr': response = self.client.write_registers(registeraddress,value,self.deviceid)
+            if datablock=='co': response = self.execute(wiretime,lambda: self.client.write_coil(registeraddress,value,self.deviceid))
+            if datablock=='hr': response = self.execute(wiretime,lambda: self.client.write_registers(registeraddress,value,self.deviceid))
+        except SuspectDeviceException as exc:
+            logging.debug(str(exc))
+            return False
         except ModbusException as exc:
             logging.error('ModbusException: '+str(exc))
             return False
@@ -192,26 +245,364 @@ class ClientObject():
             return False
         return True
 
+    ##\brief Read all registers from the server, one at a time
+    # \return Generator yielding datablock, address and value of each register read
+    def stream(self):
+        for datablock in self.profile['datablocks']:
+            for address in self.profile['datablocks'][datablock]:
+                value=self.read(datablock,address)
+                if value!=None: yield datablock,address,value
+
     ##\brief Read all registers from the server
     # \return dictionary of all read values
     def download(self):
         output={}
         output['identity']=self.profile['identity']
         output['datablocks']={}
-        for datablock in self.profile['datablocks']:
-            for address in self.profile['datablocks'][datablock]:
-                value=self.read(datablock,address)
-                if value!=None:
-                    if not datablock in output['datablocks']: output['datablocks'][datablock]={}
-                    output['datablocks'][datablock][address]={}
-                    output['datablocks'][datablock][address]['name']=self.profile['datablocks'][datablock][address]['dsc']
-                    output['datablocks'][datablock][address]['value']=value
+        for datablock,address,value in self.stream():
+            if not datablock in output['datablocks']: output['datablocks'][datablock]={}
+            output['datablocks'][datablock][address]={}
+            output['datablocks'][datablock][address]['name']=self.profile['datablocks'][datablock][address]['dsc']
+            output['datablocks'][datablock][address]['value']=value
         return output
 
     ##\brief Close connection to server
     def close(self):
         if self.client: self.client.close()
 
+##\class RequestEngine
+# \brief Executes raw MODBUS requests of any length
+#
+# Reads and writes of more registers or bits than the protocol allows in one
+# request are split into as few requests as possible. A failing request is
+# reported and the remaining requests are still executed, so large address
+# windows can be dumped in spite of holes. Addresses are protocol addresses,
+# without any offset applied.
+class RequestEngine():
+    ## Supported function codes and their names
+    functions={1:'Read Coils',2:'Read Discrete Inputs',3:'Read Holding Registers',4:'Read Input Registers',5:'Write Single Coil',6:'Write Single Register',15:'Write Multiple Coils',16:'Write Multiple Registers'}
+
+    ## Maximum number of bits or registers per request for each function code
+    limits={1:2000,2:2000,3:125,4:125,5:1,6:1,15:1968,16:123}
+
+    ##\brief Initializes engine
+    # \param client Connected synchronous pymodbus client
+    def __init__(self,client):
+        self.client=client
+        self.cancelled=False
+
+    ##\brief Split a range into requests the protocol allows
+    # \param function Function code
+    # \param address First protocol address
+    # \param count Number of registers or bits
+    # \return List of (address,count) tuples, one per request
+    def split(function,address,count):
+        limit=RequestEngine.limits[function]
+        return [(start,min(limit,address+count-start)) for start in range(address,address+count,limit)]
+
+    ##\brief Execute one request
+    # \param function Function code
+    # \param deviceid Device ID (Unit id)
+    # \param address First protocol address
+    # \param count Number of registers or bits to read
+    # \param values List of values to write
+    # \return Response from the device
+    def request(self,function,deviceid,address,count,values):
+        if function==1:  return self.client.read_coils(address,count,deviceid)
+        if function==2:  return self.client.read_discrete_inputs(address,count,deviceid)
+        if function==3:  return self.client.read_holding_registers(address,count,deviceid)
+        if function==4:  return self.client.read_input_registers(address,count,deviceid)
+        if function==5:  return self.client.write_coil(address,values[0],deviceid)
+        if function==6:  return self.client.write_register(address,values[0],deviceid)
+        if function==15: return self.client.write_coils(address,values,deviceid)
+        if function==16: return self.client.write_registers(address,values,deviceid)
+        raise Exception('Unsupported function code: '+str(function))
+
+    ##\brief Execute a read or write of any length
+    # \param function Function code (1-6, 15 or 16)
+    # \param deviceid Device ID (Unit id)
+    # \param address First protocol address
+    # \param count Number of registers or bits to read, ignored for writes
+    # \param values List of values to write, ignored for reads
+    # \param progress Optional callback function(done,total) called after each request
+    # \return Dictionary of address to value read or written, and list of (address,count,error) for failed requests
+    def execute(self,function,deviceid,address,count=1,values=None,progress=None):
+        write=function in [5,6,15,16]
+        if write: count=len(values)
+        chunks=RequestEngine.split(function,address,count)
+        self.cancelled=False
+        output={}
+        errors=[]
+        for i in range(len(chunks)):
+            if self.cancelled:
+                errors.append((chunks[i][0],sum(chunk[1] for chunk in chunks[i:]),'Cancelled'))
+                break
+            start,length=chunks[i]
+            chunk=values[start-address:start-address+length] if write else None
+            try:
+                response=self.request(function,deviceid,start,length,chunk)
+            except ModbusException as exc:
+                response=exc
+            if isinstance(response,ModbusException) or response.isError() or isinstance(response,ExceptionResponse):
+                logging.debug('Request at '+str(start)+' failed: '+str(response))
+                errors.append((start,length,str(response)))
+            else:
+                if write: data=chunk
+                elif function<3: data=response.bits[:length]
+                else: data=response.registers
+                for j in range(len(data)): output[start+j]=data[j]
+            if progress: progress(i+1,len(chunks))
+        return output,errors
+
+    ##\brief Stop an ongoing execute() after the current request
+    def cancel(self):
+        self.cancelled=True
+
+    ##\brief Parse a request from the commandline
+    # \param spec Request as FC:ADDRESS:COUNT for reads, or FC:ADDRESS:VALUE[,VALUE...] for writes
+    # \return Tuple of function code, address, count and list of values
+    def parseRequest(spec):
+        fields=spec.split(':')
+        function=int(fields[0])
+        if not function in RequestEngine.functions or len(fields)<2 or len(fields)>3: raise Exception('Invalid request: '+spec)
+        address=int(fields[1],0)
+        if function in [5,6,15,16]:
+            if len(fields)<3: raise Exception('No values to write: '+spec)
+            values=[int(value,0) for value in fields[2].split(',')]
+            if function in [5,15]: values=[value!=0 for value in values]
+            return function,address,len(values),values
+        return function,address,int(fields[2]) if len(fields)==3 else 1,None
+
+
+##\class StreamWriter
+# \brief Writes register values as they arrive, one record per value
+#
+# Records are written as newline delimited JSON objects (ndjson) or CSV rows
+# with a header (csv), with the fields time (Seconds since epoch), datablock,
+# address, name and value. Output is flushed at most flushinterval seconds
+# after a record is written, by the next write or else by a timer, so readers at
+# the other end of a pipe see values with little delay while writes are still
+# buffered, also when the device stops responding halfway through a cycle.
+class StreamWriter():
+    ## Fields of each record
+    fields=['time','datablock','address','name','value']
+
+    ##\brief Initializes writer
+    # \param fd File object to write to
+    # \param profile Loaded profile to look up register names in
+    # \param format Output format, ndjson or csv
+    # \param flushinterval Maximum time in seconds between writing a record and flushing it
+    def __init__(self,fd,profile,format='ndjson',flushinterval=1.0):
+        self.fd=fd
+        self.profile=profile
+        self.format=format
+        self.flushinterval=flushinterval
+        self.flushed=time.monotonic()
+        self.timer=None
+        self.lock=threading.RLock()
+        self.count=0
+        self.csv=None
+        if format=='csv':
+            self.csv=csv.writer(fd)
+            self.csv.writerow(StreamWriter.fields)
+
+    ##\brief Write a register value
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address Register address
+    # \param value Decoded value
+    def writeValue(self,datablock,address,value):
+        name=self.profile['datablocks'][datablock][str(address)]['dsc']
+        timestamp=round(time.time(),3)
+        with self.lock:
+            if self.csv:
+                self.csv.writerow([timestamp,datablock,address,name,value])
+            else:
+                self.fd.write(json.dumps({'time':timestamp,'datablock':datablock,'address':str(address),'name':name,'value':value})+'\n')
+            self.count+=1
+            if time.monotonic()-self.flushed>=self.flushinterval:
+                self.flush()
+            elif not self.timer:
+                self.timer=threading.Timer(self.flushinterval,self.flushPending)
+                self.timer.daemon=True
+                self.timer.start()
+
+    ##\brief Timer method flushing records not flushed meanwhile
+    def flushPending(self):
+        with self.lock:
+            if self.timer: self.flush()
+
+    ##\brief Flush buffered records
+    def flush(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer=None
+            self.fd.flush()
+            self.flushed=time.monotonic()
+
+    ##\brief Flush and close output, unless it is stdout
+    def close(self):
+        self.flush()
+        if self.fd!=sys.stdout: self.fd.close()
+
+    ##\brief Open an output for a sink specification
+    # \param spec stdout, file:PATH or udp:HOST:PORT
+    # \return File-like object
+    def openSink(spec):
+        fields=spec.split(':')
+        if fields[0]=='stdout': return sys.stdout
+        if fields[0]=='file' and len(fields)>1: return open(spec[5:],'a',newline='')
+        if fields[0]=='udp' and len(fields)==3: return DatagramSink(fields[1],int(fields[2]))
+        raise Exception('Invalid sink: '+spec)
+
+##\class DatagramSink
+# \brief File-like output sending each write as a UDP datagram
+#
+# StreamWriter writes one record per call, so each datagram holds one value.
+# Datagrams that can not be sent are dropped, as a collector that is down
+# must not stall polling.
+class DatagramSink():
+    ##\brief Initializes sink
+    # \param host Host to send to
+    # \param port UDP port to send to
+    def __init__(self,host,port):
+        self.address=(host,port)
+        self.socket=socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.dropped=0
+
+    ##\brief Send a record
+    # \param text Record to send
+    def write(self,text):
+        try:
+            self.socket.sendto(text.encode('utf-8'),self.address)
+        except OSError:
+            self.dropped+=1
+
+    ##\brief Nothing to flush for datagrams
+    def flush(self):
+        pass
+
+    ##\brief Close socket
+    def close(self):
+        self.socket.close()
+
+##\class ClientDaemon
+# \brief Polls a device headless with ClientWorker, streaming values to sinks
+#
+# Polling runs until stop() is called, which the CLI does on SIGTERM and SIGINT.
+# Running cycles are then finished and all sinks flushed before returning.
+# Cycle statistics are logged at a fixed interval and when stopping.
+class ClientDaemon():
+    ##\brief Initializes daemon
+    # \param client Connected ClientObject
+    # \param sinks List of sink specifications (See StreamWriter.openSink())
+    # \param format Output format, ndjson or csv
+    # \param interval Seconds between polling cycles, 0 to poll continuously
+    # \param stats Seconds between logging cycle statistics, 0 to only log them when stopping
+    def __init__(self,client,sinks,format='ndjson',interval=0,stats=0):
+        self.client=client
+        self.interval=interval
+        self.stats=stats
+        self.writers=[StreamWriter(StreamWriter.openSink(spec),client.profile,format) for spec in sinks]
+        self.worker=ClientWorker(client)
+        self.worker.addReadCallback(self.onRead)
+        self.worker.addCompletedCallback(self.onCompleted)
+        self.event=threading.Event()
+        self.cycles=0
+        self.values=0
+        self.overruns=0
+        self.total=0
+        self.minimum=None
+        self.maximum=0
+
+    ##\brief Worker callback writing a value to all sinks
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address Register address
+    # \param value Decoded value
+    def onRead(self,datablock,address,value):
+        self.values+=1
+        for writer in self.writers: writer.writeValue(datablock,address,value)
+
+    ##\brief Worker callback updating statistics and flushing sinks after each cycle
+    def onCompleted(self):
+        duration=self.worker.cycletime
+        self.cycles+=1
+        self.total+=duration
+        self.minimum=duration if self.minimum==None else min(self.minimum,duration)
+        self.maximum=max(self.maximum,duration)
+        if self.interval and duration>self.interval: self.overruns+=1
+        for writer in self.writers: writer.flush()
+
+    ##\brief Get cycle statistics
+    # \return Dictionary of cycle count, overruns, cycle times in milliseconds, reads, failures and values streamed
+    def getStatistics(self):
+        return {
+            'cycles':self.cycles,
+            'overruns':self.overruns,
+            'min':round((self.minimum or 0)*1000,3),
+            'avg':round(self.total/self.cycles*1000,3) if self.cycles else 0,
+            'max':round(self.maximum*1000,3),
+            'reads':self.worker.rcount,
+            'failures':self.worker.ecount,
+            'values':self.values,
+        }
+
+    ##\brief Poll until stopped
+    def run(self):
+        self.worker.start()
+        self.worker.setInterval(self.interval)
+        while not self.event.wait(self.stats if self.stats>0 else None):
+            logging.info('Statistics: '+json.dumps(self.getStatistics()))
+        self.worker.close()
+        for writer in self.writers: writer.close()
+        logging.info('Statistics: '+json.dumps(self.getStatistics()))
+
+    ##\brief Stop polling, safe to call from signal handlers
+    def stop(self):
+        self.event.set()
+
+    ##\brief Create commandline options for streaming and polling
+    # \return Parent argparse parser
+    def createParser():
+        parser=argparse.ArgumentParser(add_help=False)
+        parser.add_argument('-J','--format',choices=['json','ndjson','csv'],help='Output format, ndjson and csv stream values as they are read, default is json',dest='format',default='json',type=str)
+        parser.add_argument('-O','--output',help='File to stream values to, default is stdout',dest='output',default='',type=str)
+        parser.add_argument('-I','--interval',help='Poll continuously with this many seconds between cycles, streaming values until stopped',dest='interval',default=None,type=float)
+        parser.add_argument('-K','--sink',help='Additional output when polling, as stdout, file:PATH or udp:HOST:PORT, may be repeated',dest='sinks',action='append',default=[])
+        parser.add_argument('-T','--stats',help='Seconds between logging cycle statistics when polling, default is 60',dest='stats',default=60,type=float)
+        return parser
+
+    ##\brief Check if the options ask for streamed output
+    # \param args Parsed commandline arguments
+    # \return True if values are streamed rather than printed as one document
+    def isStreaming(args):
+        return args.format!='json' or args.interval!=None
+
+    ##\brief Run the client according to the streaming and polling options
+    # \param client Connected ClientObject
+    # \param args Parsed commandline arguments
+    def runClient(client,args):
+        format='ndjson' if args.format=='json' else args.format
+        if args.interval!=None:
+            # Poll until SIGTERM or SIGINT
+            sinks=(['file:'+args.output] if len(args.output) else ['stdout'] if len(args.sinks)==0 else [])+args.sinks
+            daemon=ClientDaemon(client,sinks,format,args.interval,args.stats)
+            signal.signal(signal.SIGTERM,lambda signum,frame: daemon.stop())
+            signal.signal(signal.SIGINT,lambda signum,frame: daemon.stop())
+            daemon.run()
+        elif ClientDaemon.isStreaming(args):
+            # Stream values as they are read
+            fd=open(args.output,'w',newline='') if len(args.output) else sys.stdout
+            writer=StreamWriter(fd,client.profile,format)
+            for datablock,address,value in client.stream():
+                writer.writeValue(datablock,address,value)
+            writer.close()
+            logging.info('Wrote '+str(writer.count)+' values')
+        else:
+            output=client.download()
+            output=json.dumps(output,indent=4)
+            print(str(output))
+
 
 ##\class ClientWorker
 # \brief Manages sending and receiving messages with the client object
@@ -229,12 +620,16 @@ class ClientWorker():
         self.paused=False
         self.started=None
         self.duration=0
+        self.cycletime=0
         self.rcount=0
         self.wcount=0
+        self.ecount=0
         self.lock=threading.Lock()
+        self.iolock=threading.Lock()
         for datablock in self.client.profile['datablocks']:
             for address in self.client.profile['datablocks'][datablock]:
                 self.reglist.append([datablock,address,None])
+        self.predicted=self.client.link.predictCycle(LinkModel.getRegisterPlan(self.client.profile))
 
     ##\brief Add callback for register write
     # \param callback Callback function(datablock,register,value)
@@ -299,12 +694,22 @@ class ClientWorker():
         self.thread.start()
 
     ##\brief Pause or resume client worker
+    # \param paused True to pause
+    #
+    # When pausing, this waits for the request in flight to complete, so the
+    # caller may use the client right away.
     def setPaused(self,paused):
-        self.paused=paused
+        with self.lock:
+            self.paused=paused
+        with self.iolock:
+            pass
 
     ##\brief Background thread to read/write values
     def worker(self):
         while self.running:
+            if self.paused:
+                time.sleep(0.1)
+                continue
             with self.lock:
                 # Get timestamp
                 now=time.time()
@@ -318,8 +723,12 @@ class ClientWorker():
                     duration=now-self.started
                     if self.duration==0: self.duration=duration
                     self.duration=(self.duration*3+(duration))/4.0
+                    self.cycletime=duration
                     for callback in self.ccallbacks: callback()
                     logging.info('Cycle completed in %.3fms' % round(self.duration*1000,3))
+                    if self.predicted and len(self.reglist):
+                        turnaround=(self.duration-self.predicted)/len(self.reglist)
+                        logging.info('Predicted wire time %.3fms, average turnaround %.3fms per request' % (round(self.predicted*1000,3),round(turnaround*1000,3)))
                     self.started=None
 
                 # Check for next cycle
@@ -343,28 +752,41 @@ class ClientWorker():
                 else:
                     backlog=None
 
+                # Claim the client before setPaused() can return
+                if backlog: self.iolock.acquire()
+
             # Execute current cycle
             if backlog:
-                if backlog[2]==None:
-                    # Read register
-                    value=self.client.read(backlog[0],backlog[1])
-                    if value==None:
-                        logging.warning('Failed to read register '+str(backlog[1]))
-                    else:
-                        self.client.profile['datablocks'][backlog[0]][str(backlog[1])]['value']=value
-                        for callback in self.rcallbacks:
-                            callback(backlog[0],backlog[1],value)
-                else:
-                    # Write register
-                    if self.client.write(backlog[0],backlog[1],backlog[2]):
-                        self.client.profile['datablocks'][backlog[0]][str(backlog[1])]['value']=backlog[2]
-                        for callback in self.wcallbacks:
-                            callback(backlog[0],backlog[1],backlog[2])
-                    else:
-                        logging.warning('Failed to write register '+str(backlog[1]))
+                try:
+                    self.execute(backlog)
+                finally:
+                    self.iolock.release()
             else:
                 time.sleep(0.1)
 
+    ##\brief Execute a read or write from the backlog
+    # \param backlog Backlog entry as [datablock,address,value], with value None for reads
+    def execute(self,backlog):
+        if backlog[2]==None:
+            # Read register
+            value=self.client.read(backlog[0],backlog[1])
+            if value==None:
+                logging.warning('Failed to read register '+str(backlog[1]))
+                self.ecount+=1
+            else:
+                self.client.profile['datablocks'][backlog[0]][str(backlog[1])]['value']=value
+                for callback in self.rcallbacks:
+                    callback(backlog[0],backlog[1],value)
+        else:
+            # Write register
+            if self.client.write(backlog[0],backlog[1],backlog[2]):
+                self.client.profile['datablocks'][backlog[0]][str(backlog[1])]['value']=backlog[2]
+                for callback in self.wcallbacks:
+                    callback(backlog[0],backlog[1],backlog[2])
+            else:
+                logging.warning('Failed to write register '+str(backlog[1]))
+                self.ecount+=1
+
     ##\brief Read a register value from server
     # \param datablock Name of datablock (di, co, hr or ir)
     # \param address Register address to read
@@ -389,12 +811,35 @@ class ClientWorker():
 
 if __name__ == "__main__":
     # Parse command line options
-    print(App.getAbout('client','CLI client for MODBUS Testing')+'\n')
-    clientargs=Loader().clientargs
-    print(App.reportConfig(clientargs))
+    parser=argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-Q','--request',help='Execute a raw request as FC:ADDRESS:COUNT or FC:ADDRESS:VALUE[,VALUE...] instead of reading the profile',dest='request',default='',type=str)
+    clientargs=Loader(parents=[parser,ClientDaemon.createParser()],required=False).clientargs
+
+    # Keep stdout clean for streamed values
+    if ClientDaemon.isStreaming(clientargs) and (not len(clientargs.output) or 'stdout' in clientargs.sinks): LogHandler.fd=sys.stderr
+    print(App.getAbout('client','CLI client for MODBUS Testing')+'\n',file=LogHandler.fd)
+    print(App.reportConfig(clientargs),file=LogHandler.fd)
+    if len(clientargs.request):
+        # Execute raw request of any length
+        function,address,count,values=RequestEngine.parseRequest(clientargs.request)
+        client=ClientObject.createClient(clientargs)
+        client.connect()
+        if client.connected:
+            engine=RequestEngine(client)
+            output,errors=engine.execute(function,clientargs.deviceid,address,count,values,lambda done,total: logging.debug('Executed request %d of %d' % (done,total)))
+            for start,length,error in errors: logging.error('Request for %d items at %d failed: %s' % (length,start,error))
+            print(json.dumps(output,indent=4))
+            client.close()
+        else:
+            logging.error('Could not connect to server')
+        sys.exit()
+    if not len(clientargs.profile):
+        print('Please set a profile to use (See -p or --profile parameter)')
+        sys.exit()
     client=ClientObject(clientargs)
+    if client.link.chartime:
+        plan=LinkModel.getRegisterPlan(client.profile)
+        print('Predicted cycle time of %d requests: %.3fms\n' % (len(plan),round(client.link.predictCycle(plan)*1000,3)),file=LogHandler.fd)
     if client.connect():
-        output=client.download()
-        output=json.dumps(output,indent=4)
-        print(str(output))
+        ClientDaemon.runClient(client,clientargs)
         client.close()
@@ -0,0 +1,284 @@
+##\package mbtdump
+# \brief CLI dump and diff of the full address space of a device
+#
+# Vegard Fiksdal (C) 2024
+#
+# A dump reads a range of addresses from every datablock with the largest block
+# reads the protocol allows, and writes the raw words to a memory mapped image
+# along with a bitmap of the addresses the device accepted. Blocks rejected by
+# the device are split in halves until the valid regions are found (See
+# RegionSearch in common.py, shared with mbtscan).
+#
+# Images are compared block by block, so unchanged parts of the address space
+# cost a single memory comparison, and only differing blocks are walked word by
+# word. An image may also be compared to the values of a profile.
+#
+from mbtclient import *
+from datastore import *
+
+##\class DumpImage
+# \brief Raw register image of a device with a validity bitmap
+#
+# The image is a memory mapped file with the layout:
+#
+#   Offset   Size      Field
+#   0        4         Magic 'MBTD'
+#   4        2         Layout version (1)
+#   6        2         Number of datablocks (4)
+#   8        4         Words per datablock (65536)
+#   12       4         Header size in bytes (64)
+#   16       8         Time of dump in seconds since epoch, double
+#   24       40        Reserved
+#   64       4x131072  Words per datablock, unsigned 16-bit indexed by protocol address
+#   524352   4x8192    Validity bitmap per datablock, bit N (LSB first) set if address N was read
+#
+# Datablocks are laid out in the order di, co, hr, ir, with coils and discrete
+# inputs stored as one word per bit. All fields are in little endian byte order.
+class DumpImage():
+    ## Datablocks in the order they are laid out
+    datablocks=['di','co','hr','ir']
+
+    ## Number of words per datablock
+    words=65536
+
+    ## Size of header in bytes
+    headersize=64
+
+    ## Number of words compared in one go when diffing
+    blocksize=512
+
+    ## Header layout
+    header=struct.Struct('<4sHHIId')
+
+    ##\brief Creates or opens an image
+    # \param filename Image file, or None for an image in memory
+    # \param create Set to true to create an empty image
+    def __init__(self,filename=None,create=False):
+        bitmap=DumpImage.words//8
+        size=DumpImage.headersize+len(DumpImage.datablocks)*(DumpImage.words*2+bitmap)
+        self.filename=filename
+        self.fd=None
+        if filename:
+            self.fd=open(filename,'w+b' if create else 'rb')
+            if create: self.fd.truncate(size)
+            self.mmap=mmap.mmap(self.fd.fileno(),size,access=mmap.ACCESS_WRITE if create else mmap.ACCESS_READ)
+        else:
+            create=True
+            self.mmap=mmap.mmap(-1,size)
+        buffer=memoryview(self.mmap)
+
+        # Check or write header
+        if create:
+            buffer[:DumpImage.header.size]=DumpImage.header.pack(b'MBTD',1,len(DumpImage.datablocks),DumpImage.words,DumpImage.headersize,time.time())
+        else:
+            magic,version,count,words,headersize,timestamp=DumpImage.header.unpack(bytes(buffer[:DumpImage.header.size]))
+            if magic!=b'MBTD' or version!=1 or words!=DumpImage.words or headersize!=DumpImage.headersize:
+                buffer.release()
+                self.close()
+                raise Exception('Incompatible dump image: '+str(filename))
+        self.timestamp=DumpImage.header.unpack(bytes(buffer[:DumpImage.header.size]))[5]
+
+        # Map words and bitmaps
+        self.buffer=buffer
+        self.views=[]
+        self.blocks={}
+        offset=DumpImage.headersize+len(DumpImage.datablocks)*DumpImage.words*2
+        for i in range(len(DumpImage.datablocks)):
+            words=buffer[DumpImage.headersize+i*DumpImage.words*2:DumpImage.headersize+(i+1)*DumpImage.words*2]
+            valid=buffer[offset+i*bitmap:offset+(i+1)*bitmap]
+            self.blocks[DumpImage.datablocks[i]]=(words,valid)
+            self.views.extend([words,valid])
+
+    ##\brief Store words read from the device and mark them as valid
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First protocol address
+    # \param values List of words or bits
+    def setValues(self,datablock,address,values):
+        words,valid=self.blocks[datablock]
+        words[address*2:(address+len(values))*2]=struct.pack('<%dH' % len(values),*[int(value) for value in values])
+        for i in range(address,address+len(values)):
+            valid[i>>3]|=1<<(i&7)
+
+    ##\brief Get stored words
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First protocol address
+    # \param count Number of words
+    # \return List of words, regardless of validity
+    def getValues(self,datablock,address,count=1):
+        return list(struct.unpack_from('<%dH' % count,self.blocks[datablock][0],address*2))
+
+    ##\brief Check if an address was read from the device
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address Protocol address
+    # \return True if valid
+    def isValid(self,datablock,address):
+        return (self.blocks[datablock][1][address>>3]>>(address&7))&1==1
+
+    ##\brief Count valid addresses of a datablock
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \return Number of valid addresses
+    def getCount(self,datablock):
+        return bin(int.from_bytes(self.blocks[datablock][1],'little')).count('1')
+
+    ##\brief Compare with another image
+    # \param other DumpImage to compare to
+    # \return Dictionary of datablock to changed, added and removed addresses
+    #
+    # Changed addresses map to the old and new word, added and removed are lists of
+    # addresses only valid in the other or in this image. Blocks with identical
+    # words and bitmaps are skipped with one comparison each.
+    def diff(self,other):
+        output={}
+        size=DumpImage.blocksize
+        for datablock in DumpImage.datablocks:
+            words,valid=self.blocks[datablock]
+            owords,ovalid=other.blocks[datablock]
+            changed,added,removed={},[],[]
+            for first in range(0,DumpImage.words,size):
+                wslice=slice(first*2,(first+size)*2)
+                vslice=slice(first>>3,(first+size)>>3)
+                if bytes(words[wslice])==bytes(owords[wslice]) and bytes(valid[vslice])==bytes(ovalid[vslice]): continue
+                if not any(valid[vslice]) and not any(ovalid[vslice]): continue
+                old=struct.unpack('<%dH' % size,words[wslice])
+                new=struct.unpack('<%dH' % size,owords[wslice])
+                for i in range(size):
+                    address=first+i
+                    a=self.isValid(datablock,address)
+                    b=other.isValid(datablock,address)
+                    if a and b:
+                        if old[i]!=new[i]: changed[address]=[old[i],new[i]]
+                    elif b: added.append(address)
+                    elif a: removed.append(address)
+            if len(changed) or len(added) or len(removed):
+                output[datablock]={'changed':changed,'added':added,'removed':removed}
+        return output
+
+    ##\brief Create an image from the values of a profile
+    # \param profile Loaded profile
+    # \param offset Offset from profile addresses to protocol addresses
+    # \return DumpImage in memory
+    def fromProfile(profile,offset=-1):
+        image=DumpImage()
+        for datablock in DumpImage.datablocks:
+            registers,keys=DataBlock.encodeProfile(profile,datablock,True)
+            for key in keys:
+                address=key+offset
+                values=registers[key]
+                if datablock=='di' or datablock=='co': values=[1 if value else 0 for value in values]
+                if address>=0 and address+len(values)<=DumpImage.words:
+                    image.setValues(datablock,address,values)
+        return image
+
+    ##\brief Write changes to disk
+    def flush(self):
+        if self.fd and self.fd.mode!='rb': self.mmap.flush()
+
+    ##\brief Release the image
+    def close(self):
+        for view in getattr(self,'views',[]): view.release()
+        self.views=[]
+        if getattr(self,'buffer',None):
+            self.buffer.release()
+            self.buffer=None
+        if self.mmap:
+            self.flush()
+            self.mmap.close()
+            self.mmap=None
+        if self.fd:
+            self.fd.close()
+            self.fd=None
+
+##\class Dumper
+# \brief Reads the address space of a device into a DumpImage
+class Dumper():
+    ##\brief Initializes dumper
+    # \param client Connected ClientObject
+    # \param image DumpImage to write to
+    def __init__(self,client,image):
+        self.client=client
+        self.image=image
+        self.engine=RequestEngine(client.client)
+        self.requests=0
+
+    ##\brief Read a block of a datablock
+    # \param datablock Datablock to read from (di,co,hr or ir)
+    # \param address First protocol address
+    # \param count Number of registers or bits
+    # \return List of values, None if rejected, or False if the datablock is not supported
+    def fetch(self,datablock,address,count):
+        function={'co':1,'di':2,'hr':3,'ir':4}[datablock]
+        self.requests+=1
+        output,errors=self.engine.execute(function,self.client.deviceid,address,count)
+        if len(errors):
+            if 'IllegalFunction' in errors[0][2]: return False
+            return None
+        return [output[i] for i in range(address,address+count)]
+
+    ##\brief Read all valid addresses of a range into the image
+    # \param datablock Datablock to read (di,co,hr or ir)
+    # \param first First protocol address
+    # \param last Last protocol address
+    # \return Number of valid addresses, or None if the datablock is not supported
+    def dump(self,datablock,first,last):
+        limit=RequestEngine.limits[1 if datablock=='di' or datablock=='co' else 3]
+        values=RegionSearch.search(lambda address,count: self.fetch(datablock,address,count),first,last,limit)
+        if values==None: return None
+
+        # Write contiguous runs of valid addresses to the image
+        run=[]
+        for address in sorted(values):
+            if len(run) and address!=run[0]+len(run)-1:
+                self.image.setValues(datablock,run[0],run[1:])
+                run=[]
+            if not len(run): run=[address]
+            run.append(values[address])
+        if len(run): self.image.setValues(datablock,run[0],run[1:])
+        return len(values)
+
+if __name__ == "__main__":
+    # Parse command line options
+    print(App.getAbout('dump','CLI dump and diff of MODBUS address spaces')+'\n')
+    parser=argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-O','--output',help='Image file to dump the device to',dest='output',default='',type=str)
+    parser.add_argument('-D','--diff',help='Compare two images, or one image to the profile',dest='diff',nargs='+',default=[],type=str)
+    parser.add_argument('-R','--range',help='Range of protocol addresses to dump in each datablock, default is 0-65535',dest='range',default='0-65535',type=str)
+    args=Loader(parents=[parser],required=False).clientargs
+    print(App.reportConfig(args))
+
+    if len(args.diff):
+        # Compare images
+        if len(args.diff)>2:
+            print('Please give one or two images to compare')
+            sys.exit()
+        if len(args.diff)==1 and not len(args.profile):
+            print('Please set a profile to compare the image to (See -p or --profile parameter)')
+            sys.exit()
+        old=DumpImage(args.diff[0]) if len(args.diff)==2 else DumpImage.fromProfile(Profiles.loadProfile(args,args.profile),args.offset)
+        new=DumpImage(args.diff[-1])
+        started=time.monotonic()
+        output=old.diff(new)
+        logging.info('Compared images in %.3fms' % round((time.monotonic()-started)*1000,3))
+        print(json.dumps(output,indent=4))
+        old.close()
+        new.close()
+    elif len(args.output):
+        # Dump device
+        if not len(args.profile):
+            print('Please set a profile to use (See -p or --profile parameter)')
+            sys.exit()
+        fields=args.range.split('-')
+        first,last=max(0,int(fields[0])),min(DumpImage.words-1,int(fields[-1]))
+        client=ClientObject(args)
+        if client.connect():
+            image=DumpImage(args.output,True)
+            dumper=Dumper(client,image)
+            for datablock in DumpImage.datablocks:
+                started=time.monotonic()
+                count=dumper.dump(datablock,first,last)
+                if count==None: logging.info('Device does not support '+Utilities.getDatablockName(datablock))
+                else: logging.info('Read %d %s in %.3fs' % (count,Utilities.getDatablockName(datablock),time.monotonic()-started))
+            logging.info('Dumped device with '+str(dumper.requests)+' requests')
+            image.close()
+            client.close()
+    else:
+        print('Please give an image to dump to (See -O or --output) or images to compare (See -D or --diff)')
@@ -3,13 +3,21 @@
 #
 # Vegard Fiksdal (C) 2024
 #
-#from mbtclient import *
-#from mbtserver import *
-from mbtproxy import *
+import sys
+
+# Only import the code paths in use, as importing pymodbus dominates startup time
+runserver='-S' in sys.argv or '--server' in sys.argv
+runclient='-C' in sys.argv or '--client' in sys.argv
+if runserver and runclient: from mbtproxy import *
+elif runserver: from mbtserver import *
+elif runclient: from mbtclient import *
+else: from common import *
 
 # Load appropriate code
-print(App.getAbout()+'\n')
-loader=Loader()
+loader=Loader(parents=[ClientDaemon.createParser()] if runclient and not runserver else [])
+if loader.flags.client and not loader.flags.server and ClientDaemon.isStreaming(loader.clientargs):
+    if not len(loader.clientargs.output) or 'stdout' in loader.clientargs.sinks: LogHandler.fd=sys.stderr
+print(App.getAbout()+'\n',file=LogHandler.fd)
 if loader.flags.server and loader.flags.client:
     print('Server options:')
     print(App.reportConfig(loader.serverargs))
@@ -22,16 +30,17 @@ if loader.flags.server and loader.flags.client:
         proxy.server.waitServer()
 elif loader.flags.server:
     print(App.reportConfig(loader.serverargs))
-    server=ServerObject(loader.serverargs)
+    if loader.serverargs.workers>1:
+        server=ShardedServerObject(loader.serverargs)
+    else:
+        server=ServerObject(loader.serverargs)
     if server.startServer():
         server.waitServer()
 elif loader.flags.client:
-    print(App.reportConfig(loader.clientargs))
+    print(App.reportConfig(loader.clientargs),file=LogHandler.fd)
     client=ClientObject(loader.clientargs)
     if client.connect():
-        output=client.download()
-        output=json.dumps(output,indent=4)
-        print(str(output))
+        ClientDaemon.runClient(client,loader.clientargs)
         client.close()
 else:
     print('Please specify --client or --server')
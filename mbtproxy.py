@@ -5,71 +5,507 @@
 #
 from mbtserver import *
 from mbtclient import *
+import copy,concurrent.futures
 
+##\class Prefetcher
+# \brief Keeps the register image of the proxy server in sync with the upstream device
+#
+# The registers of the client profile are coalesced into block reads. A refresh
+# reads all blocks and stores them in the server datablocks, and records when
+# each register was last read. After the initial refresh at startup, refreshes
+# may run continuously in the background at a given rate, so downstream reads are
+# served from the local image. Registers are read through to the upstream device
+# once older than maxage, which defaults to five refresh intervals, or to five
+# seconds when only refreshing at startup.
+class Prefetcher():
+    ##\brief Plans block reads for the upstream device
+    # \param proxy ProxyObject to prefetch for
+    # \param rate Background refreshes per second, or 0 to only refresh at startup
+    # \param maxage Age in seconds at which registers are read through to the upstream device
+    # \param stats Seconds between logging the staleness of the registers, 0 to only log it when stopping
+    def __init__(self,proxy,rate=0,maxage=None,stats=0):
+        self.proxy=proxy
+        self.rate=rate
+        self.maxage=maxage if maxage else (5.0/rate if rate>0 else 5.0)
+        self.stats=stats
+        self.blocks=[]
+        self.stamps={}
+        self.running=False
+        self.thread=None
+        self.reporter=None
+        self.event=threading.Event()
+        profile=proxy.client.profile
+        for datablock in profile['datablocks']:
+            self.stamps[datablock]={}
+            for block in ReadPlanner.plan(profile['datablocks'][datablock],datablock):
+                self.blocks.append((datablock,block))
+
+    ##\brief Record that registers were read from the upstream device
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param addresses List of register addresses
+    def touch(self,datablock,addresses):
+        now=time.monotonic()
+        for address in addresses: self.stamps[datablock][int(address)]=now
+
+    ##\brief Get time since a register was read from the upstream device
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address Register address
+    # \return Age in seconds, or None if it has never been read
+    def getAge(self,datablock,address):
+        stamp=self.stamps[datablock].get(int(address))
+        if stamp==None: return None
+        return time.monotonic()-stamp
+
+    ##\brief Check if registers are recent enough to be served from the local image
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param registers List of (address,count) tuples
+    # \return True if all registers are younger than maxage
+    def isFresh(self,datablock,registers):
+        if self.maxage==None: return False
+        oldest=time.monotonic()-self.maxage
+        stamps=self.stamps[datablock]
+        for address,count in registers:
+            if stamps.get(address,0)<oldest: return False
+        return True
+
+    ##\brief Get staleness of all registers
+    # \return Dictionary of datablock to register address to age in seconds (None if never read)
+    def getStaleness(self):
+        output={}
+        for datablock,block in self.blocks:
+            if not datablock in output: output[datablock]={}
+            for address in block[2]:
+                age=self.getAge(datablock,address)
+                output[datablock][address]=round(age,3) if age!=None else None
+        return output
+
+    ##\brief Summarize the staleness of all registers
+    # \return Dictionary of register count, registers never read, registers older than maxage and the oldest age in seconds
+    def getSummary(self):
+        ages=[age for datablock in self.getStaleness().values() for age in datablock.values()]
+        read=[age for age in ages if age!=None]
+        return {
+            'registers':len(ages),
+            'unread':len(ages)-len(read),
+            'stale':len([age for age in read if age>self.maxage]),
+            'oldest':max(read) if len(read) else None,
+        }
+
+    ##\brief Log the staleness of all registers
+    def report(self):
+        logging.info('Staleness of '+self.proxy.client.args.profile+': '+json.dumps(self.getSummary()))
+
+    ##\brief Read all blocks from the upstream device into the local image
+    # \return Number of blocks read successfully
+    def refresh(self):
+        count=0
+        for datablock,block in self.blocks:
+            if self.thread and not self.running: break
+            with self.proxy.lock:
+                values=self.proxy.client.readBlock(datablock,block[0],block[1])
+                if values==None: continue
+                self.proxy.internal=threading.get_ident()
+                try:
+                    getattr(self.proxy.server,datablock).setMany([(block[0],list(values))])
+                finally:
+                    self.proxy.internal=None
+            self.touch(datablock,block[2])
+            count+=1
+        return count
+
+    ##\brief Thread method refreshing the image at the configured rate
+    def run(self):
+        interval=1.0/self.rate
+        while self.running:
+            started=time.monotonic()
+            self.refresh()
+            delay=started+interval-time.monotonic()
+            if delay>0: time.sleep(delay)
+
+    ##\brief Thread method logging the staleness of the registers at the configured interval
+    def runReporter(self):
+        while not self.event.wait(self.stats):
+            self.report()
+
+    ##\brief Starts background refreshing and staleness reports
+    def start(self):
+        if self.stats>0:
+            self.event.clear()
+            self.reporter=threading.Thread(target=self.runReporter,daemon=True)
+            self.reporter.start()
+        if self.rate<=0: return
+        logging.info('Refreshing '+str(len(self.blocks))+' blocks at '+str(self.rate)+'Hz')
+        self.running=True
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    ##\brief Stops background refreshing and staleness reports, and logs the staleness
+    def stop(self):
+        self.running=False
+        if self.thread:
+            self.thread.join()
+            self.thread=None
+        self.event.set()
+        if self.reporter:
+            self.reporter.join()
+            self.reporter=None
+        self.report()
+
+##\class ProxyObject
+# \brief Forwards reads and writes of server datablocks to an upstream device
+#
+# Changes the proxy makes to the server datablocks itself are marked with the id
+# of the thread making them, so they are not forwarded back upstream while other
+# threads are still forwarded.
 class ProxyObject():
-    def __init__(self,server,client):
+    ##\brief Binds server and client
+    # \param server Server object holding the datablocks (di, co, hr and ir)
+    # \param client Connected ClientObject for the upstream device
+    # \param rate Background prefetch rate in Hz, or 0 to read through
+    # \param maxage Age in seconds at which prefetched registers are read through
+    # \param bind Set to false if the caller dispatches datablock callbacks itself
+    # \param lock Lock serializing requests on the upstream connection, if shared with other proxies
+    # \param stats Seconds between logging the staleness of the registers, 0 to only log it when stopping
+    def __init__(self,server,client,rate=0,maxage=None,bind=True,lock=None,stats=0):
         self.server=server
         self.client=client
-        self.lock=threading.Lock()
-        self.override=True
+        self.lock=lock if lock else threading.Lock()
+        self.internal=None
+        self.prefetcher=Prefetcher(self,rate,maxage,stats)
 
         # Assign server callbacks
-        self.server.di.addReadCallback(self.onServerRead)
-        self.server.co.addReadCallback(self.onServerRead)
-        self.server.hr.addReadCallback(self.onServerRead)
-        self.server.ir.addReadCallback(self.onServerRead)
-        self.server.di.addWriteCallback(self.onServerWrite)
-        self.server.co.addWriteCallback(self.onServerWrite)
-        self.server.hr.addWriteCallback(self.onServerWrite)
-        self.server.ir.addWriteCallback(self.onServerWrite)
+        if bind:
+            self.server.di.addReadCallback(self.onServerRead)
+            self.server.co.addReadCallback(self.onServerRead)
+            self.server.hr.addReadCallback(self.onServerRead)
+            self.server.ir.addReadCallback(self.onServerRead)
+            self.server.di.addWriteCallback(self.onServerWrite)
+            self.server.co.addWriteCallback(self.onServerWrite)
+            self.server.hr.addWriteCallback(self.onServerWrite)
+            self.server.ir.addWriteCallback(self.onServerWrite)
 
     def startProxy(self):
         # Connect client
         result=False
         if self.server.startServer():
-            if self.client.connect():
-                result=True
+            result=self.startUpstream()
         return result
 
+    ##\brief Connect to the upstream device and prefetch its registers
+    # \return True if connected
+    def startUpstream(self):
+        if not self.client.connect(): return False
+        logging.info('Read '+str(self.prefetcher.refresh())+' of '+str(len(self.prefetcher.blocks))+' blocks from upstream device')
+        self.prefetcher.start()
+        return True
+
+    ##\brief Check if the calling thread is changing the datablocks on behalf of the proxy
+    # \return True for changes that should not be forwarded
+    def isInternal(self):
+        return self.internal==threading.get_ident()
+
     def onServerWrite(self,datablock,address,value):
         retval=value
-        if self.override:
+        if not self.isInternal():
             with self.lock:
-                self.override=False
+                self.internal=threading.get_ident()
                 value=Registers.decodeRegister(self.client.profile['datablocks'][datablock][str(address)],value)
                 logging.info('Writing '+Utilities.getDatablockName(datablock)+' #'+str(address)+' = '+str(value))
-                if not self.client.write(datablock,address,value):
+                if self.client.write(datablock,address,value):
+                    self.prefetcher.touch(datablock,[address])
+                else:
                     retval=getattr(self.server,datablock).getValues(address)
                     logging.warning('Failed to write value. Falling back to '+str(retval))
-                self.override=True
+                self.internal=None
         return retval
 
     def onServerRead(self,datablock,address,value):
+        if self.isInternal(): return value
+        count=len(value) if isinstance(value,list) else 1
+        return self.forwardRead(datablock,address,value,getattr(self.server,datablock).registers.overlapping(address,count))
+
+    ##\brief Read registers through to the upstream device
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First address of the downstream request
+    # \param value Values of the downstream request
+    # \param registers List of (address,count) tuples of the registers to forward
+    # \return Values with the forwarded registers updated
+    def forwardRead(self,datablock,address,value,registers):
         retval=value
-        if self.override:
-            with self.lock:
-                self.override=False
-                read=self.client.read(datablock,address)
-                logging.info('Reading '+Utilities.getDatablockName(datablock)+' #'+str(address)+' = '+str(read))
-                if read!=None:
-                    read=Registers.encodeRegister(self.client.profile['datablocks'][datablock][str(address)],read)
-                    getattr(self.server,datablock).setValues(address,read)
-                    retval=read
-                self.override=True
+        if self.isInternal(): return retval
+
+        # Serve recently prefetched registers from the local image
+        if self.prefetcher.isFresh(datablock,registers): return retval
+        with self.lock:
+            self.internal=threading.get_ident()
+            # Forward the defined registers overlapping the requested range with block reads
+            retval=list(value) if isinstance(value,list) else [value]
+            changes=[]
+            touched=[]
+            profile=self.client.profile['datablocks'][datablock]
+            for first,length,keys in ReadPlanner.plan(dict((str(start),profile[str(start)]) for start,count in registers),datablock):
+                read=self.client.readBlock(datablock,first,length)
+                logging.info('Reading '+Utilities.getDatablockName(datablock)+' #'+str(first)+'-'+str(first+length-1)+' = '+str(read))
+                if read==None and len(keys)>1:
+                    # Read the registers of a rejected block one by one, so one bad register does not fail the rest
+                    for key in keys:
+                        words=self.client.readBlock(datablock,int(key),Registers.registersPerValue(profile[key]))
+                        if words==None: continue
+                        changes.append((int(key),list(words)))
+                        touched.append(key)
+                    continue
+                if read==None: continue
+                changes.append((first,list(read)))
+                touched.extend(keys)
+            self.prefetcher.touch(datablock,touched)
+            for start,read in changes:
+                for i in range(len(read)):
+                    if 0<=start+i-address<len(retval): retval[start+i-address]=read[i]
+            if len(changes): getattr(self.server,datablock).setMany(changes)
+            self.internal=None
         return retval
 
+##\class RouteContext
+# \brief Slave context running the datablock access of a routed unit off the server event loop
+#
+# Reads and writes may block on upstream devices, so a request is split into the
+# ranges served by each upstream connection, and each range is run on the queue of
+# its connection. Ranges without routed registers are run on the default executor
+# of the loop. The event loop is thus free to serve requests routed to other
+# devices meanwhile, and a request spanning several devices waits for them in parallel.
+class RouteContext(ModbusSlaveContext):
+    ## Datablock names of the context store keys
+    names={'d':'di','c':'co','h':'hr','i':'ir'}
+
+    ##\brief Initializes context
+    # \param router Router dispatching the requests
+    # \param unit Downstream unit id
+    def __init__(self,router,unit,**kwargs):
+        super().__init__(**kwargs)
+        self.router=router
+        self.unit=unit
+
+    ##\brief Split a request into the ranges served by each upstream connection
+    # \param fc_as_hex Function code of the request
+    # \param address Protocol address of the request
+    # \param count Number of values requested
+    # \return List of (address,count,executor) tuples in protocol addresses
+    def getSegments(self,fc_as_hex,address,count):
+        offset=0 if self.zero_mode else 1
+        segments=self.router.getSegments(self.unit,RouteContext.names[self.decode(fc_as_hex)],address+offset,count)
+        return [(start-offset,length,executor) for start,length,executor in segments]
+
+    async def async_getValues(self,fc_as_hex,address,count=1):
+        loop=asyncio.get_running_loop()
+        results=await asyncio.gather(*[loop.run_in_executor(executor,self.getValues,fc_as_hex,start,length) for start,length,executor in self.getSegments(fc_as_hex,address,count)])
+        return [value for result in results for value in result]
+
+    async def async_setValues(self,fc_as_hex,address,values):
+        loop=asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor,self.setValues,fc_as_hex,start,values[start-address:start-address+length]) for start,length,executor in self.getSegments(fc_as_hex,address,len(values))])
+
+##\class RouteUnit
+# \brief Datablocks of one downstream unit id served by a routing proxy
+class RouteUnit():
+    ##\brief Creates datablocks for a merged profile
+    # \param profile Profile with the registers of all routes to this unit
+    # \param strict Set to true to only respond to defined addresses
+    # \param router Router dispatching the requests
+    # \param unit Downstream unit id
+    def __init__(self,profile,strict,router,unit):
+        self.profile=profile
+        self.di=DataBlock(profile,'di',strict)
+        self.co=DataBlock(profile,'co',strict)
+        self.hr=DataBlock(profile,'hr',strict)
+        self.ir=DataBlock(profile,'ir',strict)
+        self.context=RouteContext(router,unit,di=self.di, co=self.co, hr=self.hr, ir=self.ir)
+
+##\class Router
+# \brief Proxy fronting several upstream devices
+#
+# A routing file lists the upstream devices, eg:
+#
+#   {"routes":[
+#     {"unit":1,"profile":"meter.json","comm":"serial","serial":"/dev/ttyUSB0","deviceid":1},
+#     {"unit":2,"profile":"meter.json","comm":"serial","serial":"/dev/ttyUSB0","deviceid":2},
+#     {"unit":3,"profile":"plc.json","comm":"tcp","host":"10.0.0.5","port":502,"datablocks":["hr"],"window":[1000,1999]}
+#   ]}
+#
+# Each route maps a downstream unit id, optionally limited to some datablocks and
+# an address window, to an upstream device with its own profile. Any client option
+# may be given per route, the rest are taken from the commandline. Several routes
+# may share a downstream unit id as long as their windows do not overlap.
+#
+# Requests are dispatched to a unit by the server context, and to a route by a
+# dictionary lookup of the register address. Every upstream connection has its
+# own queue, a single worker thread running the requests routed to it, so a slow
+# device only delays requests routed to it while the server event loop keeps
+# serving the others. Routes using the same serial port or TCP endpoint share the
+# connection, its lock and its queue. The server only serves the routed units,
+# it has no profile, scenarios or persistence of its own.
+class Router():
+    ## Route keys copied to the client arguments
+    options=['comm','framer','deviceid','offset','host','port','serial','baudrate','parity','bytesize','timeout','adaptive']
+
+    ##\brief Loads routes, builds downstream units and the server serving them
+    # \param serverargs Parsed server arguments
+    # \param clientargs Parsed client arguments used as defaults for all routes
+    # \param filename Routing file
+    # \param rate Default background prefetch rate in Hz
+    # \param maxage Default age at which prefetched registers are read through
+    # \param stats Seconds between logging the staleness of the registers, 0 to only log it when stopping
+    def __init__(self,serverargs,clientargs,filename,rate=0,maxage=0,stats=0):
+        self.proxies=[]
+        self.executors={}
+        self.table={}
+        profiles={}
+        routes=[]
+        connections={}
+        with open(filename,'r') as fd:
+            config=json.loads(fd.read())
+        for route in config['routes']:
+            # Connect client with route specific options
+            args=copy.copy(clientargs)
+            for option in Router.options:
+                if option in route: setattr(args,option,route[option])
+            args.profile=route['profile']
+            client=ClientObject(args)
+            key=(args.comm,args.serial) if args.comm=='serial' else (args.comm,args.host,str(args.port))
+            if key in connections:
+                client.client,lock,executor=connections[key]
+            else:
+                lock=threading.Lock()
+                executor=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                connections[key]=(client.client,lock,executor)
+
+            # Restrict client profile to the routed registers
+            unit=int(route['unit'])
+            datablocks=route.get('datablocks',['di','co','hr','ir'])
+            first,last=route.get('window',[0,65535])
+            for datablock in client.profile['datablocks']:
+                registers=client.profile['datablocks'][datablock]
+                for address in list(registers.keys()):
+                    if not datablock in datablocks or int(address)<first or int(address)>last: del registers[address]
+
+            # Merge routed registers into the downstream unit
+            if not unit in profiles:
+                profiles[unit]={'identity':client.profile['identity'],'datablocks':{'di':{},'co':{},'hr':{},'ir':{}}}
+                self.table[unit]={'di':{},'co':{},'hr':{},'ir':{}}
+            for datablock in client.profile['datablocks']:
+                for address in client.profile['datablocks'][datablock]:
+                    if address in profiles[unit]['datablocks'][datablock]:
+                        logging.warning('Unit '+str(unit)+' '+Utilities.getDatablockName(datablock)+' #'+address+' is routed twice')
+                    profiles[unit]['datablocks'][datablock][address]=client.profile['datablocks'][datablock][address]
+            routes.append((unit,client,lock,executor,route))
+
+        # Build units and bind a proxy per route
+        self.units={}
+        for unit in profiles:
+            self.units[unit]=RouteUnit(profiles[unit],serverargs.strict,self,unit)
+            for datablock in ['di','co','hr','ir']:
+                getattr(self.units[unit],datablock).addReadCallback(self.createReadCallback(unit))
+                getattr(self.units[unit],datablock).addWriteCallback(self.createWriteCallback(unit))
+        for unit,client,lock,executor,route in routes:
+            proxy=ProxyObject(self.units[unit],client,float(route.get('prefetch',rate)),float(route.get('maxage',maxage)),False,lock,stats)
+            self.executors[proxy]=executor
+            for datablock in client.profile['datablocks']:
+                for address in client.profile['datablocks'][datablock]:
+                    self.table[unit][datablock][int(address)]=proxy
+            self.proxies.append(proxy)
+        self.server=ServerObject(serverargs,self.units)
+
+    ##\brief Split a request into the ranges served by each upstream connection
+    # \param unit Downstream unit id
+    # \param datablock Name of datablock (di, co, hr or ir)
+    # \param address First address of the request
+    # \param count Number of values requested
+    # \return List of (address,count,executor) tuples covering the request, executor is None for a request without routed registers
+    #
+    # Ranges start at the first register of a new connection, and unrouted
+    # addresses are served along with the routed registers before them.
+    def getSegments(self,unit,datablock,address,count):
+        table=self.table[unit][datablock]
+        segments=[]
+        start,executor=address,None
+        for register in getattr(self.units[unit],datablock).registers.overlapping(address,count):
+            proxy=table.get(register[0])
+            if not proxy: continue
+            if executor and self.executors[proxy]!=executor:
+                segments.append((start,register[0]-start,executor))
+                start=register[0]
+            executor=self.executors[proxy]
+        segments.append((start,address+count-start,executor))
+        return segments
+
+    ##\brief Create read callback dispatching to the routes of a unit
+    # \param unit Downstream unit id
+    # \return Callback function(datablock,address,value)
+    def createReadCallback(self,unit):
+        def onServerRead(datablock,address,value):
+            table=self.table[unit][datablock]
+            count=len(value) if isinstance(value,list) else 1
+            groups={}
+            for register in getattr(self.units[unit],datablock).registers.overlapping(address,count):
+                proxy=table[register[0]]
+                if not proxy in groups: groups[proxy]=[]
+                groups[proxy].append(register)
+            for proxy in groups:
+                value=proxy.forwardRead(datablock,address,value,groups[proxy])
+            return value
+        return onServerRead
+
+    ##\brief Create write callback dispatching to the routes of a unit
+    # \param unit Downstream unit id
+    # \return Callback function(datablock,address,value)
+    def createWriteCallback(self,unit):
+        def onServerWrite(datablock,address,value):
+            proxy=self.table[unit][datablock].get(int(address))
+            if proxy==None: return value
+            return proxy.onServerWrite(datablock,address,value)
+        return onServerWrite
+
+    ##\brief Start the server and connect all upstream devices
+    # \return True if the server is running
+    def startProxy(self):
+        if not self.server.startServer(): return False
+        for proxy in self.proxies:
+            if not proxy.startUpstream():
+                logging.error('Could not connect to upstream device for '+proxy.client.args.profile)
+        return True
+
+    ##\brief Stop background prefetching and the connection queues
+    def stop(self):
+        for proxy in self.proxies: proxy.prefetcher.stop()
+        for executor in set(self.executors.values()): executor.shutdown()
+
 if __name__ == "__main__":
     # Present options
     print(App.getAbout('proxy','CLI proxy for MODBUS Testing')+'\n')
-    loader=Loader()
+    parser=argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-F','--prefetch',help='Refresh the register image from the upstream device this many times per second, default is 0 (Read through)',dest='prefetch',default=0,type=float)
+    parser.add_argument('-M','--maxage',help='Age in seconds at which prefetched registers are read through, default is 5 refresh intervals or 5 seconds without prefetching',dest='maxage',default=0,type=float)
+    parser.add_argument('-T','--stats',help='Seconds between logging the staleness of the prefetched registers, default is 60',dest='stats',default=60,type=float)
+    parser.add_argument('-R','--routes',help='Routing file mapping unit ids to several upstream devices',dest='routes',default='',type=str)
+    loader=Loader(parents=[parser],required=False)
+    routes=loader.serverargs.routes if len(loader.serverargs.routes) else loader.clientargs.routes
+    if not len(routes) and not len(loader.serverargs.profile):
+        print('No profile specified')
+        sys.exit()
     print('Server options:')
     print(App.reportConfig(loader.serverargs))
     print('Client options:')
     print(App.reportConfig(loader.clientargs))
 
     # Run proxy
-    server=ServerObject(loader.serverargs)
-    client=ClientObject(loader.clientargs)
-    proxy=ProxyObject(server,client)
-    if proxy.startProxy():
-        proxy.server.waitServer()
+    if len(routes):
+        router=Router(loader.serverargs,loader.clientargs,routes,loader.clientargs.prefetch,loader.clientargs.maxage,loader.clientargs.stats)
+        if router.startProxy():
+            router.server.waitServer()
+            router.stop()
+    else:
+        server=ServerObject(loader.serverargs)
+        client=ClientObject(loader.clientargs)
+        proxy=ProxyObject(server,client,loader.clientargs.prefetch,loader.clientargs.maxage,stats=loader.clientargs.stats)
+        if proxy.startProxy():
+            proxy.server.waitServer()
+            proxy.prefetcher.stop()
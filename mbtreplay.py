@@ -0,0 +1,108 @@
+##\package mbtreplay
+# \brief CLI replay of captured MODBUS traffic
+#
+# Vegard Fiksdal (C) 2024
+#
+from pymodbus.factory import ServerDecoder
+from mbtclient import *
+from capture import *
+
+##\class ReplayObject
+# \brief Re-issues captured requests against a server and compares the outcome
+class ReplayObject():
+    ##\brief Initializes replay
+    # \param args Parsed commandline arguments
+    def __init__(self,args):
+        self.args=args
+        self.speed=args.speed
+        self.transactions=TraceReader(args.trace).transactions()
+        self.client=ClientObject.createClient(args)
+        self.decoder=ServerDecoder()
+
+    ##\brief Connect to the server
+    # \return True if succsessfully connected
+    def connect(self):
+        if self.client:
+            self.client.connect()
+            if not self.client.connected: self.client=None
+        return (self.client!=None)
+
+    ##\brief Replay all transactions
+    # \return Dictionary with replay statistics
+    def run(self):
+        count,errors,mismatches=0,0,0
+        original,replayed=[],[]
+        started=time.monotonic()
+        first=None
+        for request,response in self.transactions:
+            # Pace requests according to speed
+            if first==None: first=request[0]
+            if self.speed>0:
+                delay=(request[0]-first)/self.speed-(time.monotonic()-started)
+                if delay>0: time.sleep(delay)
+
+            # Execute request
+            message=self.decoder.decode(request[5])
+            if message==None:
+                logging.warning('Skipping undecodable request with function code '+str(request[4]))
+                continue
+            message.slave_id=request[3]
+            count+=1
+            t=time.monotonic()
+            try:
+                result=self.client.execute(message)
+            except ModbusException as exc:
+                logging.error('ModbusException: '+str(exc))
+                errors+=1
+                continue
+            replayed.append(time.monotonic()-t)
+
+            # Compare with captured response
+            if response:
+                original.append(response[0]-request[0])
+                pdu=bytes([result.function_code])+result.encode()
+                if pdu!=response[5]:
+                    mismatches+=1
+                    logging.debug('Response mismatch for function code '+str(request[4])+': '+response[5].hex()+' != '+pdu.hex())
+
+        stats={}
+        stats['requests']=count
+        stats['errors']=errors
+        stats['mismatches']=mismatches
+        stats['duration']=time.monotonic()-started
+        stats['original']=ReplayObject.getLatencies(original)
+        stats['replayed']=ReplayObject.getLatencies(replayed)
+        return stats
+
+    ##\brief Summarize latencies
+    # \param latencies List of latencies in seconds
+    # \return Dictionary of mean, median, 95th percentile and max in milliseconds
+    def getLatencies(latencies):
+        output={'mean':0,'p50':0,'p95':0,'max':0}
+        if len(latencies):
+            latencies=sorted(latencies)
+            output['mean']=round(sum(latencies)/len(latencies)*1000,3)
+            output['p50']=round(latencies[int(len(latencies)*0.50)]*1000,3)
+            output['p95']=round(latencies[min(int(len(latencies)*0.95),len(latencies)-1)]*1000,3)
+            output['max']=round(latencies[-1]*1000,3)
+        return output
+
+    ##\brief Close connection to server
+    def close(self):
+        if self.client: self.client.close()
+
+if __name__ == "__main__":
+    # Parse command line options
+    print(App.getAbout('replay','CLI replay of captured MODBUS traffic')+'\n')
+    parser=argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-T','--trace',help='Trace file to replay',dest='trace',required=True,type=str)
+    parser.add_argument('-X','--speed',help='Replay speed factor, 1 for original timing, 0 for maximum speed',dest='speed',default=1,type=float)
+    args=Loader(parents=[parser],required=False).clientargs
+
+    # Run replay
+    replay=ReplayObject(args)
+    if replay.connect():
+        output=replay.run()
+        output=json.dumps(output,indent=4)
+        print(str(output))
+        replay.close()
@@ -0,0 +1,256 @@
+##\package mbtscan
+# \brief CLI scanner discovering devices and their registers
+#
+# Vegard Fiksdal (C) 2024
+#
+# Each target (A TCP host or a serial port) is first probed for responding unit
+# ids, with a short timeout and without retries, so absent units cost little.
+# For each unit found, the address range of every datablock is read with block
+# reads, where rejected blocks are bisected to find the valid regions (See
+# RegionSearch in common.py). Each region thus costs a handful of requests
+# regardless of its length.
+#
+# TCP targets are scanned concurrently, one thread per target, and the units of
+# each TCP target are probed and swept concurrently over several connections.
+# Serial targets are scanned sequentially with the silent interval between frames.
+#
+import copy,collections
+from mbtclient import *
+
+##\class Scanner
+# \brief Discovers units and registers on one target
+class Scanner():
+    ## Object ids of device identification, and the profile keys they map to
+    identity={0:'VendorName',1:'ProductCode',2:'MajorMinorRevision',3:'VendorUrl',4:'ProductName',5:'ModelName',6:'UserApplicationName'}
+
+    ##\brief Initializes scanner for a target
+    # \param args Parsed commandline arguments for the target
+    # \param units List of unit ids to probe
+    # \param ranges Dictionary of datablock to (first,last) protocol addresses to sweep
+    # \param parallel Number of concurrent connections to TCP targets
+    # \param probetimeout Timeout in seconds when probing unit ids
+    def __init__(self,args,units,ranges,parallel=1,probetimeout=0.2):
+        self.args=args
+        self.units=units
+        self.ranges=ranges
+        self.offset=args.offset
+        self.link=LinkModel(args)
+        self.parallel=max(1,parallel) if args.comm=='tcp' else 1
+        self.probetimeout=max(min(probetimeout,args.timeout),2*self.link.getTransactionTime('hr',1))
+        self.lock=threading.Lock()
+        self.requests=0
+        self.last=0
+        self.name=args.serial if args.comm=='serial' else args.host+':'+str(args.port)
+
+    ##\brief Connect to target
+    # \param timeout Request timeout in seconds
+    # \param retries Number of times a request is retried when the device does not respond
+    # \return Connected pymodbus client, or None upon failure
+    def connect(self,timeout,retries):
+        args=copy.copy(self.args)
+        args.timeout=timeout
+        client=ClientObject.createClient(args,retries)
+        if client:
+            client.connect()
+            if not client.connected: client=None
+        return client
+
+    ##\brief Run a job for a number of units, over several connections to TCP targets
+    # \param units List of unit ids
+    # \param timeout Request timeout in seconds
+    # \param retries Number of times a request is retried when the device does not respond
+    # \param job Function(client,unit) returning the result for the unit, or None
+    # \return Dictionary of unit id to result, or None if the target could not be connected
+    def dispatch(self,units,timeout,retries,job):
+        results={}
+        queue=collections.deque(units)
+        def work(client):
+            while True:
+                with self.lock:
+                    if not len(queue): break
+                    unit=queue.popleft()
+                result=job(client,unit)
+                if result!=None:
+                    with self.lock: results[unit]=result
+            client.close()
+        clients=[]
+        for i in range(min(self.parallel,len(units))):
+            client=self.connect(timeout,retries)
+            if client: clients.append(client)
+        if len(units) and not len(clients): return None
+        threads=[threading.Thread(target=work,args=(client,)) for client in clients]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return results
+
+    ##\brief Execute a request, respecting the silent interval
+    # \param request Function executing the request and returning the response
+    # \return Response, or None if the device did not respond
+    def execute(self,request):
+        with self.lock:
+            delay=self.last+self.link.gap-time.monotonic()
+            self.requests+=1
+        if delay>0: time.sleep(delay)
+        try:
+            response=request()
+        except ModbusException as exc:
+            logging.debug(self.name+': '+str(exc))
+            response=None
+        self.last=time.monotonic()
+        if response!=None and response.isError() and not isinstance(response,ExceptionResponse): response=None
+        return response
+
+    ##\brief Read a block of a datablock
+    # \param client Connected pymodbus client
+    # \param unit Unit id
+    # \param datablock Datablock to read from (di,co,hr or ir)
+    # \param address First protocol address
+    # \param count Number of registers or bits
+    # \return Response, or None if the device did not respond
+    def read(self,client,unit,datablock,address,count):
+        if datablock=='di': return self.execute(lambda: client.read_discrete_inputs(address,count,unit))
+        if datablock=='co': return self.execute(lambda: client.read_coils(address,count,unit))
+        if datablock=='hr': return self.execute(lambda: client.read_holding_registers(address,count,unit))
+        if datablock=='ir': return self.execute(lambda: client.read_input_registers(address,count,unit))
+
+    ##\brief Check if a unit responds
+    # \param client Connected pymodbus client
+    # \param unit Unit id
+    # \return True if the unit answered, even with an exception
+    def probe(self,client,unit):
+        return self.read(client,unit,'hr',0,1)!=None
+
+    ##\brief Read a block and extract its values
+    # \param client Connected pymodbus client
+    # \param unit Unit id
+    # \param datablock Datablock to read from (di,co,hr or ir)
+    # \param address First protocol address
+    # \param count Number of registers or bits
+    # \return List of values, None if rejected, or False if the function is not supported
+    def fetch(self,client,unit,datablock,address,count):
+        response=self.read(client,unit,datablock,address,count)
+        if response==None: return None
+        if response.isError(): return False if response.exception_code==1 else None
+        data=response.bits if datablock=='di' or datablock=='co' else response.registers
+        return data[:count]
+
+    ##\brief Find valid regions of a datablock
+    # \param client Connected pymodbus client
+    # \param unit Unit id
+    # \param datablock Datablock to sweep (di,co,hr or ir)
+    # \param first First protocol address
+    # \param last Last protocol address
+    # \return Dictionary of protocol address to value, or None if the datablock is not supported
+    def sweep(self,client,unit,datablock,first,last):
+        limit=ReadPlanner.maxbits if datablock=='di' or datablock=='co' else ReadPlanner.maxregisters
+        return RegionSearch.search(lambda address,count: self.fetch(client,unit,datablock,address,count),first,last,limit)
+
+    ##\brief Read device identification
+    # \param client Connected pymodbus client
+    # \param unit Unit id
+    # \return Dictionary of identity fields for the profile
+    def identify(self,client,unit):
+        output={}
+        response=self.execute(lambda: client.read_device_information(2,slave=unit))
+        if response!=None and not response.isError():
+            for key in response.information:
+                if key in Scanner.identity:
+                    output[Scanner.identity[key]]=response.information[key].decode('utf-8','replace')
+        return output
+
+    ##\brief Build draft profile from sweep results
+    # \param unit Unit id
+    # \param identity Dictionary of identity fields
+    # \param datablocks Dictionary of datablock to protocol address to value
+    # \return Profile dictionary
+    def getProfile(self,unit,identity,datablocks):
+        profile={'identity':{'VendorName':'Unknown','ProductCode':'','VendorUrl':'','ProductName':'Unit '+str(unit)+' at '+self.name,'ModelName':'','MajorMinorRevision':''},'datablocks':{}}
+        profile['identity'].update(identity)
+        for datablock in ['di','co','hr','ir']:
+            profile['datablocks'][datablock]={}
+            for address in sorted(datablocks.get(datablock,{})):
+                register={'dsc':'Unknown','dtype':'bit' if datablock=='di' or datablock=='co' else 'uint16','value':datablocks[datablock][address]}
+                if datablock=='co' or datablock=='hr': register['rtype']='rw'
+                profile['datablocks'][datablock][str(address-self.offset)]=register
+        return profile
+
+    ##\brief Sweep all datablocks of a unit
+    # \param client Connected pymodbus client
+    # \param unit Unit id
+    # \return Draft profile
+    def scan(self,client,unit):
+        datablocks={}
+        for datablock in self.ranges:
+            values=self.sweep(client,unit,datablock,*self.ranges[datablock])
+            if values==None:
+                logging.info('Unit '+str(unit)+' does not support '+Utilities.getDatablockName(datablock))
+                continue
+            logging.info('Unit '+str(unit)+' has '+str(len(values))+' '+Utilities.getDatablockName(datablock))
+            datablocks[datablock]=values
+        return self.getProfile(unit,self.identify(client,unit),datablocks)
+
+    ##\brief Scan all units of the target
+    # \return Dictionary of unit id to draft profile, or None if the target could not be connected
+    def run(self):
+        found=self.dispatch(self.units,self.probetimeout,0,lambda client,unit: True if self.probe(client,unit) else None)
+        if found==None: return None
+        for unit in sorted(found): logging.info('Found unit '+str(unit)+' at '+self.name)
+        output=self.dispatch(sorted(found),self.args.timeout,1,self.scan)
+        if output==None: return None
+        logging.info('Scanned '+self.name+' with '+str(self.requests)+' requests')
+        return dict((unit,output[unit]) for unit in sorted(output))
+
+    ##\brief Parse a range of numbers from the commandline
+    # \param spec Range as FIRST-LAST or a single number
+    # \return Tuple of first and last number
+    def parseRange(spec):
+        fields=spec.split('-')
+        return int(fields[0]),int(fields[-1])
+
+if __name__ == "__main__":
+    # Parse command line options
+    print(App.getAbout('scan','CLI scanner for MODBUS devices')+'\n')
+    parser=argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-T','--target',help='Additional TCP target as HOST[:PORT], may be repeated',dest='targets',action='append',default=[])
+    parser.add_argument('-U','--units',help='Range of unit ids to probe, default is 1-247',dest='units',default='1-247',type=str)
+    parser.add_argument('-R','--range',help='Range of protocol addresses to sweep in each datablock, default is 0-999',dest='range',default='0-999',type=str)
+    parser.add_argument('-O','--output',help='Directory to write draft profiles to, default is to print them',dest='output',default='',type=str)
+    parser.add_argument('-J','--parallel',help='Number of concurrent connections to each TCP target, default is 8',dest='parallel',default=8,type=int)
+    parser.add_argument('-Q','--probetimeout',help='Timeout in seconds when probing unit ids, default is 0.2 (Never more than --timeout)',dest='probetimeout',default=0.2,type=float)
+    args=Loader(parents=[parser],required=False).clientargs
+    print(App.reportConfig(args))
+
+    # Set up one scanner per target
+    first,last=Scanner.parseRange(args.units)
+    units=list(range(first,last+1))
+    ranges={}
+    for datablock in ['di','co','hr','ir']: ranges[datablock]=Scanner.parseRange(args.range)
+    targets=[args]
+    for target in args.targets:
+        targs=copy.copy(args)
+        fields=target.split(':')
+        targs.comm='tcp'
+        targs.host=fields[0]
+        if len(fields)>1: targs.port=fields[1]
+        targets.append(targs)
+    scanners=[Scanner(targs,units,ranges,args.parallel,args.probetimeout) for targs in targets]
+
+    # Scan all targets concurrently
+    results={}
+    def scan(scanner):
+        output=scanner.run()
+        if output==None: logging.error('Could not connect to '+scanner.name)
+        else: results[scanner.name]=output
+    threads=[threading.Thread(target=scan,args=(scanner,)) for scanner in scanners]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    # Output draft profiles
+    for name in results:
+        for unit in results[name]:
+            if len(args.output):
+                filename=os.path.join(args.output,'draft_'+name.replace(':','_').replace('/','_')+'_'+str(unit)+'.json')
+                Profiles.saveProfile(results[name][unit],filename)
+                print('Wrote '+filename)
+            else:
+                print(json.dumps(results[name][unit],indent=4))
@@ -3,46 +3,187 @@
 #
 # Vegard Fiksdal (C) 2024
 #
+import pymodbus
 from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import (
     ModbusServerContext,
     ModbusSlaveContext
 )
+from pymodbus.bit_read_message import ReadCoilsRequest,ReadDiscreteInputsRequest
+from pymodbus.register_read_message import ReadHoldingRegistersRequest,ReadInputRegistersRequest
 from pymodbus.server import (
+    ModbusTcpServer,
     StartAsyncSerialServer,
     StartAsyncTcpServer,
     StartAsyncUdpServer,
-    StartSerialServer,
-    StartTcpServer,
-    StartUdpServer,
     ServerAsyncStop,
     ServerStop
 )
 from common import *
-import threading,time
+from datastore import *
+from scenario import *
+from capture import *
+from persist import *
+import threading,time,socket,asyncio,multiprocessing,signal,concurrent.futures
+
+##\class CachedResponse
+# \brief Read response sent from an encoded response cache
+#
+# Carries only what the framers use to send a response, so answering from the
+# cache neither reads the datablock nor encodes the values again.
+class CachedResponse():
+    ## Always send the response
+    should_respond=True
+
+    ##\brief Initializes response
+    # \param function_code Function code of the request
+    # \param data Encoded response, excluding the function code
+    def __init__(self,function_code,data):
+        self.function_code=function_code
+        self.data=data
+        self.transaction_id=0
+        self.slave_id=0
+
+    ##\brief Get encoded response
+    # \return Encoded response, excluding the function code
+    def encode(self):
+        return self.data
+
+    ##\brief Check if response is an error
+    # \return False
+    def isError(self):
+        return False
+
+##\class CachedRequest
+# \brief Mixin answering read requests from the encoded response cache of the datablock
+#
+# Misses are executed as usual and the encoded response is cached, unless the
+# datablock has no cache or was written to meanwhile (See DataBlock.putEncoded()).
+class CachedRequest():
+    ##\brief Run request against a slave context
+    # \param context ModbusSlaveContext to read from
+    # \return Response
+    async def execute(self, context):
+        store=getattr(context,'store',None)
+        datablock=store.get(context.decode(self.function_code)) if store else None
+        if not isinstance(datablock,DataBlock) or not datablock.cache:
+            return await super().execute(context)
+        address=self.address if context.zero_mode else self.address+1
+        data=datablock.getEncoded(address,self.count)
+        if data: return CachedResponse(self.function_code,data)
+        token=datablock.getToken()
+        response=await super().execute(context)
+        if not response.isError(): datablock.putEncoded(address,self.count,response.encode(),token)
+        return response
+
+##\class CachedReadCoilsRequest
+# \brief Read coils request answered from the response cache
+class CachedReadCoilsRequest(CachedRequest,ReadCoilsRequest):
+    pass
+
+##\class CachedReadDiscreteInputsRequest
+# \brief Read discrete inputs request answered from the response cache
+class CachedReadDiscreteInputsRequest(CachedRequest,ReadDiscreteInputsRequest):
+    pass
+
+##\class CachedReadHoldingRegistersRequest
+# \brief Read holding registers request answered from the response cache
+class CachedReadHoldingRegistersRequest(CachedRequest,ReadHoldingRegistersRequest):
+    pass
+
+##\class CachedReadInputRegistersRequest
+# \brief Read input registers request answered from the response cache
+class CachedReadInputRegistersRequest(CachedRequest,ReadInputRegistersRequest):
+    pass
+
+##\class SharedPortTcpServer
+# \brief Modbus TCP server accepting connections on a socket bound by the caller
+#
+# Overrides listen() to serve the given socket, so it can be bound with options
+# pymodbus does not set itself (Eg. SO_REUSEPORT).
+#
+# pymodbus has no public hook for this, so the class relies on these internals
+# of ModbusBaseServer and ModbusProtocol in pymodbus 3.6.9 (See requirements.txt):
+#   listen()                 Called by serve_forever() to start accepting connections
+#   loop                     Event loop the server was created on
+#   transport                Listening transport, closed by shutdown()
+#   handle_new_connection    Protocol factory for accepted connections
+#   decoder.register()       Adds custom functions, as StartAsyncTcpServer() does
+class SharedPortTcpServer(ModbusTcpServer):
+    ## pymodbus version the internals above are verified against
+    version='3.6.9'
+
+    ##\brief Initializes server
+    # \param sock Bound and listening socket
+    def __init__(self,sock,**kwargs):
+        super().__init__(**kwargs)
+        self.sock=sock
+
+    ##\brief Start accepting connections on the socket
+    # \return True if listening
+    async def listen(self):
+        self.transport=await self.loop.create_server(self.handle_new_connection,sock=self.sock,start_serving=True)
+        return True
 
 ##\class AsyncServerObject
 # \brief Asynchrous modbus server
 class AsyncServerObject():
     ##\brief Initializes async server object
     # \param args Arguments to configure the object
-    def __init__(self,args):
+    # \param image Optional SharedImage to keep register values in
+    # \param units Optional dictionary of unit id to units (Eg. RouteUnit) to serve instead of a profile
+    def __init__(self,args,image=None,units=None):
         # Parse profile and contexts
-        self.profile=Profiles.loadProfile(args,args.profile)
-        self.di=DataBlock(self.profile,'di',args.strict)
-        self.co=DataBlock(self.profile,'co',args.strict)
-        self.hr=DataBlock(self.profile,'hr',args.strict)
-        self.ir=DataBlock(self.profile,'ir',args.strict)
-        self.slavecontext=ModbusSlaveContext(di=self.di, co=self.co, hr=self.hr, ir=self.ir)
-        if args.deviceid:
-            self.mastercontext=ModbusServerContext(slaves={args.deviceid:self.slavecontext},single=False)
+        if units:
+            # Serve the contexts of the given units, the first one identifies the server
+            self.profile=units[next(iter(units))].profile
+            self.image=None
+            self.di=self.co=self.hr=self.ir=None
+            self.slavecontext=None
+            self.mastercontext=ModbusServerContext(slaves=dict((unit,units[unit].context) for unit in units),single=False)
         else:
-            self.mastercontext=ModbusServerContext(slaves=self.slavecontext,single=True)
+            self.profile=Profiles.loadProfile(args,args.profile)
+            if image==None and args.image:
+                logging.info('Sharing register image in '+args.image)
+                image=SharedImage(filename=args.image,create=True)
+            self.image=image
+            if image:
+                self.di=SharedDataBlock(self.profile,'di',args.strict,image)
+                self.co=SharedDataBlock(self.profile,'co',args.strict,image)
+                self.hr=SharedDataBlock(self.profile,'hr',args.strict,image)
+                self.ir=SharedDataBlock(self.profile,'ir',args.strict,image)
+            else:
+                self.di=DataBlock(self.profile,'di',args.strict)
+                self.co=DataBlock(self.profile,'co',args.strict)
+                self.hr=DataBlock(self.profile,'hr',args.strict)
+                self.ir=DataBlock(self.profile,'ir',args.strict)
+            self.slavecontext=ModbusSlaveContext(di=self.di, co=self.co, hr=self.hr, ir=self.ir)
+            if args.deviceid:
+                self.mastercontext=ModbusServerContext(slaves={args.deviceid:self.slavecontext},single=False)
+            else:
+                self.mastercontext=ModbusServerContext(slaves=self.slavecontext,single=True)
         self.identity=ModbusDeviceIdentification(info_name=self.profile['identity'])
 
+        # Optionally cache encoded read responses
+        self.functions=[]
+        if args.cache and not units:
+            logging.info('Caching encoded responses of up to '+str(args.cache)+' ranges per datablock')
+            for datablock in [self.di,self.co,self.hr,self.ir]: datablock.enableCache(args.cache)
+            self.functions=[CachedReadCoilsRequest,CachedReadDiscreteInputsRequest,CachedReadHoldingRegistersRequest,CachedReadInputRegistersRequest]
+
+        # Optionally capture traffic
+        self.capture=None
+        self.hooks={}
+        if args.capture:
+            logging.info('Capturing traffic to '+args.capture)
+            self.capture=TraceWriter(args.capture)
+            self.hooks['request_tracer']=self.capture.traceRequest
+            self.hooks['response_manipulator']=self.capture.traceResponse
+
         # Assign objects
         self.args=args
         self.server=None
+        self.loop=None
         self.running=False
 
     ##\brief Starts the modbus server
@@ -52,35 +193,140 @@ class AsyncServerObject():
             if not Utilities.checkSocket(self.args.host,int(self.args.port)):
                 logging.critical('Could not bind to network interface: '+str(self.args.host)+':'+str(self.args.port))
                 return False
+        await self.serve()
 
-        # Start server
+    ##\brief Runs the modbus server on the running event loop
+    async def serve(self):
+        self.loop=asyncio.get_running_loop()
         self.running=True
         args=self.args
-        if args.comm=='tcp':    self.server = await StartAsyncTcpServer(context=self.mastercontext,identity=self.identity,address=(args.host,args.port),framer=args.framer)
-        if args.comm=='udp':    self.server = await StartAsyncUdpServer(context=self.mastercontext,identity=self.identity,address=(args.host,args.port),framer=args.framer,timeout=args.timeout)
-        if args.comm=='serial': self.server = await StartAsyncSerialServer(context=self.mastercontext,identity=self.identity,port=args.serial,baudrate=args.baudrate,bytesize=args.bytesize,parity=args.parity,stopbits=1,framer=args.framer,timeout=args.timeout)
+        if args.comm=='tcp':    self.server = await StartAsyncTcpServer(context=self.mastercontext,identity=self.identity,address=(args.host,args.port),framer=args.framer,custom_functions=self.functions,**self.hooks)
+        if args.comm=='udp':    self.server = await StartAsyncUdpServer(context=self.mastercontext,identity=self.identity,address=(args.host,args.port),framer=args.framer,timeout=args.timeout,custom_functions=self.functions,**self.hooks)
+        if args.comm=='serial': self.server = await StartAsyncSerialServer(context=self.mastercontext,identity=self.identity,port=args.serial,baudrate=args.baudrate,bytesize=args.bytesize,parity=args.parity,stopbits=1,framer=args.framer,timeout=args.timeout,custom_functions=self.functions,**self.hooks)
         self.running=False
+        self.loop=None
+
+    ##\brief Runs a TCP server sharing its port with other processes (SO_REUSEPORT) until SIGTERM
+    async def startShard(self):
+        args=self.args
+        try:
+            sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+            sock.bind((args.host,int(args.port)))
+            sock.listen(100)
+        except OSError as error:
+            logging.critical('Could not bind to network interface: '+str(args.host)+':'+str(args.port)+': '+str(error))
+            return
+        if pymodbus.__version__!=SharedPortTcpServer.version:
+            logging.warning('Shared port workers are verified with pymodbus '+SharedPortTcpServer.version+', not '+pymodbus.__version__)
+        self.server=SharedPortTcpServer(sock,context=self.mastercontext,framer=args.framer,identity=self.identity,address=(args.host,args.port),**self.hooks)
+        for function in self.functions: self.server.decoder.register(function)
+        self.loop=asyncio.get_running_loop()
+        self.loop.add_signal_handler(signal.SIGTERM,lambda: self.loop.create_task(self.server.shutdown()))
+        self.running=True
+        await self.server.serve_forever()
+        self.running=False
+
+    ##\brief Apply a changed profile to the live datablocks
+    # \param filename Profile to load
+    # \param timeout Seconds to wait for the server to apply the change
+    #
+    # Raises an exception if the profile can not be loaded or applied.
+    def reloadProfile(self,filename=None,timeout=10):
+        self.applyProfile(Profiles.loadProfile(self.args,filename if filename else self.args.profile),timeout)
+
+    ##\brief Apply a loaded profile to the live datablocks
+    # \param profile Loaded profile
+    # \param timeout Seconds to wait for the server to apply the change
+    #
+    # When the server is running, the change is made on its event loop between two
+    # requests, so no request sees a mix of the old and new register layouts. Any
+    # exception raised while applying the change is raised here.
+    def applyProfile(self,profile,timeout=10):
+        # Encode all datablocks before touching any, so an invalid profile changes nothing
+        layouts=dict((datablock,getattr(self,datablock).prepare(profile)) for datablock in ['di','co','hr','ir'])
+        async def apply():
+            for datablock in ['di','co','hr','ir']:
+                added,removed,changed=getattr(self,datablock).commit(layouts[datablock])
+                if added or removed or changed:
+                    logging.info('Reloaded '+Utilities.getDatablockName(datablock)+': '+str(added)+' added, '+str(removed)+' removed, '+str(changed)+' changed')
+            self.profile=profile
+        loop=self.loop
+        if loop and loop.is_running():
+            future=asyncio.run_coroutine_threadsafe(apply(),loop)
+            try:
+                future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise Exception('Server did not apply the profile within '+str(timeout)+' seconds')
+        else:
+            asyncio.run(apply())
+
+    ##\brief Log the hit rate of the response caches
+    def reportCache(self):
+        for datablock in ['di','co','hr','ir']:
+            if not getattr(self,datablock): continue
+            cache=getattr(self,datablock).cache
+            if cache and cache.hits+cache.misses:
+                logging.info('Response cache of '+Utilities.getDatablockName(datablock)+': '+str(cache.hits)+' hits, '+str(cache.misses)+' misses')
 
     ##\brief Stops the modbus server
     async def stopServer(self):
         if self.running: await ServerAsyncStop()
+        self.reportCache()
+        if self.capture: self.capture.close()
+        if self.image and self.image.owner: self.image.close()
 
 ##\class ServerObject
 # \brief Threaded modbus server
 class ServerObject(AsyncServerObject):
     ##\brief Initializes server object
     # \param args Arguments to configure the object
-    def __init__(self,args):
-        super().__init__(args)
+    # \param units Optional dictionary of unit id to units (Eg. RouteUnit) to serve instead of a profile
+    #
+    # Servers given units have no profile of their own, and thus no scenarios,
+    # profile reload or persistence.
+    def __init__(self,args,units=None):
+        super().__init__(args,units=units)
+        self.scenarios=None
+        self.watcher=None
+        self.journal=None
+        if units: return
+        path=os.path.dirname(os.path.abspath(Profiles.getProfile(args,args.profile)))
+        self.scenarios=ScenarioEngine(self,args.rate,path)
+        if args.watch:
+            self.watcher=ProfileWatcher(Profiles.getProfile(args,args.profile),self.reloadProfile)
+        if args.persist:
+            logging.info('Persisting register values in '+args.persist)
+            self.journal=Journal(self,args.persist,args.fsync,period=args.checkpoint)
+
+    ##\brief Apply a changed profile to the live datablocks, and restart its scenarios
+    # \param filename Profile to load
+    # \param timeout Seconds to wait for the server to apply the change
+    #
+    # The running scenarios are only replaced once the new profile has loaded, and
+    # are resumed if it can not be applied.
+    def reloadProfile(self,filename=None,timeout=10):
+        filename=filename if filename else self.args.profile
+        logging.info('Reloading profile '+str(filename))
+        profile=Profiles.loadProfile(self.args,filename)
+        path=os.path.dirname(os.path.abspath(Profiles.getProfile(self.args,filename)))
+        scenarios=ScenarioEngine(self,self.args.rate,path,profile=profile)
+        self.scenarios.stop()
+        try:
+            self.applyProfile(profile,timeout)
+        except:
+            if self.running: self.scenarios.start()
+            raise
+        if self.journal: self.journal.checkpoint()
+        self.scenarios=scenarios
+        if self.running: self.scenarios.start()
 
     ##\brief Thread method to run the server
     def runServer(self):
         self.running=True
-        args=self.args
-        if args.comm=='tcp':    self.server = StartTcpServer(context=self.mastercontext,identity=self.identity,address=(args.host,args.port),framer=args.framer)
-        if args.comm=='udp':    self.server = StartUdpServer(context=self.mastercontext,identity=self.identity,address=(args.host,args.port),framer=args.framer,timeout=args.timeout)
-        if args.comm=='serial': self.server = StartSerialServer(context=self.mastercontext,identity=self.identity,port=args.serial,baudrate=args.baudrate,bytesize=args.bytesize,parity=args.parity,stopbits=1,framer=args.framer,timeout=args.timeout)
-        self.running=False
+        asyncio.run(self.serve())
 
     ##\brief Starts the modbus server in a background thread
     # \returns True if the server is running
@@ -91,17 +337,31 @@ class ServerObject(AsyncServerObject):
                 logging.critical('Could not bind to network interface: '+str(self.args.host)+':'+str(self.args.port))
                 return False
 
+        # Restore persisted values, logging writes from before the first request
+        if self.journal:
+            if not self.journal.restore(): return False
+            self.journal.start()
+
         # Start server in background thread
         self.thread=threading.Thread(target=self.runServer)
         self.thread.start()
         time.sleep(1)
+        if self.running and self.scenarios: self.scenarios.start()
+        if self.running and self.watcher: self.watcher.start()
+        if not self.running and self.journal: self.journal.stop()
         return self.running
 
     ##\brief Stops the modbus server
     def stopServer(self):
+        if self.watcher: self.watcher.stop()
+        if self.scenarios: self.scenarios.stop()
         if self.running:
             ServerStop()
             self.thread.join()
+        if self.journal: self.journal.stop()
+        self.reportCache()
+        if self.capture: self.capture.close()
+        if self.image and self.image.owner: self.image.close()
 
     ##\brief Wait for server to terminate
     def waitServer(self):
@@ -111,11 +371,102 @@ class ServerObject(AsyncServerObject):
         except:
             self.stopServer()
 
+##\brief Process method for workers of a ShardedServerObject
+# \param args Arguments to configure the worker
+# \param name Name of the SharedImage to attach to
+# \param lock Lock shared by all writers to the image
+def runShard(args,name,lock):
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+    if args.image:
+        image=SharedImage(filename=args.image,lock=lock)
+    else:
+        image=SharedImage(name=name,lock=lock)
+    server=AsyncServerObject(args,image)
+    try:
+        asyncio.run(server.startShard())
+    finally:
+        if server.capture: server.capture.close()
+
+##\class ShardedServerObject
+# \brief Modbus TCP server spread over several processes
+#
+# All workers accept connections on the same TCP port (SO_REUSEPORT), letting the
+# kernel balance connections between them. Register values are kept in a single
+# SharedImage, so writes through one worker are visible through all of them. The
+# scenario engine runs in the parent process and writes straight to the image.
+class ShardedServerObject():
+    ##\brief Initializes server object
+    # \param args Arguments to configure the object
+    def __init__(self,args):
+        self.args=args
+        self.lock=multiprocessing.Lock()
+        self.image=SharedImage(filename=args.image if args.image else None,create=True,lock=self.lock)
+        self.profile=Profiles.loadProfile(args,args.profile)
+        self.di=SharedDataBlock(self.profile,'di',args.strict,self.image)
+        self.co=SharedDataBlock(self.profile,'co',args.strict,self.image)
+        self.hr=SharedDataBlock(self.profile,'hr',args.strict,self.image)
+        self.ir=SharedDataBlock(self.profile,'ir',args.strict,self.image)
+        path=os.path.dirname(os.path.abspath(Profiles.getProfile(args,args.profile)))
+        self.scenarios=ScenarioEngine(self,args.rate,path)
+        self.workers=[]
+        self.running=False
+        if args.watch: logging.warning('Profile reload is not supported with multiple workers')
+        if args.persist: logging.warning('Persistence is not supported with multiple workers')
+
+    ##\brief Starts the worker processes
+    # \returns True if the workers are running
+    def startServer(self):
+        if self.args.comm!='tcp' or not hasattr(socket,'SO_REUSEPORT'):
+            logging.critical('Multiple workers are only supported for TCP on platforms with SO_REUSEPORT')
+            return False
+        if not Utilities.checkSocket(self.args.host,int(self.args.port)):
+            logging.critical('Could not bind to network interface: '+str(self.args.host)+':'+str(self.args.port))
+            return False
+
+        # Start workers, each with their own capture file
+        logging.info('Starting '+str(self.args.workers)+' server processes')
+        for i in range(self.args.workers):
+            args=argparse.Namespace(**vars(self.args))
+            if args.capture: args.capture+='.'+str(i)
+            worker=multiprocessing.Process(target=runShard,args=(args,self.image.name,self.lock),daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        time.sleep(1)
+        self.running=all(worker.is_alive() for worker in self.workers)
+        if self.running: self.scenarios.start()
+        else: self.stopServer()
+        return self.running
+
+    ##\brief Stops the worker processes
+    def stopServer(self):
+        self.scenarios.stop()
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.workers=[]
+        self.running=False
+        self.image.close()
+
+    ##\brief Wait for server to terminate
+    def waitServer(self):
+        try:
+            while self.running:
+                time.sleep(0.5)
+                if not all(worker.is_alive() for worker in self.workers):
+                    logging.error('Server process terminated unexpectedly')
+                    break
+        except:
+            pass
+        self.stopServer()
+
 if __name__ == "__main__":
     # Parse command line options
     print(App.getAbout('server','CLI server for MODBUS Testing')+'\n')
     serverargs=Loader().serverargs
     print(App.reportConfig(serverargs))
-    server=ServerObject(serverargs)
+    if serverargs.workers>1:
+        server=ShardedServerObject(serverargs)
+    else:
+        server=ServerObject(serverargs)
     if server.startServer():
         server.waitServer()
@@ -0,0 +1,298 @@
+##\package persist
+# \brief Write-ahead persistence of server register values
+#
+# Vegard Fiksdal (C) 2024
+#
+# Register values are kept in a snapshot of all words of the server and a
+# write-ahead log of the ranges written since the snapshot was taken. Writes
+# only mark their ranges as dirty. A background thread commits the current
+# words of all dirty ranges to the log in one go (Group commit), so repeated
+# writes to the same registers between two commits cost a single record. The
+# log is flushed after each commit, and only synced to disk when configured.
+#
+# Periodically, when the log grows large, after a profile reload and when the
+# server stops, a new snapshot is written next to the old one and renamed over
+# it, and a new log is started. Snapshots and logs carry a generation number,
+# and a log is only replayed over the snapshot of the same generation. A crash
+# halfway through a checkpoint thus leaves either the old snapshot and log, or
+# the new snapshot and no valid log.
+#
+# Snapshot file (PATH.snap):
+#   Header:    magic 'MBTS' (4 bytes), version (uint8), generation (uint32), time (float64, Seconds since epoch)
+#   Datablock: count (uint32), count addresses (uint32), count words (uint16), for each of di, co, hr and ir
+#   Trailer:   crc32 of all preceding bytes (uint32)
+#
+# Write-ahead log (PATH.wal):
+#   Header:    magic 'MBTW' (4 bytes), version (uint8), generation (uint32)
+#   Record:    crc32 (uint32, Of the rest of the record), datablock (uint8, Index in di, co, hr, ir),
+#              address (uint32), count (uint16), count words (uint16)
+#
+# Addresses are the server side addresses, ie. the ones used as keys in the
+# profile. All values are little endian. Replay stops at the first incomplete or
+# corrupt record, as left by a crash in the middle of a commit.
+#
+# The log is kept open and exclusively locked (Where the platform supports it)
+# for as long as the journal is in use, so a second server given the same path
+# fails instead of overwriting the files of the first one.
+#
+import struct,threading,time,os,zlib,array
+try:
+    import fcntl
+except ImportError:
+    fcntl=None
+from common import *
+
+##\class Journal
+# \brief Persists the register values of a server in a snapshot and a write-ahead log
+class Journal():
+    ## Datablocks in the order they are stored
+    datablocks=['di','co','hr','ir']
+
+    ## Snapshot header layout
+    snapheader=struct.Struct('<4sBId')
+
+    ## Log header layout
+    logheader=struct.Struct('<4sBI')
+
+    ## Log record header layout
+    record=struct.Struct('<IBIH')
+
+    ## Size of the log in bytes at which a checkpoint is made
+    maxlog=16*1024*1024
+
+    ##\brief Initializes journal
+    # \param server Server object with di, co, hr and ir datablocks, and the profile
+    # \param path Path of the journal, the files are named PATH.snap and PATH.wal
+    # \param fsync Set to true to sync the log to disk after every commit
+    # \param interval Time between commits in seconds
+    # \param period Time between checkpoints in seconds
+    def __init__(self,server,path,fsync=False,interval=0.1,period=300):
+        self.server=server
+        self.snapname=path+'.snap'
+        self.logname=path+'.wal'
+        self.fsync=fsync
+        self.interval=interval
+        self.period=period
+        self.lock=threading.Lock()
+        self.iolock=threading.Lock()
+        self.dirty={datablock:{} for datablock in Journal.datablocks}
+        self.generation=0
+        self.fd=None
+        self.checkpointed=time.monotonic()
+        self.commits=0
+        self.records=0
+        self.subscriptions=[]
+        self.running=False
+        self.thread=None
+
+    ##\brief Lock the journal, restore register values from the snapshot and log, and start a new generation
+    # \return True if restored, False if the journal is in use by another process
+    #
+    # Addresses no longer present in the profile are ignored. The values of the
+    # profile are updated to match the restored registers. Writes are logged from
+    # here on, and committed once start() is called.
+    def restore(self):
+        self.fd=open(self.logname,'a+b')
+        if fcntl:
+            try:
+                fcntl.flock(self.fd.fileno(),fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except OSError:
+                self.fd.close()
+                self.fd=None
+                logging.critical('Persisted register values in '+self.logname+' are in use by another process')
+                return False
+        words={datablock:{} for datablock in Journal.datablocks}
+        snapshot=self.readSnapshot(words)
+        records=0
+        if snapshot!=None:
+            self.generation=snapshot
+            records=self.readLog(words)
+        count=0
+        for datablock in Journal.datablocks:
+            store=getattr(self.server,datablock)
+            changes=[(address,[words[datablock][address]]) for address in words[datablock] if store.validate(address)]
+            store.setMany(changes)
+            count+=len(changes)
+        if snapshot!=None:
+            logging.info('Restored '+str(count)+' register words from '+self.snapname+' and '+str(records)+' log records')
+            self.updateProfile()
+        self.checkpoint()
+        for datablock in Journal.datablocks:
+            self.subscriptions.append((datablock,getattr(self.server,datablock).subscribeWrites(self.onWrite)))
+        return True
+
+    ##\brief Read the snapshot
+    # \param words Dictionary of datablock to dictionary of address to word, to fill in
+    # \return Generation of the snapshot, or None if there is no valid snapshot
+    def readSnapshot(self,words):
+        try:
+            with open(self.snapname,'rb') as fd: data=fd.read()
+        except OSError:
+            return None
+        if len(data)<Journal.snapheader.size+4 or zlib.crc32(data[:-4])!=struct.unpack_from('<I',data,len(data)-4)[0]:
+            logging.error('Ignoring corrupt snapshot: '+self.snapname)
+            return None
+        magic,version,generation,timestamp=Journal.snapheader.unpack_from(data)
+        if magic!=b'MBTS' or version!=1:
+            logging.error('Ignoring incompatible snapshot: '+self.snapname)
+            return None
+        offset=Journal.snapheader.size
+        for datablock in Journal.datablocks:
+            count=struct.unpack_from('<I',data,offset)[0]
+            offset+=4
+            addresses=struct.unpack_from('<%dI' % count,data,offset)
+            offset+=4*count
+            values=struct.unpack_from('<%dH' % count,data,offset)
+            offset+=2*count
+            words[datablock].update(zip(addresses,values))
+        return generation
+
+    ##\brief Replay the log of the current generation
+    # \param words Dictionary of datablock to dictionary of address to word, to update
+    # \return Number of records replayed
+    def readLog(self,words):
+        self.fd.seek(0)
+        data=self.fd.read()
+        if len(data)<Journal.logheader.size: return 0
+        magic,version,generation=Journal.logheader.unpack_from(data)
+        if magic!=b'MBTW' or version!=1 or generation!=self.generation: return 0
+        offset=Journal.logheader.size
+        records=0
+        while offset<len(data):
+            if offset+Journal.record.size>len(data): break
+            crc,index,address,count=Journal.record.unpack_from(data,offset)
+            end=offset+Journal.record.size+2*count
+            if end>len(data) or index>=len(Journal.datablocks) or zlib.crc32(data[offset+4:end])!=crc: break
+            values=struct.unpack_from('<%dH' % count,data,offset+Journal.record.size)
+            words[Journal.datablocks[index]].update(zip(range(address,address+count),values))
+            offset=end
+            records+=1
+        if offset<len(data):
+            logging.warning('Discarded '+str(len(data)-offset)+' bytes of incomplete records at the end of '+self.logname)
+        return records
+
+    ##\brief Update the values of the profile from the datablocks
+    def updateProfile(self):
+        for datablock in Journal.datablocks:
+            store=getattr(self.server,datablock)
+            registers=self.server.profile['datablocks'][datablock]
+            for key in registers:
+                register=registers[key]
+                count=Registers.registersPerValue(register)
+                if store.validate(int(key),count):
+                    register['value']=Registers.decodeRegister(register,store.snapshot(int(key),count))
+
+    ##\brief Write subscription marking the written ranges as dirty
+    # \param datablock Name of datablock
+    # \param changes List of (address,values) tuples
+    def onWrite(self,datablock,changes):
+        with self.lock:
+            dirty=self.dirty[datablock]
+            for address,values in changes:
+                count=len(values) if isinstance(values,list) else 1
+                if dirty.get(address,0)<count: dirty[address]=count
+
+    ##\brief Take the dirty ranges
+    # \return Dictionary of datablock to dictionary of address to count
+    def takeDirty(self):
+        with self.lock:
+            dirty=self.dirty
+            self.dirty={datablock:{} for datablock in Journal.datablocks}
+        return dirty
+
+    ##\brief Append the current words of all dirty ranges to the log
+    # \return Number of records written
+    def commit(self):
+        with self.iolock:
+            dirty=self.takeDirty()
+            parts=[]
+            for index in range(len(Journal.datablocks)):
+                store=getattr(self.server,Journal.datablocks[index])
+                for address,count in dirty[Journal.datablocks[index]].items():
+                    if not store.validate(address,count): continue
+                    body=struct.pack('<BIH',index,address,count)+array.array('H',[int(value)&0xFFFF for value in store.snapshot(address,count)]).tobytes()
+                    parts.append(struct.pack('<I',zlib.crc32(body))+body)
+            if len(parts) and self.fd:
+                self.fd.write(b''.join(parts))
+                self.fd.flush()
+                if self.fsync: os.fsync(self.fd.fileno())
+                self.commits+=1
+                self.records+=len(parts)
+            return len(parts)
+
+    ##\brief Write a snapshot of all registers and start a new log
+    def checkpoint(self):
+        with self.iolock:
+            # Writes marked dirty from here on are logged in the new generation
+            self.takeDirty()
+            generation=self.generation+1
+            parts=[Journal.snapheader.pack(b'MBTS',1,generation,time.time())]
+            for datablock in Journal.datablocks:
+                store=getattr(self.server,datablock)
+                addresses,words=[],[]
+                with store.atomic():
+                    for address,count in Journal.getRuns(sorted(store.values)):
+                        addresses.extend(range(address,address+count))
+                        words.extend(int(value)&0xFFFF for value in store.load(address,count))
+                parts.append(struct.pack('<I',len(addresses))+array.array('I',addresses).tobytes()+array.array('H',words).tobytes())
+            data=b''.join(parts)
+            data+=struct.pack('<I',zlib.crc32(data))
+
+            # Replace the snapshot, then start the log of the new generation
+            with open(self.snapname+'.tmp','wb') as fd:
+                fd.write(data)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(self.snapname+'.tmp',self.snapname)
+            self.fd.seek(0)
+            self.fd.truncate()
+            self.fd.write(Journal.logheader.pack(b'MBTW',1,generation))
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            self.generation=generation
+            self.checkpointed=time.monotonic()
+
+    ##\brief Group sorted addresses into contiguous runs
+    # \param addresses Sorted list of addresses
+    # \return List of (address,count) tuples
+    def getRuns(addresses):
+        runs=[]
+        for address in addresses:
+            if len(runs) and runs[-1][0]+runs[-1][1]==address:
+                runs[-1][1]+=1
+            else:
+                runs.append([address,1])
+        return runs
+
+    ##\brief Thread method committing and checkpointing
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            try:
+                self.commit()
+                if time.monotonic()-self.checkpointed>self.period or self.fd.tell()>Journal.maxlog:
+                    self.checkpoint()
+            except OSError as error:
+                logging.error('Failed to persist register values: '+str(error))
+
+    ##\brief Starts committing logged writes in a background thread
+    def start(self):
+        self.running=True
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    ##\brief Stops logging, and writes a final snapshot
+    def stop(self):
+        if not self.fd: return
+        for datablock,subscription in self.subscriptions:
+            getattr(self.server,datablock).unsubscribe(subscription)
+        self.subscriptions=[]
+        self.running=False
+        if self.thread:
+            self.thread.join()
+            self.thread=None
+        self.checkpoint()
+        if self.fd:
+            self.fd.close()
+            self.fd=None
+        logging.info('Persisted register values with '+str(self.records)+' records in '+str(self.commits)+' commits')
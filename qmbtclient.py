@@ -74,91 +74,154 @@ class DeviceIdFrame(QFrame):
 
 ##\class CustomClientFrame
 # \brief Frame to send and receive custom MODBUS requests to device
+#
+# Requests are executed by a RequestEngine in a background thread, and any
+# number of registers or bits may be requested. Progress and results are picked
+# up by a timer in the UI thread.
 class CustomClientFrame(QFrame):
+    ## Function codes in the order of the function list
+    functions=[1,2,3,4,5,6,15,16]
+
+    ## Data types registers read can be decoded as
+    dtypes=['uint16','int16','uint32','int32','float16','float32','float64']
+
     def __init__(self,worker):
         super().__init__()
         self.worker=worker
         self.client=worker.client.client
         self.args=worker.client.args
+        self.engine=RequestEngine(self.client)
+        self.thread=None
+        self.progress=(0,0)
+        self.result=None
         self.deviceid=QSpinBox()
         self.function=QComboBox()
         self.address=QSpinBox()
         self.count=QSpinBox()
+        self.values=QLineEdit()
+        self.dtype=QComboBox()
         self.border=QComboBox()
         self.worder=QComboBox()
         self.log=QListWidget()
-        button=QPushButton('Execute')
+        self.progressbar=QProgressBar()
+        self.button=QPushButton('Execute')
+        self.cancel=QPushButton('Cancel')
         layout=QVBoxLayout()
         layout.addWidget(LabeledControl('Device ID',self.deviceid))
         layout.addWidget(LabeledControl('Function',self.function))
         layout.addWidget(LabeledControl('Address',self.address))
         layout.addWidget(LabeledControl('Count',self.count))
+        layout.addWidget(LabeledControl('Values to write',self.values))
+        layout.addWidget(LabeledControl('Data type',self.dtype))
         layout.addWidget(LabeledControl('Word order',self.worder))
         layout.addWidget(LabeledControl('Byte order',self.border))
-        layout.addWidget(LabeledControl('',button))
+        layout.addWidget(LabeledControl('',self.button))
+        layout.addWidget(self.progressbar)
+        layout.addWidget(LabeledControl('',self.cancel))
         layout.addWidget(self.log,1)
         self.deviceid.setRange(0,248)
         self.deviceid.setValue(self.args.deviceid)
-        self.address.setRange(0,65536)
+        self.address.setRange(0,65535)
         self.address.setValue(1)
-        self.count.setRange(1,16)
+        self.count.setRange(1,65536)
         self.count.setValue(1)
-        self.function.addItem('01 - Read Coils')
-        self.function.addItem('02 - Read Discrete Inputs')
-        self.function.addItem('03 - Read Holding Registers')
-        self.function.addItem('04 - Read Input Registers')
-        self.function.addItem('05 - Write single Coil')
-        self.function.addItem('06 - Write single Register')
-        self.function.addItem('15 - Write multiple Coils')
-        self.function.addItem('16 - Write multiple Registers')
+        for function in CustomClientFrame.functions:
+            self.function.addItem('%02d - %s' % (function,RequestEngine.functions[function]))
         self.function.setCurrentIndex(2)
+        self.values.setPlaceholderText('Comma separated values')
+        for dtype in CustomClientFrame.dtypes: self.dtype.addItem(dtype)
         self.border.addItem('Little endian')
         self.border.addItem('Big endian')
         self.worder.addItem('Little endian')
         self.worder.addItem('Big endian')
         self.log.setFont(QFont('cascadia mono'))
-        button.clicked.connect(self.Execute)
+        self.cancel.setEnabled(False)
+        self.button.clicked.connect(self.Execute)
+        self.cancel.clicked.connect(self.engine.cancel)
+        self.timer=QTimer()
+        self.timer.timeout.connect(self.process)
         self.setLayout(layout)
 
+    ##\brief Start executing the request in a background thread
     def Execute(self):
-        self.worker.setPaused(True)
+        if self.thread: return
         self.log.clear()
-        deviceid=self.deviceid.value()
+        function=CustomClientFrame.functions[self.function.currentIndex()]
         address=self.address.value()#+self.args.offset
-        count=self.count.value()
-        response=None
-        if self.border.currentIndex()==0:
-            border='<'
-        else:
-            border='>'
-        if self.worder.currentIndex()==0:
-            worder='<'
-        else:
-            worder='>'
+        count=min(self.count.value(),65536-address)
+        values=None
+        if function in [5,6,15,16]:
+            try:
+                values=[int(value,0) for value in self.values.text().split(',')]
+            except ValueError:
+                self.log.addItem('Error: Invalid values to write')
+                return
+            if function in [5,15]: values=[value!=0 for value in values]
+            if function in [5,6]: values=values[:1]
+        self.progress=(0,0)
+        self.result=None
+        self.button.setEnabled(False)
+        self.cancel.setEnabled(True)
+        self.worker.setPaused(True)
+        self.thread=threading.Thread(target=self.run,args=(function,self.deviceid.value(),address,count,values),daemon=True)
+        self.thread.start()
+        self.timer.start(100)
+
+    ##\brief Thread method executing the request
+    # \param function Function code
+    # \param deviceid Device ID (Unit id)
+    # \param address First protocol address
+    # \param count Number of registers or bits to read
+    # \param values List of values to write
+    def run(self,function,deviceid,address,count,values):
         try:
-            if self.function.currentIndex()==0: response=self.client.read_coils(address,count,deviceid)
-            if self.function.currentIndex()==1: response=self.client.read_discrete_inputs(address,count,deviceid)
-            if self.function.currentIndex()==2: response=self.client.read_holding_registers(address,count,deviceid)
-            if self.function.currentIndex()==3: response=self.client.read_input_registers(address,count,deviceid)
-        except ModbusException as exc:
-            self.log.addItem('Exception: '+str(exc))
-            response=None
-        if response!=None and (response.isError() or isinstance(response, ExceptionResponse)):
-            self.log.addItem('Error: '+str(response))
-            response=None
-        if response!=None:
-            # Do something
-            if self.function.currentIndex()==0 or self.function.currentIndex()==1:
-                for i in range(count):
-                    self.log.addItem('Read address '+str(address)+': '+str(response.bits[i]))
-                    address+=1
-            if self.function.currentIndex()==2 or self.function.currentIndex()==3:
-                decoder = BinaryPayloadDecoder.fromRegisters(response.registers, byteorder=border, wordorder=worder)
-                for register in response.registers:
-                    self.log.addItem('Read address '+str(address)+': '+str(decoder.decode_16bit_uint()))
-                    address+=1
-
-
+            output,errors=self.engine.execute(function,deviceid,address,count,values,self.setProgress)
+        except Exception as exc:
+            output,errors={},[(address,count,str(exc))]
+        self.result=(function,output,errors)
+
+    ##\brief Progress callback from the request engine
+    # \param done Number of requests executed
+    # \param total Total number of requests
+    def setProgress(self,done,total):
+        self.progress=(done,total)
+
+    ##\brief Timer event to update progress and show results in UI thread
+    def process(self):
+        done,total=self.progress
+        self.progressbar.setValue(int(done*100/total) if total else 0)
+        self.progressbar.setFormat('Executed %d of %d requests' % (done,total))
+        if self.result==None: return
+        self.timer.stop()
+        self.thread.join()
+        self.thread=None
+        function,output,errors=self.result
+        border='<' if self.border.currentIndex()==0 else '>'
+        worder='<' if self.worder.currentIndex()==0 else '>'
+        addresses=sorted(output)
+        items=[]
+        for start,length,error in errors:
+            items.append('Error: '+str(length)+' items at address '+str(start)+': '+error)
+        if function in [5,6,15,16]:
+            for address in addresses: items.append('Wrote address '+str(address)+': '+str(output[address]))
+        elif function in [1,2]:
+            for address in addresses: items.append('Read address '+str(address)+': '+str(output[address]))
+        else:
+            # Decode consecutive words as values of the chosen type
+            register={'dtype':CustomClientFrame.dtypes[self.dtype.currentIndex()],'bo':border,'wo':worder}
+            size=Registers.registersPerValue(register)
+            i=0
+            while i<len(addresses):
+                words=[output[address] for address in addresses[i:i+size]]
+                if len(words)<size or addresses[i]+size-1!=addresses[i+size-1]:
+                    items.append('Read address '+str(addresses[i])+': '+str(words[0])+' (Incomplete '+register['dtype']+')')
+                    i+=1
+                else:
+                    items.append('Read address '+str(addresses[i])+': '+str(Registers.decodeRegister(register,words)))
+                    i+=size
+        self.log.addItems(items)
+        self.button.setEnabled(True)
+        self.cancel.setEnabled(False)
         self.worker.setPaused(False)
 
 
@@ -170,22 +233,12 @@ class ClientTableFrame(QFrame):
     # \param datablock Name of datablock (di, co, hr or ir)
     def __init__(self,worker,datablock):
         super().__init__()
-        self.tablewidget=QTableWidget()
-        self.tablewidget.verticalHeader().setVisible(False)
-        self.tablewidget.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        self.tablewidget.setSelectionBehavior(QAbstractItemView.SelectRows)
-        self.tablewidget.setEditTriggers(QAbstractItemView.NoEditTriggers)
-        self.tablewidget.cellDoubleClicked.connect(self.doubleClicked)
-        layout=QVBoxLayout()
-        layout.addWidget(self.tablewidget,1)
-        self.setLayout(layout)
-        Utilities.setMargins(layout)
         self.datablock=datablock
         self.worker=worker
 
         # Populate table
         registers=worker.client.profile['datablocks'][datablock]
-        self.table=[]
+        table=[]
         for register in registers:
             row=[]
             row.append(registers[register]['dsc'])
@@ -193,33 +246,32 @@ class ClientTableFrame(QFrame):
             row.append(registers[register]['rtype'].upper())
             row.append(register)
             row.append('')
-            self.table.append(row)
-        self.tablewidget.setColumnCount(5)
-        self.tablewidget.setRowCount(len(self.table))
-        self.tablewidget.setHorizontalHeaderItem(0,QTableWidgetItem('Description'))
-        self.tablewidget.setHorizontalHeaderItem(1,QTableWidgetItem('Type'))
-        self.tablewidget.setHorizontalHeaderItem(2,QTableWidgetItem('Access'))
-        self.tablewidget.setHorizontalHeaderItem(3,QTableWidgetItem('Address'))
-        self.tablewidget.setHorizontalHeaderItem(4,QTableWidgetItem('Value'))
-        for i in range(len(self.table)):
-            for j in range(len(self.table[i])):
-                self.tablewidget.setItem(i,j,QTableWidgetItem(str(self.table[i][j])))
+            table.append(row)
+        self.model=RegisterTableModel(['Description','Type','Access','Address','Value'],table,3,4)
+        self.tableview=RegisterTableView(self.model)
+        self.tableview.doubleClicked.connect(self.doubleClicked)
+        layout=QVBoxLayout()
+        layout.addWidget(self.tableview,1)
+        self.setLayout(layout)
+        Utilities.setMargins(layout)
 
     ##\brief Update read/write value
     # \param datablock Datablock to update
     # \param address Register address that has changed
     # \param value New register value
+    #
+    # The view is not refreshed before updateUI() is called
     def update(self,datablock,address,value):
-        for j in range(len(self.table)):
-            if self.table[j][3]==str(address):
-                self.tablewidget.setItem(j,4,QTableWidgetItem(str(value)))
-                break
+        self.model.setValue(address,value)
+
+    ##\brief Refresh view with all values changed since last call
+    def updateUI(self):
+        self.model.flush()
 
     ##\brief Event handler for double-clicks. Opens a dialog to write a register value
-    # \param row The clicked row
-    # \param column The clicked column (Not used)
-    def doubleClicked(self,row,column):
-        address=self.table[row][3]
+    # \param index The clicked model index
+    def doubleClicked(self,index):
+        address=self.model.getAddress(index.row())
         register=self.worker.client.profile['datablocks'][self.datablock][address]
         if register['rtype'].upper()=='R':
             resp=QMessageBox.question(self,'Confirmation','This value is marked read-only.\n\nDo you want to try overwriting it anyway?')
@@ -263,8 +315,7 @@ class ClientUI(QMainWindow):
             self.conframe.addText(line)
 
         # Prepare update mechanism
-        self.lock=threading.Lock()
-        self.updates=[]
+        self.bus=UpdateBus()
 
         # Add statusbar
         self.statusbar=QStatusBar()
@@ -373,6 +424,8 @@ class ClientUI(QMainWindow):
     def closeEvent(self, event):
         self.timer.stop()
         logging.info('Shutting down connection')
+        self.customframe.engine.cancel()
+        if self.customframe.thread: self.customframe.thread.join()
         if self.worker: self.worker.close()
         if self.client: self.client.close()
         super().close()
@@ -397,19 +450,21 @@ class ClientUI(QMainWindow):
     #
     # UI is only updated from Process() as that runs in UI thread
     def update(self,datablock,address,value):
-        with self.lock:
-            self.updates.append([datablock,address,value])
+        self.bus.put(datablock,address,value)
 
     ##\brief Timer event to update status and tranceivers in UI thread
     def process(self):
         # Update UI
-        with self.lock:
-            for update in self.updates:
-                if update[0]=='di': self.table_di.update(update[0],update[1],update[2])
-                if update[0]=='co': self.table_co.update(update[0],update[1],update[2])
-                if update[0]=='hr': self.table_hr.update(update[0],update[1],update[2])
-                if update[0]=='ir': self.table_ir.update(update[0],update[1],update[2])
-                self.logging.update(update[0],update[1],update[2])
+        for (datablock,address),value in self.bus.take().items():
+            if datablock=='di': self.table_di.update(datablock,address,value)
+            if datablock=='co': self.table_co.update(datablock,address,value)
+            if datablock=='hr': self.table_hr.update(datablock,address,value)
+            if datablock=='ir': self.table_ir.update(datablock,address,value)
+            self.logging.update(datablock,address,value)
+        self.table_di.updateUI()
+        self.table_co.updateUI()
+        self.table_hr.updateUI()
+        self.table_ir.updateUI()
 
         # Update status bar
         icount,rcount,wcount,duration,iprg,rprg=self.worker.getStatus()
@@ -10,6 +10,12 @@ class ProxyUI(ServerUI):
         super().__init__(serverargs,aboutstring,False)
         self.setWindowTitle(App.getTitle('proxy'))
         self.hide()
+        self.proxy=None
+
+        # Show the staleness of the prefetched registers next to the counters
+        self.status_stale=QLineEdit()
+        self.status_stale.setEnabled(False)
+        self.statusbar.insertWidget(3,self.status_stale)
 
         # Try to connect with dialog
         self.worker=None
@@ -36,37 +42,29 @@ class ProxyUI(ServerUI):
         for line in App.reportConfig(clientargs).split('\n'):
             self.conframe.addText(line)
 
-        # Temporarily load worker to read current values
-        self.worker=ClientWorker(self.client)
-        self.worker.addReadCallback(self.updateWrite)
-        self.worker.addCompletedCallback(self.updateComplete)
-        self.worker.start()
-
-        # Bind server and client
+        # Bind server and client, and read current values with block reads
         self.proxy=ProxyObject(self.server,self.client)
+        self.worker=threading.Thread(target=self.updateComplete)
+        self.worker.start()
         self.showMaximized()
 
-    ##\brief Update read/write value
-    # \param datablock Datablock containing register
-    # \param address Register address that has changed
-    # \param value New register value
-    # \return Original value
-    def updateWrite(self,datablock,address,value):
-        value=Registers.encodeRegister(self.client.profile['datablocks'][datablock][str(address)],value)
-        if datablock=='di': self.table_di.updateWrite(datablock,address,value)
-        if datablock=='co': self.table_co.updateWrite(datablock,address,value)
-        if datablock=='hr': self.table_hr.updateWrite(datablock,address,value)
-        if datablock=='ir': self.table_ir.updateWrite(datablock,address,value)
-
-    ##\brief Close worker after initial read
+    ##\brief Read initial values from the upstream device
     def updateComplete(self):
-        logging.info('Read initial server values')
-        self.worker.running=False
+        count=self.proxy.prefetcher.refresh()
+        logging.info('Read initial server values ('+str(count)+' of '+str(len(self.proxy.prefetcher.blocks))+' blocks)')
+
+    ##\brief Timer event to update status and tranceivers
+    def process(self):
+        super().process()
+        if self.proxy:
+            summary=self.proxy.prefetcher.getSummary()
+            oldest='-' if summary['oldest']==None else '%.1fs' % summary['oldest']
+            self.status_stale.setText('Oldest: %s, Stale: %d, Unread: %d' % (oldest,summary['stale'],summary['unread']))
 
     ##\brief Stop background processes upon terminating the application
     # \param event Not used
     def closeEvent(self, event):
-        if self.worker: self.worker.close()
+        if self.worker: self.worker.join()
         if self.client: self.client.close()
         super().closeEvent(event)
 
@@ -22,29 +22,17 @@ class ServerTableFrame(QFrame):
     # \param datablock Name of datablock (di, co, hr or ir)
     def __init__(self,server,datablock):
         super().__init__()
-        self.tablewidget=QTableWidget()
-        self.tablewidget.verticalHeader().setVisible(False)
-        self.tablewidget.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        self.tablewidget.setSelectionBehavior(QAbstractItemView.SelectRows)
-        self.tablewidget.setEditTriggers(QAbstractItemView.NoEditTriggers)
-        self.tablewidget.cellDoubleClicked.connect(self.doubleClicked)
-        layout=QVBoxLayout()
-        layout.addWidget(self.tablewidget,1)
-        self.setLayout(layout)
-        Utilities.setMargins(layout)
-
         self.datablock=datablock
         self.server=server
-        self.updates=[]
-        self.rcount=0
-        self.wcount=0
+        self.bus=UpdateBus()
 
-        getattr(self.server,self.datablock).addWriteCallback(self.updateWrite)
-        getattr(self.server,self.datablock).addReadCallback(self.updateRead)
+        # Reads are only counted, so they are not slowed down by callbacks
+        getattr(self.server,self.datablock).subscribeWrites(self.updateBatch)
+        getattr(self.server,self.datablock).enableCounters()
 
         # Populate table
         registers=server.profile['datablocks'][datablock]
-        self.table=[]
+        table=[]
         for register in registers:
             column=[]
             column.append(registers[register]['dsc'])
@@ -52,20 +40,20 @@ class ServerTableFrame(QFrame):
             column.append(registers[register]['rtype'].upper())
             column.append(register)
             column.append(registers[register]['value'])
-            self.table.append(column)
-        self.tablewidget.setColumnCount(5)
-        self.tablewidget.setRowCount(len(self.table))
-        self.tablewidget.setHorizontalHeaderItem(0,QTableWidgetItem('Description'))
-        self.tablewidget.setHorizontalHeaderItem(1,QTableWidgetItem('Type'))
-        self.tablewidget.setHorizontalHeaderItem(2,QTableWidgetItem('Access'))
-        self.tablewidget.setHorizontalHeaderItem(3,QTableWidgetItem('Address'))
-        self.tablewidget.setHorizontalHeaderItem(4,QTableWidgetItem('Value'))
-        for i in range(len(self.table)):
-            for j in range(len(self.table[i])):
-                self.tablewidget.setItem(i,j,QTableWidgetItem(str(self.table[i][j])))
+            table.append(column)
+        self.model=RegisterTableModel(['Description','Type','Access','Address','Value'],table,3,4)
+        self.tableview=RegisterTableView(self.model)
+        self.tableview.doubleClicked.connect(self.doubleClicked)
+        layout=QVBoxLayout()
+        layout.addWidget(self.tableview,1)
+        self.setLayout(layout)
+        Utilities.setMargins(layout)
 
+    ##\brief Get register count and number of reads and writes
+    # \return Tuple of number of registers, reads and writes
     def getStatus(self):
-        return len(self.table)-1,self.rcount,self.wcount
+        datablock=getattr(self.server,self.datablock)
+        return self.model.rowCount()-1,datablock.reads,datablock.writes
 
     ##\brief Update read/write value
     # \param datablock Datablock containing register
@@ -73,43 +61,45 @@ class ServerTableFrame(QFrame):
     # \param value New register value
     # \return Original value
     #
-    # This method only tags the changed value. The actual UI will be updated later on
-    # the main UI thread -- See UpdateUI().
+    # This method only posts the changed value to the update bus. The actual UI will
+    # be updated later on the main UI thread -- See updateUI().
     def updateWrite(self,datablock,address,value):
-        self.updates.append([address,value])
-        self.wcount+=1
+        self.bus.put(datablock,address,value)
         return value
 
-    ##\brief Update read/write value
-    # \param datablock Datablock containing register
-    # \param address Register address that has changed
-    # \param value New register value
-    # \return Original value
-    def updateRead(self,datablock,address,value):
-        self.rcount+=1
-        return value
+    ##\brief Update values changed by a batched write
+    # \param datablock Datablock containing registers
+    # \param changes List of (address,values) tuples
+    def updateBatch(self,datablock,changes):
+        for address,values in changes:
+            self.updateWrite(datablock,address,values)
 
     ##\brief Update UI controls
     #
     # This method updated the UI according to the register changes tracked by Update()
     def updateUI(self):
-        updates=self.updates
-        self.updates=[]
-        for i in range(len(updates)):
-            address=updates[i][0]
-            value=updates[i][1]
-            for j in range(len(self.table)):
-                if self.table[j][3]==str(address):
-                    register=self.server.profile['datablocks'][self.datablock][str(address)]
-                    value=Registers.decodeRegister(register,value)
-                    self.tablewidget.setItem(j,4,QTableWidgetItem(str(value)))
+        registers=self.server.profile['datablocks'][self.datablock]
+        for (datablock,address),values in self.bus.take().items():
+            # A single write may span several registers
+            if not isinstance(values,list): values=[values]
+            offset=0
+            while offset<len(values):
+                key=str(address+offset)
+                if key in registers:
+                    register=registers[key]
+                    count=Registers.registersPerValue(register)
+                    value=Registers.decodeRegister(register,values[offset:offset+count])
+                    self.model.setValue(key,value)
                     register['value']=value
+                    offset+=count
+                else:
+                    offset+=1
+        self.model.flush()
 
     ##\brief Event handler for double-clicks. Opens a dialog to write a register value
-    # \param row The clicked row
-    # \param column The clicked column (Not used)
-    def doubleClicked(self,row,column):
-        address=self.table[row][3]
+    # \param index The clicked model index
+    def doubleClicked(self,index):
+        address=self.model.getAddress(index.row())
         register=self.server.profile['datablocks'][self.datablock][address]
         dialog=SetValue('Change register',register)
         if dialog.exec_()!=0:
@@ -199,7 +189,7 @@ class ServerUI(QMainWindow):
         # Use a timer to process data from the queue
         self.timer=QTimer()
         self.timer.timeout.connect(self.process)
-        self.timer.start(100)
+        self.timer.start(250)
 
         # Show window
         layout=QVBoxLayout()
@@ -0,0 +1,268 @@
+##\package scenario
+# \brief Scripted register values for MODBUS servers
+#
+# Vegard Fiksdal (C) 2024
+#
+# Registers in a profile may hold a scenario describing how its value changes
+# over time, eg:
+#
+#   "10": {"dsc":"Temperature","dtype":"float32","value":20,
+#          "scenario":{"type":"sine","offset":20,"amplitude":5,"period":60,"interval":0.1}}
+#
+# Supported types and their parameters (All times in seconds):
+#   ramp    min, max, period          Sawtooth from min to max
+#   sine    offset, amplitude, period, phase (Degrees)
+#   noise   mean, stddev              Gaussian noise around mean
+#   step    values, duration          Cycles through a list of values
+#   replay  file, column, duration    Cycles through a column of a CSV file (Eg. from the client logger)
+#
+# All types accept an interval, which is the time between updates. It defaults
+# to the tick of the scenario engine.
+#
+import math,random,time,threading,csv,struct
+from common import *
+
+##\class Scenarios
+# \brief Builds value generators from scenario descriptions
+#
+# Scenarios are described by their kind and a tuple of parameters, so the engine
+# can evaluate all scenarios of a kind in one pass over their parameters.
+class Scenarios():
+    ## Struct format of the datatypes encoded in bulk, and the function casting values to them
+    formats={'float16':('e',float),'float32':('f',float),'float64':('d',float),'float':('f',float),'double':('d',float),
+             'uint32':('I',int),'uint16':('H',int),'uint8':('B',int),'int32':('i',int),'int16':('h',int),'int8':('b',int),
+             'word':('h',int),'int':('i',int)}
+
+    ##\brief Get the kind and parameters of the scenario of a register
+    # \param register Register profile with a scenario
+    # \param path Directory to resolve relative file names against
+    # \param cache Dictionary of already loaded replay files
+    # \return Tuple of kind (ramp, sine, noise or sequence) and parameters
+    def createParameters(register,path='',cache=None):
+        if cache==None: cache={}
+        scenario=register['scenario']
+        stype=scenario.get('type','')
+        value=register['value']
+        if isinstance(value,str) or isinstance(value,bool): value=0
+        if stype=='ramp':
+            low=float(scenario.get('min',0))
+            high=float(scenario.get('max',100))
+            period=float(scenario.get('period',60))
+            return 'ramp',(low,high-low,period)
+        if stype=='sine':
+            offset=float(scenario.get('offset',value))
+            amplitude=float(scenario.get('amplitude',1))
+            omega=2*math.pi/float(scenario.get('period',60))
+            phase=math.radians(float(scenario.get('phase',0)))
+            return 'sine',(offset,amplitude,omega,phase)
+        if stype=='noise':
+            mean=float(scenario.get('mean',value))
+            stddev=float(scenario.get('stddev',1))
+            return 'noise',(mean,stddev)
+        if stype=='step':
+            return 'sequence',Scenarios.createSequence(register,scenario['values'],float(scenario.get('duration',1)))
+        if stype=='replay':
+            filename=scenario['file']
+            if not os.path.isabs(filename): filename=os.path.join(path,filename)
+            column=scenario.get('column',1)
+            key=(filename,str(column))
+            if not key in cache:
+                cache[key]=Scenarios.loadColumn(filename,column)
+            return 'sequence',Scenarios.createSequence(register,cache[key],float(scenario.get('duration',1)))
+        raise Exception('Unknown scenario type: '+str(stype))
+
+    ##\brief Create the parameters of a sequence of values
+    # \param register Register profile
+    # \param values List of values
+    # \param duration Time in seconds to hold each value
+    # \return Tuple of the list of encoded values, and duration
+    #
+    # The values are encoded up front, so cycling through them costs nothing but a lookup.
+    def createSequence(register,values,duration):
+        if len(values)==0: raise Exception('Empty scenario sequence')
+        return [Registers.encodeRegister(register,Registers.castRegister(register,value)) for value in values],duration
+
+    ##\brief Evaluate a number of scenarios of the same kind
+    # \param kind Kind of scenarios (ramp, sine, noise or sequence)
+    # \param parameters List of parameters, one tuple per scenario
+    # \param t Elapsed time in seconds
+    # \return List of values, or encoded values for sequences
+    def evaluate(kind,parameters,t):
+        if kind=='ramp': return [low+span*((t%period)/period) for low,span,period in parameters]
+        if kind=='sine': return [offset+amplitude*math.sin(omega*t+phase) for offset,amplitude,omega,phase in parameters]
+        if kind=='noise': return [random.gauss(mean,stddev) for mean,stddev in parameters]
+        if kind=='sequence': return [values[int(t/duration)%len(values)] for values,duration in parameters]
+
+    ##\brief Create a function encoding values for registers of the same datatype and endianness
+    # \param register Register profile
+    # \return Function taking a list of values and returning a list of words per value
+    #
+    # Numeric datatypes are cast and packed with a single struct call for all the
+    # values, giving the same words as Registers.encodeRegister(). Other datatypes
+    # are encoded one value at a time.
+    def createEncoder(register):
+        if not register['dtype'] in Scenarios.formats:
+            return lambda values: [Registers.encodeRegister(register,Registers.castRegister(register,value)) for value in values]
+        fmt,cast=Scenarios.formats[register['dtype']]
+        if fmt in 'bB':
+            # Single bytes go in the high byte of the word
+            return lambda values: [[byte<<8] for byte in struct.pack('>'+str(len(values))+fmt,*[cast(value) for value in values])]
+
+        # The word order decides the byte order of the packed value, and words are
+        # read back swapped when the byte order differs from it
+        size=struct.calcsize(fmt)//2
+        pack=register['wo']+'%d'+fmt
+        unpack=('>' if register['bo']==register['wo'] else '<')+'%dH'
+        def encode(values):
+            words=struct.unpack(unpack % (len(values)*size),struct.pack(pack % len(values),*[cast(value) for value in values]))
+            return [list(words[i:i+size]) for i in range(0,len(words),size)]
+        return encode
+
+    ##\brief Load a column of values from a CSV file
+    # \param filename Path to CSV file with a header row
+    # \param column Column name or index
+    # \return List of values
+    def loadColumn(filename,column):
+        values=[]
+        with open(filename,'r',newline='') as fd:
+            reader=csv.reader(fd)
+            header=next(reader)
+            if isinstance(column,str) and not column.isdigit():
+                column=header.index(column)
+            column=int(column)
+            for row in reader:
+                if column<len(row) and len(row[column]): values.append(row[column])
+        return values
+
+##\class ScenarioEngine
+# \brief Drives register values of a server from the scenarios in its profile
+#
+# Scenarios of the same datablock, kind, interval and datatype are gathered in
+# batches, which are scheduled on a single timer wheel. Each tick the due batches
+# are evaluated in one pass over their parameters, encoded in bulk and written to
+# each datablock with a single atomic setMany() call, regardless of how many
+# registers change.
+class ScenarioEngine():
+    ##\brief Loads scenarios from the server profile
+    # \param server Server object holding the datablocks
+    # \param rate Number of ticks per second, or 0 to disable all scenarios
+    # \param path Directory to resolve relative file names against
+    # \param wheelsize Number of slots in the timer wheel
+    # \param profile Profile to load scenarios from, the server profile by default
+    def __init__(self,server,rate=10,path='',wheelsize=256,profile=None):
+        self.server=server
+        self.tick=1.0/rate if rate>0 else None
+        self.wheel=[[] for i in range(wheelsize)]
+        self.count=0
+        self.running=False
+        self.thread=None
+        if not self.tick: return
+        cache={}
+        batches={}
+        profile=profile if profile else server.profile
+        for datablock in profile['datablocks']:
+            registers=profile['datablocks'][datablock]
+            for address in registers:
+                register=registers[address]
+                if not 'scenario' in register: continue
+                try:
+                    kind,parameters=Scenarios.createParameters(register,path,cache)
+                except Exception as error:
+                    logging.error('Invalid scenario for '+Utilities.getDatablockName(datablock)+' #'+address+': '+str(error))
+                    continue
+                interval=float(register['scenario'].get('interval',self.tick))
+                interval=max(1,int(round(interval/self.tick)))
+
+                # Registers not encoded in bulk (Eg. strings) get an encoder of their own
+                dtype=register['dtype'] if register['dtype'] in Scenarios.formats else address
+                key=(datablock,kind,interval,dtype,register['bo'],register['wo'])
+                if not key in batches: batches[key]=[datablock,kind,Scenarios.createEncoder(register),[],[],interval]
+                batches[key][3].append(int(address))
+                batches[key][4].append(parameters)
+                self.count+=1
+        for key in batches: self.schedule(batches[key],0)
+
+    ##\brief Put a batch of scenarios on the timer wheel
+    # \param batch Scenario batch [datablock,kind,encoder,addresses,parameters,interval]
+    # \param tick Tick number the batch is due
+    def schedule(self,batch,tick):
+        self.wheel[tick%len(self.wheel)].append((tick,batch))
+
+    ##\brief Encode the values of a batch one by one, disabling scenarios that fail
+    # \param batch Scenario batch [datablock,kind,encoder,addresses,parameters,interval]
+    # \param values List of values of the batch
+    # \return List of words per remaining scenario
+    def recover(self,batch,values):
+        datablock,kind,encoder,addresses,parameters,interval=batch
+        output=[]
+        for i in reversed(range(len(addresses))):
+            try:
+                output.append(encoder([values[i]])[0])
+            except Exception as error:
+                logging.warning('Disabling scenario for '+Utilities.getDatablockName(datablock)+' #'+str(addresses[i])+': '+str(error))
+                del addresses[i]
+                del parameters[i]
+                self.count-=1
+        output.reverse()
+        return output
+
+    ##\brief Process all scenarios due at a tick
+    # \param tick Current tick number
+    # \param elapsed Elapsed time in seconds
+    def step(self,tick,elapsed):
+        slot=tick%len(self.wheel)
+        entries=self.wheel[slot]
+        self.wheel[slot]=[]
+        writes={}
+        for due,batch in entries:
+            if due>tick:
+                self.wheel[slot].append((due,batch))
+                continue
+            datablock,kind,encoder,addresses,parameters,interval=batch
+            values=Scenarios.evaluate(kind,parameters,elapsed)
+            if kind!='sequence':
+                try:
+                    values=encoder(values)
+                except Exception:
+                    values=self.recover(batch,values)
+            if not len(addresses): continue
+            if not datablock in writes: writes[datablock]=[]
+            writes[datablock].extend(zip(addresses,values))
+            self.schedule(batch,tick+interval)
+
+        # Write all changes to each datablock in one go
+        for datablock in writes:
+            getattr(self.server,datablock).setMany(writes[datablock])
+
+    ##\brief Thread method running the timer wheel
+    def run(self):
+        started=time.monotonic()
+        tick=0
+        while self.running:
+            # Catch up on any ticks that are due
+            elapsed=time.monotonic()-started
+            now=int(elapsed/self.tick)
+            while tick<=now:
+                self.step(tick,elapsed)
+                tick+=1
+
+            # Wait for next tick
+            delay=started+tick*self.tick-time.monotonic()
+            if delay>0: time.sleep(delay)
+
+    ##\brief Starts the engine in a background thread
+    # \return True if there are any scenarios to run
+    def start(self):
+        if self.count==0: return False
+        logging.info('Running '+str(self.count)+' scenarios at '+str(round(1/self.tick,3))+'Hz')
+        self.running=True
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        return True
+
+    ##\brief Stops the engine
+    def stop(self):
+        self.running=False
+        if self.thread:
+            self.thread.join()
+            self.thread=None
@@ -0,0 +1,221 @@
+##\package timing
+# \brief Adaptive request timing for MODBUS clients
+#
+# Vegard Fiksdal (C) 2024
+#
+# Response times are tracked per device, in the same way TCP estimates its
+# retransmission timeout (RFC 6298): A smoothed round trip time (SRTT) and its
+# mean deviation (RTTVAR) are updated after each response, and the timeout for
+# the next request is SRTT+4*RTTVAR. The timeout never drops below the time it
+# takes to put the request and response on the wire, and never exceeds the
+# timeout given on the commandline.
+#
+# A device failing to respond to a request and its retries is marked as suspect.
+# Requests to suspect devices fail immediately without touching the line, until
+# a backoff period has passed. The next request is then sent as a single probe.
+# If it succeeds the device is healthy again, otherwise the backoff is doubled.
+#
+import logging,time
+from pymodbus import ExceptionResponse,ModbusException
+from common import *
+
+##\class LinkModel
+# \brief Computes the time MODBUS frames take on the wire
+#
+# Each character on a serial line is a start bit, the data bits, an optional
+# parity bit and a stop bit. RTU frames carry the unit id, the PDU and a 16-bit
+# CRC, and must be followed by a silent interval of 3.5 characters (Fixed at
+# 1.75ms above 19200 baud). ASCII frames carry the same fields plus an LRC as
+# hex characters between a colon and CR/LF. Network links are not modelled, and
+# report a wire time of zero.
+class LinkModel():
+    ##\brief Initializes model from link settings
+    # \param args Parsed commandline arguments
+    def __init__(self,args):
+        self.framer=args.framer
+        self.chartime=0
+        self.gap=0
+        if args.comm=='serial':
+            self.chartime=(2+args.bytesize+(0 if args.parity=='N' else 1))/float(args.baudrate)
+            if self.framer=='rtu':
+                self.gap=0.00175 if args.baudrate>19200 else 3.5*self.chartime
+
+    ##\brief Get size of a frame on the wire
+    # \param pdu Size of the PDU in bytes
+    # \return Size of frame in characters
+    def getFrameSize(self,pdu):
+        if self.framer=='ascii': return 1+2*(1+pdu+1)+2
+        if self.framer=='socket': return 7+pdu
+        return 1+pdu+2
+
+    ##\brief Get request and response PDU sizes
+    # \param datablock Datablock to access (di,co,hr or ir)
+    # \param count Number of registers or bits
+    # \param write Set to true for write requests
+    # \return Tuple of request and response PDU sizes in bytes
+    def getPduSizes(datablock,count,write=False):
+        if write:
+            if datablock=='co': return 5,5
+            return 6+2*count,5
+        if datablock=='di' or datablock=='co': return 5,2+(count+7)//8
+        return 5,2+2*count
+
+    ##\brief Get the wire time of a transaction
+    # \param datablock Datablock to access (di,co,hr or ir)
+    # \param count Number of registers or bits
+    # \param write Set to true for write requests
+    # \return Time in seconds to send the request and receive the response, including silent intervals
+    def getTransactionTime(self,datablock,count,write=False):
+        request,response=LinkModel.getPduSizes(datablock,count,write)
+        return (self.getFrameSize(request)+self.getFrameSize(response))*self.chartime+2*self.gap
+
+    ##\brief Predict the wire time of a polling cycle
+    # \param plan List of (datablock,count,write) tuples, one per request
+    # \return Time in seconds
+    def predictCycle(self,plan):
+        return sum(self.getTransactionTime(datablock,count,write) for datablock,count,write in plan)
+
+    ##\brief Get the poll plan of a profile when reading one register per request
+    # \param profile Loaded profile
+    # \return List of (datablock,count,write) tuples
+    def getRegisterPlan(profile):
+        plan=[]
+        for datablock in profile['datablocks']:
+            for address in profile['datablocks'][datablock]:
+                plan.append((datablock,Registers.registersPerValue(profile['datablocks'][datablock][address]),False))
+        return plan
+
+##\class SuspectDeviceException
+# \brief Raised for requests to devices that are backed off
+class SuspectDeviceException(ModbusException):
+    pass
+
+##\class AdaptiveTimeout
+# \brief Derives per device timeouts and retries from measured response times
+class AdaptiveTimeout():
+    ## Gain of the smoothed round trip time
+    alpha=0.125
+
+    ## Gain of the round trip time deviation
+    beta=0.25
+
+    ## Margin added to the wire time for device turnaround, in seconds
+    margin=0.02
+
+    ## Initial backoff for suspect devices, in seconds
+    backoff=1.0
+
+    ## Maximum backoff for suspect devices, in seconds
+    maxbackoff=60.0
+
+    ##\brief Initializes timing from link settings
+    # \param args Parsed commandline arguments
+    # \param retries Number of retries for devices that are not suspect
+    def __init__(self,args,retries=1):
+        self.ceiling=float(args.timeout)
+        self.retries=retries
+        self.link=LinkModel(args)
+        self.devices={}
+
+    ##\brief Get timing state of a device
+    # \param deviceid Device ID (Unit id)
+    # \return Dictionary with srtt, rttvar, failures, backoff and until
+    def getDevice(self,deviceid):
+        if not deviceid in self.devices:
+            self.devices[deviceid]={'srtt':None,'rttvar':0,'failures':0,'backoff':0,'until':0}
+        return self.devices[deviceid]
+
+    ##\brief Get timeout for the next request to a device
+    # \param deviceid Device ID (Unit id)
+    # \param wiretime Time the request and response take on the wire, in seconds
+    # \return Timeout in seconds
+    def getTimeout(self,deviceid,wiretime=0):
+        device=self.getDevice(deviceid)
+        floor=wiretime+AdaptiveTimeout.margin
+        if device['srtt']==None: return max(self.ceiling,floor)
+        return min(max(device['srtt']+4*device['rttvar'],floor),max(self.ceiling,floor))
+
+    ##\brief Check if requests to a device should be skipped
+    # \param deviceid Device ID (Unit id)
+    # \return True if the device is suspect and not due for a probe
+    def isSuspect(self,deviceid):
+        device=self.getDevice(deviceid)
+        return device['backoff']>0 and time.monotonic()<device['until']
+
+    ##\brief Record a response from a device
+    # \param deviceid Device ID (Unit id)
+    # \param rtt Measured round trip time in seconds
+    def success(self,deviceid,rtt):
+        device=self.getDevice(deviceid)
+        if device['srtt']==None:
+            device['srtt']=rtt
+            device['rttvar']=rtt/2
+        else:
+            device['rttvar']=(1-AdaptiveTimeout.beta)*device['rttvar']+AdaptiveTimeout.beta*abs(device['srtt']-rtt)
+            device['srtt']=(1-AdaptiveTimeout.alpha)*device['srtt']+AdaptiveTimeout.alpha*rtt
+        if device['backoff']>0:
+            logging.info('Device '+str(deviceid)+' is responding again')
+        device['failures']=0
+        device['backoff']=0
+
+    ##\brief Record a request a device did not respond to
+    # \param deviceid Device ID (Unit id)
+    def failure(self,deviceid):
+        device=self.getDevice(deviceid)
+        device['failures']+=1
+        if device['backoff']==0: device['backoff']=AdaptiveTimeout.backoff
+        else: device['backoff']=min(device['backoff']*2,AdaptiveTimeout.maxbackoff)
+        device['until']=time.monotonic()+device['backoff']
+        logging.warning('Device '+str(deviceid)+' is not responding, backing off for '+str(device['backoff'])+'s')
+
+    ##\brief Set the timeout of a pymodbus client
+    # \param client Synchronous pymodbus client
+    # \param timeout Timeout in seconds
+    def setTimeout(client,timeout):
+        client.comm_params.timeout_connect=timeout
+        socket=getattr(client,'socket',None)
+        if socket==None: return
+        if hasattr(socket,'settimeout'): socket.settimeout(timeout)
+        else: socket.timeout=timeout
+
+    ##\brief Execute a request with adaptive timeout and retries
+    # \param client Synchronous pymodbus client
+    # \param deviceid Device ID (Unit id)
+    # \param wiretime Time the request and response take on the wire, in seconds
+    # \param request Function executing the request and returning the response
+    # \return Response from the device
+    #
+    # Raises SuspectDeviceException without sending anything if the device is backed off,
+    # and re-raises the last exception if the device did not respond at all.
+    def execute(self,client,deviceid,wiretime,request):
+        if self.isSuspect(deviceid):
+            raise SuspectDeviceException('Skipping request to suspect device '+str(deviceid))
+        attempts=1 if self.getDevice(deviceid)['backoff']>0 else 1+self.retries
+        client.transaction.retries=0
+        response,error=None,None
+        for attempt in range(attempts):
+            AdaptiveTimeout.setTimeout(client,self.getTimeout(deviceid,wiretime))
+            started=time.monotonic()
+            try:
+                response=request()
+            except ModbusException as exc:
+                response,error=None,exc
+            if response!=None and (not response.isError() or isinstance(response,ExceptionResponse)):
+                self.success(deviceid,time.monotonic()-started)
+                return response
+        self.failure(deviceid)
+        if response==None and error: raise error
+        return response
+
+    ##\brief Get a summary of all devices
+    # \return Dictionary of device id to srtt, timeout and backoff in milliseconds
+    def getStatus(self):
+        output={}
+        for deviceid in self.devices:
+            device=self.devices[deviceid]
+            output[deviceid]={
+                'srtt':round(device['srtt']*1000,3) if device['srtt']!=None else None,
+                'timeout':round(self.getTimeout(deviceid)*1000,3),
+                'backoff':round(device['backoff']*1000,3),
+            }
+        return output